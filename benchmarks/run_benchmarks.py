@@ -0,0 +1,243 @@
+'''Time each pipeline stage against synthetic data, with arcpy, arcgis, and forklift stubbed out.
+
+    python run_benchmarks.py [--scale 10] [--repeat 3] [--data-dir dir] [--json results.json]
+    python run_benchmarks.py --scale 10 --compare results.json --tolerance 1.5
+
+--compare exits with status 1 if any stage got slower than --tolerance times its time in the baseline json, so it can
+be used to catch regressions before production data grows into them.
+'''
+
+import argparse
+import io
+import json
+import statistics
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+import stubs
+
+stubs.install()
+
+#: pylint: disable=wrong-import-position
+import synthetic_data  # noqa: E402
+import hex_engine  # noqa: E402
+import update_hexes  # noqa: E402
+from checkpoints import file_digest  # noqa: E402
+from csv_points import convert_csv_to_points  # noqa: E402
+from sftp_sync import LocalDirectoryClient, ManifestSync, open_remote_csv  # noqa: E402
+from update_agol_vehicles_pallet import AGOLVehiclesPallet  # noqa: E402
+from vehicle_proximity import VehicleIndex  # noqa: E402
+
+#: Circumradius in meters of a 5 square mile hexagon (area = 3 * sqrt(3) / 2 * R^2)
+FIVE_SQUARE_MILE_HEX_SIZE = np.sqrt(5 * 2589988.11 / (3 * np.sqrt(3) / 2))
+#: Size of the department writeback benchmark, well past today's few hundred hexes
+WRITEBACK_HEXES = 5000
+WRITEBACK_DEPARTMENTS = 150
+#: Lon, lat of a few state office buildings to look for vehicles around
+OFFICES = [(-111.888, 40.777), (-111.891, 40.760), (-111.660, 40.234), (-113.584, 37.104), (-111.974, 41.223)]
+
+
+def synthetic_points(dhrm_df, seed=4):
+    '''Fake geocoded points (UTM 12N) for the employees in dhrm_df.
+    '''
+
+    rng = np.random.default_rng(seed)
+    count = len(dhrm_df)
+    #: Cluster around a few population centers like the real data does
+    centers = np.array([[425000, 4510000], [445000, 4450000], [415000, 4570000], [270000, 4110000]])
+    picks = rng.integers(0, len(centers), count)
+    x = centers[picks, 0] + rng.normal(0, 15000, count)
+    y = centers[picks, 1] + rng.normal(0, 15000, count)
+    return x, y, dhrm_df['DEPT_NAME'].to_numpy()
+
+
+def synthetic_group_table(hex_count, department_count, seed=5):
+    '''Fake SummarizeWithin group table rows, (join ids, departments, counts), with every hex holding some of the
+    departments. A few department names collide once cleaned for field names.
+    '''
+
+    rng = np.random.default_rng(seed)
+    departments = np.array([f'Department {number}' for number in range(department_count - 2)] +
+                           ['Department-0', 'Department & 1'])
+    per_hex = rng.integers(1, min(department_count, 40), hex_count)
+    join_ids = np.repeat(np.arange(1, hex_count + 1), per_hex)
+    return join_ids, rng.choice(departments, len(join_ids)), rng.integers(1, 50, len(join_ids))
+
+
+def build_stages(paths, work_dir):
+    '''Returns [(stage name, callable, untimed setup callable or None)] in pipeline order. Later stages use the outputs
+    of earlier ones.
+    '''
+
+    state = {}
+    grid = hex_engine.HexGrid(0, 0, FIVE_SQUARE_MILE_HEX_SIZE)
+    pallet = AGOLVehiclesPallet()
+
+    def dhrm():
+        state['dhrm'] = update_hexes.get_dhrm_dataframe(paths['dhrm'])
+
+    def dhrm_cached():
+        update_hexes.get_dhrm_dataframe(paths['dhrm'], work_dir / 'cache')
+
+    def warm_dhrm_cache():
+        update_hexes.get_dhrm_dataframe(paths['dhrm'], work_dir / 'cache')
+
+    def wfh():
+        update_hexes.get_wfh_eins(paths['wfh'], state['dhrm'], work_dir / 'wfh.csv')
+
+    def operators():
+        update_hexes.get_operator_eins(paths['operators'], state['dhrm'], work_dir / 'operators.csv')
+
+    def hex_binning():
+        x, y, departments = synthetic_points(state['dhrm'])
+        state['counts'] = hex_engine.bin_points(grid, x, y, departments)
+
+    def department_matrix():
+        #: The same long (join id, department, count) rows SummarizeWithin's group table has
+        long_counts = state['counts'].drop(columns='Point_Count').stack()
+        long_counts = long_counts[long_counts > 0]
+        join_ids, departments, count_matrix = update_hexes.department_count_matrix(
+            long_counts.index.get_level_values(0), long_counts.index.get_level_values(1), long_counts.to_numpy()
+        )
+        update_hexes.department_update_rows(join_ids, count_matrix)
+        update_hexes.department_field_names(departments)
+
+    def make_wide_group_table():
+        state['wide_groups'] = synthetic_group_table(WRITEBACK_HEXES, WRITEBACK_DEPARTMENTS)
+
+    def department_writeback():
+        join_ids, departments, counts = state['wide_groups']
+        join_ids, departments, count_matrix = update_hexes.department_count_matrix(join_ids, departments, counts)
+        field_names = update_hexes.department_field_names(departments, ['Join_ID', 'Point_Count'])
+        rows = update_hexes.department_update_rows(join_ids, count_matrix)
+        empty_counts = [0] * len(field_names)
+        #: What write_department_counts does for each row of its UpdateCursor
+        state['writeback_rows'] = [
+            rows.get(join_id) or [join_id] + empty_counts for join_id in range(1, WRITEBACK_HEXES + 1)
+        ]
+
+    def latest_csv():
+        pallet.get_latest_csv(paths['vehicles'])
+
+    #: The fleet folder stands in for the SFTP upload folder
+    client = LocalDirectoryClient(paths['vehicles'].parent)
+    remote_dir = paths['vehicles'].name
+    latest_name = ManifestSync.latest_name({path.name: None for path in paths['vehicles'].glob('vehicle_data_*.csv')})
+
+    def csv_downloaded():
+        local_path = ManifestSync(client, remote_dir, work_dir / 'downloads').download(latest_name)
+        file_digest(local_path)
+        convert_csv_to_points(local_path, work_dir / 'downloaded.geojson')
+
+    def csv_streamed():
+        with open_remote_csv(client, f'{remote_dir}/{latest_name}') as stream:
+            convert_csv_to_points(
+                io.BufferedReader(stream, buffer_size=2**20),
+                work_dir / 'streamed.geojson',
+                fields=synthetic_data.VEHICLE_CSV_FIELDS,
+            )
+            stream.hexdigest()
+
+    def make_download_dir():
+        (work_dir / 'downloads').mkdir(exist_ok=True)
+
+    def read_fleet():
+        state['fleet'] = pd.read_csv(paths['vehicles'] / latest_name)
+
+    def vehicle_proximity():
+        #: Everything the CLI does for a whole fleet csv: index it, then both kinds of queries
+        index = VehicleIndex(state['fleet'], miles=5)
+        index.nearby(OFFICES, 5)
+        index.clusters(5)
+
+    return [
+        ('get_dhrm_dataframe', dhrm, None),
+        ('get_dhrm_dataframe (cached)', dhrm_cached, warm_dhrm_cache),
+        ('get_wfh_eins', wfh, None),
+        ('get_operator_eins', operators, None),
+        ('hex binning', hex_binning, None),
+        ('department matrix', department_matrix, None),
+        (
+            f'department writeback ({WRITEBACK_HEXES}x{WRITEBACK_DEPARTMENTS})',
+            department_writeback,
+            make_wide_group_table,
+        ),
+        ('get_latest_csv', latest_csv, None),
+        ('vehicle csv download + convert', csv_downloaded, make_download_dir),
+        ('vehicle csv stream + convert', csv_streamed, None),
+        ('vehicle nearby + clusters', vehicle_proximity, read_fleet),
+    ]
+
+
+def run(paths, work_dir, repeat):
+    '''Run every stage repeat times and return {stage: {'min': seconds, 'median': seconds}}.
+    '''
+
+    results = {}
+    for name, stage, setup in build_stages(paths, work_dir):
+        times = []
+        for _ in range(repeat):
+            #: The pipeline functions narrate their progress; keep that out of the results table
+            with redirect_stdout(io.StringIO()):
+                if setup is not None:
+                    setup()
+                start = perf_counter()
+                stage()
+                times.append(perf_counter() - start)
+        results[name] = {'min': min(times), 'median': statistics.median(times)}
+        print(f'{name:<32}{results[name]["min"]:>10.3f}s{results[name]["median"]:>10.3f}s')
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Print stages that are more than tolerance times slower than baseline. Returns True if there are any.
+    '''
+
+    regressed = False
+    for name, timing in results.items():
+        if name not in baseline:
+            continue
+        ratio = timing['min'] / max(baseline[name]['min'], 1e-9)
+        if ratio > tolerance:
+            regressed = True
+            print(f'REGRESSION: {name} {baseline[name]["min"]:.3f}s -> {timing["min"]:.3f}s ({ratio:.1f}x)')
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark fleetshare pipeline stages on synthetic data')
+    parser.add_argument('--scale', type=float, default=1, help='multiple of current production volume (default 1)')
+    parser.add_argument('--repeat', type=int, default=3, help='times to run each stage (default 3)')
+    parser.add_argument(
+        '--data-dir', type=Path, help='generate synthetic data here (and keep it) instead of a temp dir'
+    )
+    parser.add_argument('--json', type=Path, help='save results to this json file')
+    parser.add_argument('--compare', type=Path, help='baseline json to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='allowed slowdown vs baseline (default 1.5x)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_dir = args.data_dir or Path(temp_dir) / 'data'
+        print(f'Generating scale {args.scale} synthetic data in {data_dir}...')
+        paths = synthetic_data.generate_all(data_dir, args.scale)
+
+        print(f'{"stage":<32}{"min":>11}{"median":>11}')
+        results = run(paths, Path(temp_dir), args.repeat)
+
+    if args.json:
+        args.json.write_text(json.dumps({'scale': args.scale, 'stages': results}, indent=2))
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        if compare(results, baseline['stages'], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''Stand-ins for the ArcGIS, Forklift, SFTP, and secrets modules so the pipeline modules can be imported (and their
+pure-Python stages timed) outside of an ArcGIS Pro environment.
+
+Call install() before importing update_hexes or update_agol_vehicles_pallet. Anything that actually calls arcpy or
+arcgis will fail loudly; only stages that don't touch them should be benchmarked.
+'''
+
+import logging
+import sys
+import types
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent / 'src'
+
+
+class _Unavailable(types.ModuleType):
+    '''Module whose attributes raise, so an accidental arcpy call in a benchmark is obvious.
+    '''
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        raise RuntimeError(f'{self.__name__}.{name} is stubbed out for benchmarking')
+
+
+class Pallet:
+    '''Minimal forklift.models.Pallet: just the log the pallet methods use.
+    '''
+
+    def __init__(self, arg=None):
+        self.arg = arg
+        self.log = logging.getLogger('forklift')
+
+    def configure_standalone_logging(self):
+        logging.basicConfig(level=logging.INFO)
+
+
+def install():
+    '''Put the stubs in sys.modules (without replacing anything real that is already importable) and add src to the
+    path.
+    '''
+
+    if str(SRC_DIR) not in sys.path:
+        sys.path.insert(0, str(SRC_DIR))
+
+    for name in ['arcpy', 'arcgis', 'pysftp']:
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = _Unavailable(name)
+
+    try:
+        __import__('forklift.models')
+    except ImportError:
+        forklift = types.ModuleType('forklift')
+        forklift_models = types.ModuleType('forklift.models')
+        forklift_models.Pallet = Pallet
+        forklift.models = forklift_models
+        sys.modules['forklift'] = forklift
+        sys.modules['forklift.models'] = forklift_models
+
+    for name in ['fleetshare_secrets', 'hex_secrets']:
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = types.ModuleType(name)
@@ -0,0 +1,201 @@
+'''Generate realistic synthetic inputs for the fleetshare pipelines at a configurable scale.
+
+Scale 1 is roughly our current production volume; use larger scales to find out what breaks before the real data
+gets there. Everything is seeded, so the same scale always produces the same files.
+
+    python synthetic_data.py <output_dir> [--scale 10]
+'''
+
+import argparse
+import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+#: Row counts at scale 1
+BASE_EMPLOYEES = 22000
+BASE_WFH_REPORTS = 30
+BASE_WFH_ROWS_PER_REPORT = 400
+BASE_OPERATORS = 9000
+BASE_VEHICLES = 7000
+BASE_VEHICLE_DAYS = 30
+BASE_DEPARTMENTS = 40
+
+STREETS = [
+    'Main St', 'State St', '500 E', '700 W', 'Center St', 'University Ave', '2100 S', 'Redwood Rd', 'Highland Dr'
+]
+ZIPS = [f'84{number:03d}' for number in range(1, 800, 7)]
+#: Field types of generate_vehicle_csvs' columns, for streaming them (see csv_points.convert_csv_to_points)
+VEHICLE_CSV_FIELDS = {
+    'VEHICLE_NUMBER': 'TEXT',
+    'AGENCY': 'TEXT',
+    'MAKE': 'TEXT',
+    'YEAR': 'LONG',
+    'ODOMETER': 'LONG',
+    'LAST_REPORT': 'TEXT',
+}
+#: Roughly the extent of Utah
+LATITUDES = (37.0, 42.0)
+LONGITUDES = (-114.05, -109.05)
+
+
+def _addresses(rng, count):
+    numbers = rng.integers(1, 9999, count)
+    streets = rng.choice(STREETS, count)
+    return pd.Series([f'{number} {street}' for number, street in zip(numbers, streets)])
+
+
+def employee_eins(scale, seed=0):
+    '''The EINs generate_dhrm uses, so the other generators can reference real employees.
+    '''
+
+    rng = np.random.default_rng(seed)
+    return rng.choice(np.arange(100000, 1000000), int(BASE_EMPLOYEES * scale), replace=False)
+
+
+def generate_dhrm(path, scale=1, seed=0):
+    '''Write a DHRM dump: a title row, the real header row, employee rows, and a trailing "Page" row.
+
+    pandas picks the reader from the file's contents, so an .xlsx layout works for the .xls code path.
+    '''
+
+    rng = np.random.default_rng(seed)
+    count = int(BASE_EMPLOYEES * scale)
+    eins = employee_eins(scale, seed)
+    departments = [f'Department of Thing {number} & Stuff-{number % 7}' for number in range(BASE_DEPARTMENTS)]
+
+    has_physical = rng.random(count) < 0.8
+    physical = _addresses(rng, count).where(has_physical, None)
+    physical_zip = pd.Series(rng.choice(ZIPS, count)).where(has_physical, None)
+    mailing_zip = pd.Series(rng.choice(ZIPS, count)) + '-' + pd.Series(rng.integers(1000, 9999, count)).astype(str)
+
+    eins = eins.astype(object)
+    #: A few bad EINs like the real dump has
+    eins[rng.random(count) < 0.001] = 'N/A'
+
+    header = ['EIN', 'Name', 'DEPT_NAME', 'physical_address_line1', 'Empl Physical ZIP', 'mailing_address_line1',
+              'Empl Mail ZIP', 'Job Title', 'Hire Date']
+    rows = pd.DataFrame({
+        'EIN': eins,
+        'Name': [f'Employee {number}' for number in range(count)],
+        'DEPT_NAME': rng.choice(departments, count),
+        'physical_address_line1': physical,
+        'Empl Physical ZIP': physical_zip.map(lambda zip_code: f' {zip_code} ' if zip_code else zip_code),
+        'mailing_address_line1': _addresses(rng, count),
+        'Empl Mail ZIP': mailing_zip,
+        'Job Title': rng.choice(['Analyst', 'Technician', 'Manager', 'Specialist'], count),
+        'Hire Date': pd.Timestamp('2000-01-01') + pd.to_timedelta(rng.integers(0, 8000, count), unit='D'),
+    })
+
+    title = pd.DataFrame([['State of Utah Employee Listing'] + [None] * (len(header) - 1)], columns=header)
+    header_row = pd.DataFrame([header], columns=header)
+    page = pd.DataFrame([['Page 1 of 1'] + [None] * (len(header) - 1)], columns=header)
+    pd.concat([title, header_row, rows, page], ignore_index=True).to_excel(path, header=False, index=False)
+
+
+def generate_wfh_reports(report_dir, scale=1, seed=1):
+    '''Write WFH survey csvs: a header, two junk rows (question text and import ids), then responses.
+    '''
+
+    rng = np.random.default_rng(seed)
+    report_dir = Path(report_dir)
+    report_dir.mkdir(parents=True, exist_ok=True)
+    eins = employee_eins(scale)
+
+    for report_number in range(int(BASE_WFH_REPORTS * scale)):
+        count = BASE_WFH_ROWS_PER_REPORT
+        #: Mostly real employees, some typos
+        report_eins = rng.choice(eins, count).astype(str).astype(object)
+        report_eins[rng.random(count) < 0.03] = '12345'
+        report_eins[rng.random(count) < 0.02] = None
+        responses = pd.DataFrame({
+            'StartDate': pd.Timestamp('2021-01-01') + pd.Timedelta(days=report_number),
+            'New': rng.choice(['Yes', 'No'], count, p=[0.85, 0.15]),
+            'Q5': rng.choice(['DTS', 'DNR', 'UDOT', 'UTNG'], count, p=[0.4, 0.3, 0.25, 0.05]),
+            'Q1_4': report_eins,
+            'Q2': rng.choice(['Full time', 'Part time', 'Not at all'], count),
+            'Q3_TEXT': 'Some free text answer',
+        })
+        junk = pd.DataFrame([{column: f'{column} question text' for column in responses},
+                             {column: f'{{"ImportId":"{column}"}}' for column in responses}])
+        pd.concat([junk, responses], ignore_index=True).to_csv(report_dir / f'wfh_{report_number:03d}.csv', index=False)
+
+
+def generate_operators(path, scale=1, seed=2):
+    '''Write the approved operators xlsx from Fleet.
+    '''
+
+    rng = np.random.default_rng(seed)
+    count = int(BASE_OPERATORS * scale)
+    eins = rng.choice(employee_eins(scale), count)
+    eins[rng.random(count) < 0.01] = rng.integers(1, 99999)
+    pd.DataFrame({
+        'EIN': eins,
+        'Operator Name': [f'Operator {number}' for number in range(count)],
+        'Approval Date': pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 900, count), unit='D'),
+        'License Class': rng.choice(['D', 'C', 'B'], count),
+    }).to_excel(path, index=False)
+
+
+def generate_vehicle_csvs(csv_dir, scale=1, days=BASE_VEHICLE_DAYS, seed=3, end_date=None):
+    '''Write one vehicle_data_YYYYMMDD.csv per day, ending at end_date (today by default).
+    '''
+
+    rng = np.random.default_rng(seed)
+    csv_dir = Path(csv_dir)
+    csv_dir.mkdir(parents=True, exist_ok=True)
+    count = int(BASE_VEHICLES * scale)
+    end_date = end_date or datetime.date.today()
+
+    vehicles = pd.DataFrame({
+        'VEHICLE_NUMBER': [f'V{number:07d}' for number in range(count)],
+        'AGENCY': rng.choice([f'Agency {number}' for number in range(BASE_DEPARTMENTS)], count),
+        'MAKE': rng.choice(['Ford', 'Chevrolet', 'Toyota', 'Dodge'], count),
+        'YEAR': rng.integers(2005, 2022, count),
+    })
+    latitudes = rng.uniform(*LATITUDES, count)
+    longitudes = rng.uniform(*LONGITUDES, count)
+    odometers = rng.integers(1000, 150000, count)
+
+    for day in range(days):
+        date = end_date - datetime.timedelta(days=days - 1 - day)
+        moved = rng.random(count) < 0.3
+        latitudes = np.where(moved, np.clip(latitudes + rng.normal(0, 0.05, count), *LATITUDES), latitudes)
+        longitudes = np.where(moved, np.clip(longitudes + rng.normal(0, 0.05, count), *LONGITUDES), longitudes)
+        odometers = odometers + np.where(moved, rng.integers(1, 200, count), 0)
+        daily = vehicles.assign(
+            ODOMETER=odometers,
+            LATITUDE=latitudes.round(6),
+            LONGITUDE=longitudes.round(6),
+            LAST_REPORT=date.isoformat(),
+        )
+        daily.to_csv(csv_dir / f'vehicle_data_{date:%Y%m%d}.csv', index=False)
+
+
+def generate_all(output_dir, scale=1):
+    '''Generate every input under output_dir and return a dict of their paths.
+    '''
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    paths = {
+        'dhrm': output_dir / 'dhrm.xlsx',
+        'wfh': output_dir / 'wfh',
+        'operators': output_dir / 'operators.xlsx',
+        'vehicles': output_dir / 'fleet',
+    }
+    generate_dhrm(paths['dhrm'], scale)
+    generate_wfh_reports(paths['wfh'], scale)
+    generate_operators(paths['operators'], scale)
+    generate_vehicle_csvs(paths['vehicles'], scale)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic fleetshare inputs')
+    parser.add_argument('output_dir', type=Path)
+    parser.add_argument('--scale', type=float, default=1, help='multiple of current production volume (default 1)')
+    args = parser.parse_args()
+    for name, path in generate_all(args.output_dir, args.scale).items():
+        print(f'{name}: {path}')
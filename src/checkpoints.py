@@ -0,0 +1,168 @@
+'''Checkpoints for resuming update_hexes part way through.
+
+Each stage's completion is recorded in a json manifest along with a key, a hash of everything the stage's outputs
+depend on: the contents of its input files, its parameters, and the output hash of the stage before it. On the next
+run a stage is skipped if its key matches and its outputs still exist, so the run resumes at the first stage whose
+inputs changed (or whose outputs were deleted). --force-from reruns a stage and every stage after it regardless.
+'''
+
+import datetime
+import hashlib
+import json
+import os
+from pathlib import Path
+
+#: Stages in the order they run. Per-method stages are recorded as '<stage>:<method>' (ie, 'bin:wfh'). publish isn't
+#: checkpointed here (see fingerprints.py), but can be forced.
+STAGES = ['records', 'geocode', 'select', 'bin', 'trim', 'rollup', 'publish']
+
+
+def file_digest(path, chunk_size=2**20):
+    '''Get the sha256 hex digest of a file's contents
+
+    Args:
+        path (Path): File to hash
+        chunk_size (int, optional): Bytes to read at a time. Defaults to 1 MB.
+
+    Returns:
+        str: Hex digest
+    '''
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stat_fingerprint(path):
+    '''Cheap stand-in for a content hash of inputs that are too big to hash every run (ie, locators): the path, size,
+    and modification time
+
+    Args:
+        path (Path): File to fingerprint
+
+    Returns:
+        str: The fingerprint, or just the path if it isn't a regular file
+    '''
+
+    path = Path(path)
+    if not path.is_file():
+        return str(path)
+    stat = path.stat()
+    return f'{path}|{stat.st_size}|{stat.st_mtime_ns}'
+
+
+def tree_fingerprint(path):
+    '''stat_fingerprint of a file, or of every file in a directory (ie, a folder of WFH reports), so a folder of inputs
+    can be checked every run without reading it
+
+    Args:
+        path (Path): File or directory to fingerprint
+
+    Returns:
+        str: Hex digest of the files' paths, sizes, and modification times
+    '''
+
+    path = Path(path)
+    files = sorted(child for child in path.rglob('*') if child.is_file()) if path.is_dir() else [path]
+    return hash_parts(*[stat_fingerprint(child) for child in files])
+
+
+def hash_parts(*parts):
+    '''Combine parts (anything with a stable str()) into a single sha256 hex digest
+
+    Returns:
+        str: Hex digest
+    '''
+
+    return hashlib.sha256('\0'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+class CheckpointStore:
+    '''Records which stages have completed and the key of the inputs they completed with
+
+    Args:
+        manifest_path (Path): json file to keep the checkpoints in
+        force_from (str, optional): Rerun this stage (one of STAGES) and every later stage. Defaults to None.
+        exists (callable, optional): Checks whether an output exists. Defaults to os.path.exists; pass arcpy.Exists
+            for feature classes.
+
+    Raises:
+        ValueError: If force_from isn't one of STAGES
+    '''
+
+    def __init__(self, manifest_path, force_from=None, exists=os.path.exists):
+        if force_from is not None and force_from not in STAGES:
+            raise ValueError(f'Unknown stage {force_from}; must be one of {", ".join(STAGES)}')
+
+        self.manifest_path = Path(manifest_path)
+        self.force_from = force_from
+        self.exists = exists
+        self.manifest = json.loads(self.manifest_path.read_text()) if self.manifest_path.exists() else {}
+
+    @staticmethod
+    def base_stage(stage):
+        return stage.split(':')[0]
+
+    def is_forced(self, stage):
+        if self.force_from is None:
+            return False
+        return STAGES.index(self.base_stage(stage)) >= STAGES.index(self.force_from)
+
+    def is_current(self, stage, key, outputs):
+        '''Whether stage already completed with the same key and all of its outputs are still there
+
+        Args:
+            stage (str): Stage name
+            key (str): Hash of the stage's inputs
+            outputs (list): Paths the stage writes
+
+        Returns:
+            bool: True if the stage can be skipped
+        '''
+
+        checkpoint = self.manifest.get(stage)
+        if self.is_forced(stage) or checkpoint is None or checkpoint['key'] != key:
+            return False
+        return all(self.exists(str(output)) for output in outputs)
+
+    def output_hash(self, stage):
+        '''The hash of stage's outputs from when it last completed, for keying the stages that read them
+
+        Raises:
+            KeyError: If stage hasn't completed
+        '''
+
+        return self.manifest[stage]['output_hash']
+
+    def invalidate(self, stage):
+        '''Forget stage's checkpoint (ie, before rerunning it, so a failure part way through doesn't leave it marked
+        complete)
+        '''
+
+        if self.manifest.pop(stage, None) is not None:
+            self.save()
+
+    def complete(self, stage, key, output_hash=None):
+        '''Record that stage finished with key
+
+        Args:
+            stage (str): Stage name
+            key (str): Hash of the stage's inputs
+            output_hash (str, optional): Hash of the stage's outputs. Defaults to None (use key; for stages whose
+                outputs are too expensive to hash and only depend on key).
+        '''
+
+        self.manifest[stage] = {
+            'key': key,
+            'output_hash': output_hash or key,
+            'completed': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        self.save()
+
+    def save(self):
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.manifest_path.with_suffix('.tmp')
+        temp_path.write_text(json.dumps(self.manifest, indent=2))
+        os.replace(temp_path, self.manifest_path)
@@ -0,0 +1,515 @@
+'''
+csv_points.py:
+Streams a vehicle csv into a point feature class in bounded chunks, validating
+the coordinates and field values of each chunk with vectorized checks and
+writing rejected rows (with the reason) to a separate csv instead of failing or
+silently dropping them. Writes to a GeoJSON file instead when arcpy isn't
+available.
+'''
+
+import json
+import os
+import tempfile
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+#: WGS84 valid ranges as (xmin, ymin, xmax, ymax)
+WGS84_BOUNDS = (-180, -90, 180, 90)
+REJECT_REASON_FIELD = 'reject_reason'
+#: Minimum length for text fields; columns with longer values get double their longest
+MIN_TEXT_LENGTH = 255
+FIELD_TYPES = ('SHORT', 'LONG', 'DOUBLE', 'TEXT')
+LONG_RANGE = (-2**31, 2**31 - 1)
+#: Text values written to SHORT fields
+BOOLEAN_VALUES = {'true': 1, 'false': 0}
+SPOOL_CHUNK_PATTERN = 'chunk_*.pkl'
+
+
+@dataclass
+class ConversionReport:
+    '''
+    Row counts from a conversion.
+
+    rows:       Rows read from the csv
+    written:    Points written to the output
+    rejects:    {reason: count} for rows that weren't written
+    '''
+    rows: int = 0
+    written: int = 0
+    rejects: dict = field(default_factory=dict)
+
+    @property
+    def rejected(self):
+        return sum(self.rejects.values())
+
+    def __str__(self):
+        reasons = ', '.join(f'{count} {reason}' for reason, count in self.rejects.items())
+        return f'{self.written} of {self.rows} rows written' + (f' ({reasons} rejected)' if reasons else '')
+
+
+def validate_coordinates(chunk, x_field, y_field, bounds=None):
+    '''
+    Check every row's coordinates at once.
+
+    chunk:      DataFrame of csv rows
+    x_field:    Longitude column
+    y_field:    Latitude column
+    bounds:     Optional (xmin, ymin, xmax, ymax) the points must fall in (ie,
+                roughly Utah), on top of the WGS84 range check
+
+    returns: Series of reject reasons for each row, None for valid rows, and
+             the x and y columns as floats
+    '''
+
+    x = pd.to_numeric(chunk[x_field], errors='coerce')
+    y = pd.to_numeric(chunk[y_field], errors='coerce')
+
+    def outside(xmin, ymin, xmax, ymax):
+        return ~(x.between(xmin, xmax) & y.between(ymin, ymax))
+
+    reasons = pd.Series(None, index=chunk.index, dtype=object)
+    checks = [
+        ('missing coordinates', chunk[x_field].isnull() | chunk[y_field].isnull()),
+        ('non-numeric coordinates', x.isnull() | y.isnull() | ~np.isfinite(x) | ~np.isfinite(y)),
+        ('out of WGS84 range', outside(*WGS84_BOUNDS)),
+        ('null island', (x == 0) & (y == 0)),
+    ]
+    if bounds is not None:
+        checks.append(('outside bounds', outside(*bounds)))
+
+    #: First failing check wins
+    for reason, failed in checks:
+        reasons = reasons.where(reasons.notnull() | ~failed, reason)
+
+    return reasons, x, y
+
+
+def column_type(values):
+    '''
+    The narrowest field type that holds every value in a column of csv text, or
+    None if it's all empty.
+    '''
+
+    values = values.dropna()
+    if values.empty:
+        return None
+    if values.str.lower().isin(BOOLEAN_VALUES).all():
+        return 'SHORT'
+    numbers = pd.to_numeric(values, errors='coerce')
+    if numbers.isnull().any():
+        return 'TEXT'
+    if ((numbers % 1) == 0).all() and numbers.between(*LONG_RANGE).all():
+        return 'LONG'
+    return 'DOUBLE'
+
+
+def widen_type(first, second):
+    '''
+    The field type that holds the values of both types (None for an all-empty
+    column fits anything).
+    '''
+
+    if first is None or first == second:
+        return second
+    if second is None:
+        return first
+    if {first, second} == {'LONG', 'DOUBLE'}:
+        return 'DOUBLE'
+    return 'TEXT'
+
+
+def text_length(longest):
+    return max(MIN_TEXT_LENGTH, int(longest) * 2)
+
+
+def infer_schema(chunks, x_field, y_field, source=''):
+    '''
+    Work out every column's field type and text length from all of chunks.
+
+    chunks:     Iterable of DataFrames of csv text (read with dtype=str)
+    x_field:    Longitude column, always DOUBLE
+    y_field:    Latitude column, always DOUBLE
+    source:     Name of the csv for error messages
+
+    returns: {column: (field type, text length or None)} in csv column order.
+             Columns that are empty throughout are TEXT.
+    raises: ValueError if there are no rows or x_field or y_field is missing
+    '''
+
+    types = longest = None
+    for chunk in chunks:
+        if types is None:
+            if x_field not in chunk.columns or y_field not in chunk.columns:
+                raise ValueError(f'{source} is missing {x_field} or {y_field}')
+            types = dict.fromkeys(chunk.columns)
+            longest = dict.fromkeys(chunk.columns, 0)
+        for column in chunk.columns:
+            types[column] = widen_type(types[column], column_type(chunk[column]))
+            column_longest = chunk[column].str.len().max()
+            if not pd.isnull(column_longest):
+                longest[column] = max(longest[column], int(column_longest))
+    if types is None:
+        raise ValueError(f'{source} has no rows')
+
+    #: Coordinates are always written as numbers; bad ones are rejected by validate_coordinates
+    types[x_field] = types[y_field] = 'DOUBLE'
+    return {
+        column: ('TEXT', text_length(longest[column])) if field_type in (None, 'TEXT') else (field_type, None)
+        for column, field_type in types.items()
+    }
+
+
+def scan_schema(csv_path, x_field, y_field, chunk_size=50000, spool_dir=None):
+    '''
+    Read the whole csv, chunk_size rows at a time, for its schema (see
+    infer_schema) so a column that only gets text, decimals, large numbers, or
+    long values further down is still given a field that holds them.
+
+    spool_dir:  Optional directory to also pickle each parsed chunk to, so
+                they can be read back with spooled_chunks instead of parsing
+                the csv a second time
+    '''
+
+    def chunks():
+        for number, chunk in enumerate(pd.read_csv(csv_path, chunksize=chunk_size, dtype=str)):
+            if spool_dir is not None:
+                chunk.to_pickle(Path(spool_dir) / f'chunk_{number:06d}.pkl')
+            yield chunk
+
+    return infer_schema(chunks(), x_field, y_field, csv_path)
+
+
+def spooled_chunks(spool_dir):
+    '''
+    Yields the chunks scan_schema pickled to spool_dir, in csv order, deleting
+    each one once it's read.
+    '''
+
+    for chunk_path in sorted(Path(spool_dir).glob(SPOOL_CHUNK_PATTERN)):
+        chunk = pd.read_pickle(chunk_path)
+        chunk_path.unlink()
+        yield chunk
+
+
+def stream_schema(columns, fields, x_field, y_field, source=''):
+    '''
+    The schema for a streamed csv, which can't be read ahead of writing to
+    infer its types.
+
+    columns:    The csv's columns, from its first chunk
+    fields:     {column: field type} (see normalize_fields) for every column
+                but x_field and y_field, which are always DOUBLE
+
+    returns: {column: (field type, text length or None)} in csv column order
+    raises: ValueError if a column is missing from fields or x_field or
+            y_field is missing from the csv
+    '''
+
+    if x_field not in columns or y_field not in columns:
+        raise ValueError(f'{source} is missing {x_field} or {y_field}')
+    explicit = normalize_fields(fields or {})
+    explicit[x_field] = explicit[y_field] = ('DOUBLE', None)
+    missing = [column for column in columns if column not in explicit]
+    if missing:
+        raise ValueError(f'Streaming {source} needs a field type for every column; missing {", ".join(missing)}')
+    return {column: explicit[column] for column in columns}
+
+
+def normalize_fields(fields):
+    '''
+    fields:     {column: field type} where the type is one of FIELD_TYPES, or
+                ('TEXT', length) for a text field of a given length
+
+    returns: {column: (field type, text length or None)}
+    raises: NotImplementedError for an unknown field type
+    '''
+
+    schema = {}
+    for column, field_type in fields.items():
+        field_type, length = (field_type, None) if isinstance(field_type, str) else field_type
+        field_type = field_type.upper()
+        if field_type not in FIELD_TYPES:
+            raise NotImplementedError(f'Unknown field type {field_type} for {column}')
+        if field_type == 'TEXT' and length is None:
+            length = MIN_TEXT_LENGTH
+        schema[column] = (field_type, length)
+    return schema
+
+
+def override_fields(schema, fields):
+    '''
+    schema with the types from fields (see normalize_fields) in place of the
+    inferred ones; columns not in schema are ignored.
+    '''
+
+    explicit = normalize_fields(fields or {})
+    return {column: explicit.get(column, spec) for column, spec in schema.items()}
+
+
+def field_name(column, workspace=None):
+    '''
+    The name a column gets as a field in workspace (see ArcpyPointWriter), or
+    the column itself without arcpy (see GeoJSONPointWriter).
+    '''
+
+    if arcpy is None:
+        return column
+    return arcpy.ValidateFieldName(column, workspace)
+
+
+def value_text(value):
+    if isinstance(value, (bool, np.bool_)):
+        return 'true' if value else 'false'
+    #: A whole number in a float column (ie, one with blanks) was written without the .0
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def csv_text(rows_df):
+    '''
+    Rows of any types (ie, inferred by pandas or read from the vehicle history)
+    back as the csv text read_csv(dtype=str) gives, for infer_schema and
+    conform_chunk.
+    '''
+
+    return rows_df.astype(object).apply(lambda values: values.map(value_text, na_action='ignore'))
+
+
+def conform_rows(rows_df, schema, workspace=None):
+    '''
+    Convert rows of any types to the field names and types convert_csv_to_points
+    writes for schema, ie to edit a layer published from its output.
+
+    rows_df:    DataFrame of rows (see csv_text) with every column in schema
+    schema:     {column: (field type, text length or None)}
+    workspace:  Workspace the field names are validated for (see field_name)
+
+    returns: the converted DataFrame, named by field, and a Series of reject
+             reasons for each row (see conform_chunk)
+    '''
+
+    conformed, reasons = conform_chunk(csv_text(rows_df), schema)
+    return conformed.rename(columns=lambda column: field_name(column, workspace)), reasons
+
+
+def conform_chunk(chunk, schema):
+    '''
+    Convert a chunk of csv text to the schema's field types.
+
+    chunk:      DataFrame of csv rows read with dtype=str
+    schema:     {column: (field type, text length or None)}
+
+    returns: the converted DataFrame and a Series of reject reasons for each
+             row, None for rows whose values all fit (ie, text in a number
+             field or a value too long for its text field)
+    '''
+
+    conformed = {}
+    reasons = pd.Series(None, index=chunk.index, dtype=object)
+    for column, (field_type, length) in schema.items():
+        text = chunk[column]
+        if field_type == 'SHORT':
+            values = text.str.lower().map(BOOLEAN_VALUES).astype('Int64')
+            failed, reason = values.isnull(), f'non-boolean {column}'
+        elif field_type == 'TEXT':
+            values = text.astype(object).where(text.notnull(), None)
+            failed, reason = text.str.len() > length, f'{column} too long'
+        else:
+            values = pd.to_numeric(text, errors='coerce')
+            failed, reason = values.isnull(), f'non-numeric {column}'
+            if field_type == 'LONG':
+                failed |= ((values % 1) != 0) | ~values.between(*LONG_RANGE)
+                reason = f'non-integer {column}'
+                values = values.where(~failed).astype('Int64')
+        #: First failing column wins; empty values are always fine
+        failed = failed.fillna(False).astype(bool) & text.notnull()
+        reasons = reasons.where(reasons.notnull() | ~failed, reason)
+        conformed[column] = values
+    return pd.DataFrame(conformed, index=chunk.index), reasons
+
+
+def records(chunk):
+    '''
+    Rows as lists with NaN replaced by None.
+    '''
+
+    return chunk.astype(object).where(chunk.notnull(), None).values.tolist()
+
+
+class ArcpyPointWriter:
+    '''
+    Writes points to a new WGS84 feature class through an InsertCursor that
+    stays open across chunks.
+
+    fc_path:        Path of the feature class to create (must not exist)
+    schema:         {column: (field type, text length or None)} of the csv
+    '''
+
+    def __init__(self, fc_path, schema):
+        out_path, out_name = os.path.split(fc_path)
+        arcpy.management.CreateFeatureclass(
+            out_path, out_name, 'POINT', spatial_reference=arcpy.SpatialReference(4326)
+        )
+
+        field_specs = []
+        self.field_names = []
+        for column, (field_type, length) in schema.items():
+            name = field_name(column, out_path)
+            self.field_names.append(name)
+            field_specs.append([name, field_type, name, length] if field_type == 'TEXT' else [name, field_type])
+        arcpy.management.AddFields(fc_path, field_specs)
+
+        self.cursor = arcpy.da.InsertCursor(fc_path, ['SHAPE@XY'] + self.field_names)
+
+    def write(self, chunk, x, y):
+        for xy, row in zip(zip(x.tolist(), y.tolist()), records(chunk)):
+            self.cursor.insertRow([xy] + row)
+
+    def close(self):
+        del self.cursor
+
+
+class GeoJSONPointWriter:
+    '''
+    Streams points to a GeoJSON FeatureCollection file one chunk at a time.
+
+    geojson_path:   Path of the file to write
+    schema:         {column: (field type, text length or None)} of the csv
+    '''
+
+    def __init__(self, geojson_path, schema):
+        self.columns = list(schema)
+        self.file = open(geojson_path, 'w', encoding='utf-8')  #: pylint: disable=consider-using-with
+        self.file.write('{"type": "FeatureCollection", "features": [\n')
+        self.first = True
+
+    def write(self, chunk, x, y):
+        for point_x, point_y, row in zip(x.tolist(), y.tolist(), records(chunk)):
+            feature = {
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [point_x, point_y]},
+                'properties': dict(zip(self.columns, row)),
+            }
+            self.file.write(('' if self.first else ',\n') + json.dumps(feature, default=str))
+            self.first = False
+
+    def close(self):
+        self.file.write('\n]}\n')
+        self.file.close()
+
+
+def get_writer_class(output_path):
+    '''
+    GeoJSON for .geojson outputs or when arcpy isn't available, a feature
+    class otherwise.
+    '''
+
+    if arcpy is None or str(output_path).lower().endswith('.geojson'):
+        return GeoJSONPointWriter
+    return ArcpyPointWriter
+
+
+def convert_csv_to_points(
+    csv_path,
+    output_path,
+    x_field='LONGITUDE',
+    y_field='LATITUDE',
+    chunk_size=50000,
+    bounds=None,
+    rejects_path=None,
+    fields=None,
+    log=None,
+):
+    '''
+    Convert a csv of WGS84 coordinates to points, chunk_size rows at a time.
+
+    Each column's field type and text length come from reading the whole csv
+    once beforehand; the chunks parsed then are spooled to a temporary folder
+    and written from there, so the csv is only parsed once. A stream can only
+    be read once and there's no telling what types its later rows need, so it
+    must be given fields for every column. Values that don't fit a field from
+    fields are rejected rather than written as null.
+
+    csv_path:       Path to the csv, or a binary file object to stream it
+                    from (ie, sftp_sync.open_remote_csv)
+    output_path:    Feature class to create, or a .geojson file
+    x_field:        Longitude column
+    y_field:        Latitude column
+    chunk_size:     Rows to hold in memory at once
+    bounds:         Optional (xmin, ymin, xmax, ymax) to reject points outside
+    rejects_path:   Optional csv to write rejected rows to, with a
+                    reject_reason column. Removed if nothing is rejected.
+    fields:         {column: field type} (see normalize_fields) to use
+                    instead of the inferred types; columns not in the csv are
+                    ignored. Required for every column but x_field and y_field
+                    when streaming.
+    log:            Optional logger for per-chunk progress
+
+    returns: ConversionReport
+    raises: ValueError if the csv has no rows, x_field or y_field isn't in it,
+            or it's streamed and a column is missing from fields
+    '''
+
+    report = ConversionReport()
+    writer = None
+    schema = None
+    spool = None
+    rejects_written = False
+    if rejects_path is not None and os.path.exists(rejects_path):
+        os.remove(rejects_path)
+
+    try:
+        if isinstance(csv_path, (str, os.PathLike)):
+            spool = tempfile.TemporaryDirectory(prefix='csv_points_')  #: pylint: disable=consider-using-with
+            schema = scan_schema(csv_path, x_field, y_field, chunk_size, spool.name)
+            chunks = spooled_chunks(spool.name)
+        else:
+            chunks = pd.read_csv(csv_path, chunksize=chunk_size, dtype=str)
+
+        for chunk in chunks:
+            if writer is None:
+                if schema is None:
+                    schema = stream_schema(list(chunk.columns), fields, x_field, y_field, csv_path)
+                else:
+                    schema = override_fields(schema, fields)
+                writer = get_writer_class(output_path)(output_path, schema)
+
+            reasons, x, y = validate_coordinates(chunk, x_field, y_field, bounds)
+            conformed, field_reasons = conform_chunk(chunk, schema)
+            reasons = reasons.where(reasons.notnull(), field_reasons)
+            valid = reasons.isnull()
+            writer.write(conformed[valid], x[valid], y[valid])
+
+            report.rows += len(chunk)
+            report.written += int(valid.sum())
+            for reason, count in reasons[~valid].value_counts().items():
+                report.rejects[reason] = report.rejects.get(reason, 0) + int(count)
+
+            if rejects_path is not None and not valid.all():
+                chunk[~valid].assign(**{REJECT_REASON_FIELD: reasons[~valid]}).to_csv(
+                    rejects_path, mode='a', header=not rejects_written, index=False
+                )
+                rejects_written = True
+
+            if log is not None:
+                log.debug(f'{report.rows} rows converted...')
+    finally:
+        if writer is not None:
+            writer.close()
+        if spool is not None:
+            spool.cleanup()
+
+    if writer is None:
+        raise ValueError(f'{csv_path} has no rows')
+
+    return report
@@ -0,0 +1,155 @@
+'''Typed EIN matching between the DHRM employee data and the WFH and operator source lists.
+
+EINs show up as ints, floats (from Excel), and free text (from the WFH survey). normalize_eins validates and converts
+all of them to the same nullable Int32 with vectorized checks, and EINIndex keeps the DHRM frame's EINs as a sorted
+int32 array with each one's row position so any number of source lists can be matched against it with searchsorted.
+'''
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+#: EINs are at most six digits
+MAX_EIN = 999999
+
+
+@dataclass
+class EINMatchStats:
+    '''How a source list's EINs matched the DHRM data
+
+    Attributes:
+        source (str): Name of the source list
+        eins (int): Rows in the source list
+        invalid (int): Rows without a valid EIN
+        duplicates (int): Valid rows whose EIN already appeared earlier in the source list
+        matched (int): Unique valid EINs found in the DHRM data
+        missed (int): Unique valid EINs not in the DHRM data
+        ambiguous (int): Matched EINs that are on more than one DHRM row
+    '''
+    source: str
+    eins: int = 0
+    invalid: int = 0
+    duplicates: int = 0
+    matched: int = 0
+    missed: int = 0
+    ambiguous: int = 0
+
+    def __str__(self):
+        return (
+            f'{self.source}: {self.matched} EINs matched, {self.missed} missed, {self.duplicates} duplicates, '
+            f'{self.invalid} invalid, {self.ambiguous} on more than one employee record (of {self.eins} rows)'
+        )
+
+
+def normalize_eins(values, text_length=None, min_value=1, max_value=MAX_EIN):
+    '''Validate and convert EINs to integers
+
+    Numbers must be whole and text must be all digits (a trailing .0 from Excel is allowed); both must be between
+    min_value and max_value.
+
+    Args:
+        values (array-like): EINs as numbers or text
+        text_length (int, optional): Text EINs must have exactly this many characters (ie, 6 to drop mistyped survey
+            answers). Defaults to None (any length).
+        min_value (int, optional): Smallest valid EIN. Defaults to 1.
+        max_value (int, optional): Largest valid EIN. Defaults to MAX_EIN.
+
+    Returns:
+        Series: Int32 EINs (with values' index if it's a Series), <NA> for invalid ones
+    '''
+
+    values = values if isinstance(values, pd.Series) else pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        numbers = pd.to_numeric(values, errors='coerce').astype('float64')
+        valid = numbers.notna() & (numbers == np.floor(numbers))
+    else:
+        text = values.astype('string').str.strip().str.replace(r'\.0+$', '', regex=True)
+        valid = text.str.fullmatch(r'\d+').fillna(False).astype(bool)
+        if text_length is not None:
+            valid &= text.str.len() == text_length
+        numbers = pd.to_numeric(text.where(valid), errors='coerce').astype('float64')
+
+    valid &= numbers.between(min_value, max_value)
+    return numbers.where(valid).astype('Int32')
+
+
+class EINIndex:
+    '''Sorted int32 EINs of a DHRM frame with the row position of each, for matching source lists with searchsorted
+
+    Args:
+        eins (array-like): The DHRM frame's EINs (ie, its EINint column), in row order
+
+    Attributes:
+        eins (np.ndarray): Sorted valid EINs (int32)
+        rows (np.ndarray): Row position of each of eins in the DHRM frame
+        invalid (int): DHRM rows without a valid EIN
+        duplicates (int): DHRM rows whose EIN is on an earlier row too
+    '''
+
+    def __init__(self, eins):
+        normalized = normalize_eins(eins)
+        valid = normalized.notna().to_numpy()
+        keys = normalized.to_numpy(dtype=np.int32, na_value=0)[valid]
+        order = np.argsort(keys, kind='stable')
+
+        self.eins = keys[order]
+        self.rows = np.flatnonzero(valid)[order]
+        self.invalid = int((~valid).sum())
+        self.duplicates = len(self.eins) - len(np.unique(self.eins))
+
+    def pairs(self, source_eins, source='source', **normalize_options):
+        '''Match a source list against the index
+
+        Args:
+            source_eins (array-like): The source list's EINs, in row order
+            source (str, optional): Name of the source list for the stats. Defaults to 'source'.
+            **normalize_options: text_length, min_value, and max_value for normalize_eins
+
+        Returns:
+            (np.ndarray, np.ndarray, EINMatchStats): DHRM row positions and source row positions of every matching
+                pair (like an inner join, so a duplicated EIN pairs every copy on both sides), and the match stats
+        '''
+
+        normalized = normalize_eins(source_eins, **normalize_options)
+        valid = normalized.notna().to_numpy()
+        keys = normalized.to_numpy(dtype=np.int32, na_value=0)[valid]
+        source_rows = np.flatnonzero(valid)
+
+        starts = np.searchsorted(self.eins, keys, side='left')
+        ends = np.searchsorted(self.eins, keys, side='right')
+        counts = ends - starts
+
+        unique_keys, first_positions = np.unique(keys, return_index=True)
+        unique_counts = counts[first_positions]
+        stats = EINMatchStats(
+            source=source,
+            eins=len(normalized),
+            invalid=int((~valid).sum()),
+            duplicates=len(keys) - len(unique_keys),
+            matched=int((unique_counts > 0).sum()),
+            missed=int((unique_counts == 0).sum()),
+            ambiguous=int((unique_counts > 1).sum()),
+        )
+
+        #: Expand each source row into one pair per DHRM row with its EIN
+        pair_sources = np.repeat(np.arange(len(keys)), counts)
+        pair_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        dhrm_rows = self.rows[starts[pair_sources] + pair_offsets]
+
+        return dhrm_rows, source_rows[pair_sources], stats
+
+    def match(self, source_eins, source='source', **normalize_options):
+        '''Find the DHRM rows whose EINs are in a source list
+
+        Args:
+            source_eins (array-like): The source list's EINs
+            source (str, optional): Name of the source list for the stats. Defaults to 'source'.
+            **normalize_options: text_length, min_value, and max_value for normalize_eins
+
+        Returns:
+            (np.ndarray, EINMatchStats): Sorted unique DHRM row positions and the match stats
+        '''
+
+        dhrm_rows, _, stats = self.pairs(source_eins, source, **normalize_options)
+        return np.unique(dhrm_rows), stats
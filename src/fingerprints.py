@@ -0,0 +1,108 @@
+'''
+fingerprints.py:
+Remembers what was last published to each AGOL item, as a hash of the source
+file it came from and of the final feature class's contents, so unchanged data
+doesn't get staged and published again.
+'''
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+from pathlib import Path
+
+FINGERPRINT_FILE_NAME = 'publish_fingerprints.json'
+#: Serializes writes from concurrent publishes
+_WRITE_LOCK = threading.Lock()
+
+
+def feature_class_digest(fc_path):
+    '''
+    Returns a sha256 hex digest of a feature class's contents (geometry and
+    every editable attribute, ignoring ObjectIDs and row order), so the same
+    data written to a new feature class hashes the same.
+    '''
+
+    import arcpy  #: pylint: disable=import-outside-toplevel
+
+    fields = sorted(
+        field.name for field in arcpy.ListFields(fc_path) if field.editable and field.type not in ['OID', 'Geometry']
+    )
+    row_digests = []
+    with arcpy.da.SearchCursor(fc_path, ['SHAPE@WKB'] + fields) as cursor:
+        for shape, *attributes in cursor:
+            row_digest = hashlib.sha256(bytes(shape) if shape is not None else b'')
+            row_digest.update(repr(attributes).encode())
+            row_digests.append(row_digest.digest())
+
+    digest = hashlib.sha256('\0'.join(fields).encode())
+    for row_digest in sorted(row_digests):
+        digest.update(row_digest)
+    return digest.hexdigest()
+
+
+class FingerprintStore:
+    '''
+    json file of {item id: {'source': hash, 'output': hash, 'snapshot_date':
+    iso date or None, 'remote': sftp_sync.remote_fingerprint or None,
+    'published': iso timestamp}} for the last successful publish to each item.
+
+    store_path:     Path to the json file; created on the first record()
+    '''
+
+    def __init__(self, store_path):
+        self.store_path = Path(store_path)
+        self.fingerprints = json.loads(self.store_path.read_text()) if self.store_path.exists() else {}
+
+    def is_unchanged(self, item_id, source=None, output=None, remote=None):
+        '''
+        Returns True if item_id was last published from the same source and/or
+        output hash and/or remote file. Only the ones that are passed are
+        compared; returns False if none are passed or the item hasn't been
+        published yet.
+        '''
+
+        fingerprint = self.fingerprints.get(item_id)
+        if fingerprint is None or (source is None and output is None and remote is None):
+            return False
+        if source is not None and fingerprint.get('source') != source:
+            return False
+        if output is not None and fingerprint.get('output') != output:
+            return False
+        if remote is not None and fingerprint.get('remote') != remote:
+            return False
+        return True
+
+    def get(self, item_id):
+        '''
+        Returns the last publish's entry for item_id, or an empty dict.
+        '''
+
+        return self.fingerprints.get(item_id, {})
+
+    def record(self, item_id, source=None, output=None, snapshot_date=None, remote=None):
+        '''
+        Save the hashes of what was just published to item_id, and optionally
+        the date of the data and the remote file it came from. Other items'
+        entries are re-read from the file first, so stores for different items
+        can record concurrently.
+        '''
+
+        with _WRITE_LOCK:
+            if self.store_path.exists():
+                self.fingerprints.update(
+                    {key: value for key, value in json.loads(self.store_path.read_text()).items() if key != item_id}
+                )
+            self.fingerprints[item_id] = {
+                'source': source,
+                'output': output,
+                'snapshot_date': snapshot_date,
+                'remote': remote,
+                'published': datetime.datetime.now().isoformat(timespec='seconds'),
+            }
+            self.store_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.store_path.with_suffix('.tmp')
+            temp_path.write_text(json.dumps(self.fingerprints, indent=2))
+            os.replace(temp_path, self.store_path)
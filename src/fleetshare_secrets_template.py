@@ -30,3 +30,40 @@ FEATURES_ITEM_ID = ''
 PROJECT_PATH = ''
 #: path to knownhosts file for sftp connection
 KNOWNHOSTS = ''
+#: Field in the vehicle csv that uniquely identifies each vehicle. If set, only
+#: changed vehicles are pushed to the service instead of overwriting it.
+VEHICLE_KEY_FIELD = ''
+#: Times to retry a failed publishing step (optional, defaults to 3)
+PUBLISH_RETRIES = 3
+#: Seconds to wait before a retry, multiplied by the retry number squared
+#: (optional, defaults to 1), and the most to ever wait (optional, defaults to 300)
+PUBLISH_BACKOFF_SECONDS = 1
+PUBLISH_MAX_BACKOFF_SECONDS = 300
+#: Minutes to reuse an AGOL login before logging in again (optional, defaults to 55)
+SESSION_MAX_MINUTES = 55
+#: Rows of the vehicle csv to convert to points at a time (optional, defaults to 50000)
+CSV_CHUNK_SIZE = 50000
+#: (xmin, ymin, xmax, ymax) in WGS84; vehicles outside are rejected (optional,
+#: defaults to None for just the WGS84 range check)
+VEHICLE_BOUNDS = None
+#: {column: 'SHORT' | 'LONG' | 'DOUBLE' | 'TEXT' | ('TEXT', length)} to set the
+#: vehicle csv's field types instead of inferring them (optional, but
+#: STREAM_CSV needs it for every column besides LATITUDE and LONGITUDE)
+VEHICLE_CSV_FIELDS = None
+#: Directory for the Parquet history of every ingested vehicle csv (optional,
+#: leave blank to not keep a history)
+VEHICLE_HISTORY_DIR = ''
+#: Watch mode (update_agol_vehicles_pallet.py --watch): seconds between polls
+#: of the upload folder, the fraction to randomly spread each wait by, and the
+#: longest wait after failed polls (optional, default to 60, 0.2, and 900)
+WATCH_INTERVAL_SECONDS = 60
+WATCH_JITTER = 0.2
+WATCH_MAX_BACKOFF_SECONDS = 900
+#: Polls in a row a new csv's size must stay the same before it's published
+#: (optional, defaults to 2)
+WATCH_STABLE_POLLS = 2
+#: Convert the latest csv straight from SFTP instead of downloading it first
+#: (optional, defaults to False). Ignored if VEHICLE_KEY_FIELD or
+#: VEHICLE_HISTORY_DIR is set, since those need a local copy, or if
+#: VEHICLE_CSV_FIELDS isn't set.
+STREAM_CSV = False
@@ -0,0 +1,144 @@
+'''On-disk cache of geocoding results so unchanged addresses don't go back through the locator every run.
+
+Results are keyed on the geocoder that made them (see geocoders.Geocoder.cache_id) and a normalized address + zip, and
+stored in SQLite with their match status, coordinates, the wkid of the coordinates, and when they were geocoded. A
+different or rebuilt locator starts with an empty cache rather than mixing its coordinates with the old one's. Entries
+older than max_age_days are treated as misses (and can be evicted) so stale matches eventually get refreshed.
+'''
+
+import hashlib
+import sqlite3
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def normalize_address_keys(addresses, zips):
+    '''Build cache keys from address and zip series: upper-cased, punctuation stripped, whitespace collapsed, 5-digit
+    zip
+
+    Args:
+        addresses (Series): Street addresses
+        zips (Series): Zip codes (zip+4 is trimmed)
+
+    Returns:
+        Series: 'ADDRESS|ZIP' keys
+    '''
+
+    clean_addresses = (
+        addresses.fillna('').astype(str).str.upper().str.replace(r'[.,#]', ' ', regex=True)
+        .str.replace(r'\s+', ' ', regex=True).str.strip()
+    )
+    clean_zips = zips.fillna('').astype(str).str.strip().str.slice(stop=5)
+    return clean_addresses + '|' + clean_zips
+
+
+def source_prefix(source):
+    '''Short prefix that scopes cache keys to one geocoder (its cache_id)
+    '''
+
+    return hashlib.sha1(str(source).encode()).hexdigest()[:12] + '|'
+
+
+class GeocodeCache:
+    '''SQLite-backed geocode results cache.
+
+    Args:
+        db_path (Path): SQLite database file; created if it doesn't exist
+        max_age_days (float, optional): Entries geocoded longer ago than this are ignored. Defaults to None (never
+            stale).
+    '''
+
+    def __init__(self, db_path, max_age_days=None):
+        self.db_path = db_path
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS geocodes '
+                '(key TEXT PRIMARY KEY, status TEXT, x REAL, y REAL, wkid INTEGER, geocoded_at REAL)'
+            )
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(str(self.db_path))
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _oldest_valid(self):
+        if self.max_age_days is None:
+            return 0
+        return time.time() - self.max_age_days * SECONDS_PER_DAY
+
+    def lookup(self, keys, source=''):
+        '''Get the cached results for keys, updating the hit/miss counts.
+
+        Args:
+            keys (iterable): Normalized cache keys
+            source (str, optional): cache_id of the geocoder; only its results are returned. Defaults to ''.
+
+        Returns:
+            DataFrame: key, status, x, y, and wkid columns for every fresh cached key
+        '''
+
+        prefix = source_prefix(source)
+        unique_keys = pd.unique(pd.Series(list(keys), dtype=object))
+        with self._connect() as connection:
+            connection.execute('CREATE TEMP TABLE wanted (key TEXT PRIMARY KEY)')
+            connection.executemany('INSERT INTO wanted VALUES (?)', ((prefix + key, ) for key in unique_keys))
+            cached = pd.read_sql_query(
+                'SELECT g.key, g.status, g.x, g.y, g.wkid FROM geocodes g JOIN wanted w ON g.key = w.key '
+                'WHERE g.geocoded_at >= ?',
+                connection,
+                params=(self._oldest_valid(), )
+            )
+        cached['key'] = cached['key'].str.slice(len(prefix))
+
+        self.hits += len(cached)
+        self.misses += len(unique_keys) - len(cached)
+        return cached
+
+    def store(self, results, wkid, source=''):
+        '''Add or refresh results in the cache.
+
+        Args:
+            results (DataFrame): key, status, x, and y columns
+            wkid (int): Spatial reference wkid of x and y
+            source (str, optional): cache_id of the geocoder that made them. Defaults to ''.
+        '''
+
+        prefix = source_prefix(source)
+        now = time.time()
+        rows = (
+            (prefix + key, status, None if pd.isnull(x) else float(x), None if pd.isnull(y) else float(y), wkid, now)
+            for key, status, x, y in results[['key', 'status', 'x', 'y']].itertuples(index=False)
+        )
+        with self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def evict_stale(self):
+        '''Delete entries older than max_age_days.
+
+        Returns:
+            int: Number of entries deleted
+        '''
+
+        with self._connect() as connection:
+            deleted = connection.execute('DELETE FROM geocodes WHERE geocoded_at < ?', (self._oldest_valid(), ))
+            return deleted.rowcount
+
+    def stats(self):
+        '''Summary of this run's cache lookups.
+        '''
+
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else np.nan
+        return f'Geocode cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate)'
@@ -0,0 +1,249 @@
+'''Geocoder backends and sharded, parallel geocoding.
+
+A geocoder takes a DataFrame of addresses (with a cache_key column identifying each unique address) and returns a
+DataFrame of key, status, x, and y plus the wkid of the coordinates. LocatorGeocoder wraps an ArcGIS locator;
+StubGeocoder is a deterministic stand-in for tests and benchmarks that doesn't need arcpy.
+
+geocode_in_shards splits the addresses into shards, geocodes them in a process pool, and saves each finished shard so a
+failed shard can be retried (in the same run or the next one) without redoing the others.
+'''
+
+import hashlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from time import perf_counter, sleep
+
+import numpy as np
+import pandas as pd
+
+from checkpoints import stat_fingerprint
+
+RESULT_COLUMNS = ['key', 'status', 'x', 'y']
+
+
+class Geocoder:
+    '''Interface for geocoder backends. Instances must be picklable so they can be sent to worker processes.
+    '''
+
+    @property
+    def cache_id(self):
+        '''Identifies the geocoder and the data behind it, so cached and saved results from a different locator (which
+        may also be in a different spatial reference) aren't mixed with this one's
+        '''
+
+        return type(self).__name__
+
+    def geocode(self, addresses_df, addr_field, zip_field):
+        '''Geocode addresses_df.
+
+        Args:
+            addresses_df (DataFrame): Addresses to geocode, with a unique cache_key column
+            addr_field (str): The address field in addresses_df
+            zip_field (str): The zip code field in addresses_df
+
+        Returns:
+            (DataFrame, int): key, status ('M' for matched), x, and y for every row, and the wkid of x/y
+        '''
+
+        raise NotImplementedError
+
+
+class LocatorGeocoder(Geocoder):
+    '''Geocode with arcpy.geocoding.GeocodeAddresses against an ArcGIS locator.
+
+    Args:
+        locator_path (str): The full path to the locator to use
+        scratch_dir (Path): Directory for the per-shard input csvs
+    '''
+
+    def __init__(self, locator_path, scratch_dir):
+        self.locator_path = str(locator_path)
+        self.scratch_dir = Path(scratch_dir)
+
+    @property
+    def cache_id(self):
+        #: A rebuilt locator gets a new size and modification time
+        return f'{type(self).__name__}|{stat_fingerprint(self.locator_path)}'
+
+    @staticmethod
+    def field_map(addr_field, zip_field):
+        '''Build the GeocodeAddresses field map string for our address and zip fields
+        '''
+
+        return f"'Address or Place' {addr_field} VISIBLE NONE;Address2 <None> VISIBLE NONE;Address3 <None> VISIBLE NONE;Neighborhood <None> VISIBLE NONE;City <None> VISIBLE NONE;County <None> VISIBLE NONE;State <None> VISIBLE NONE;ZIP {zip_field} VISIBLE NONE;ZIP4 <None> VISIBLE NONE;Country <None> VISIBLE NONE"
+
+    def geocode(self, addresses_df, addr_field, zip_field):
+        import arcpy  #: pylint: disable=import-outside-toplevel
+
+        #: Unique per shard so concurrent workers don't collide
+        name = hashlib.sha1(''.join(addresses_df['cache_key']).encode()).hexdigest()[:12]
+        input_csv = self.scratch_dir / f'geocode_input_{name}.csv'
+        addresses_df[['cache_key', addr_field, zip_field]].to_csv(input_csv, index=False)
+
+        #: using 'memory' seems to limit the geocode to 1000, use 'in_memory' instead.
+        geocode_fc = fr'in_memory\geocode_{name}'
+        if arcpy.Exists(geocode_fc):
+            arcpy.management.Delete(geocode_fc)
+
+        try:
+            arcpy.geocoding.GeocodeAddresses(
+                str(input_csv), self.locator_path, self.field_map(addr_field, zip_field), geocode_fc
+            )
+            wkid = arcpy.Describe(geocode_fc).spatialReference.factoryCode
+            with arcpy.da.SearchCursor(geocode_fc, ['USER_cache_key', 'Status', 'SHAPE@X', 'SHAPE@Y']) as cursor:
+                results_df = pd.DataFrame(list(cursor), columns=RESULT_COLUMNS)
+        finally:
+            arcpy.management.Delete(geocode_fc)
+            input_csv.unlink()
+
+        return results_df, wkid
+
+
+class StubGeocoder(Geocoder):
+    '''Deterministic geocoder for tests and benchmarks. The same key always gets the same status and coordinates.
+
+    Args:
+        match_rate (float, optional): Fraction of addresses that match. Defaults to 0.95.
+        extent (tuple, optional): (xmin, ymin, xmax, ymax) to place matches in. Defaults to roughly Utah in UTM 12N.
+        wkid (int, optional): wkid to report for the coordinates. Defaults to 26912 (NAD83 UTM 12N).
+        seconds_per_address (float, optional): Simulated locator latency. Defaults to 0.
+    '''
+
+    def __init__(self, match_rate=0.95, extent=(228000, 4094000, 673000, 4653000), wkid=26912, seconds_per_address=0):
+        self.match_rate = match_rate
+        self.extent = extent
+        self.wkid = wkid
+        self.seconds_per_address = seconds_per_address
+
+    @property
+    def cache_id(self):
+        return f'{type(self).__name__}|{self.match_rate}|{self.extent}|{self.wkid}'
+
+    def geocode(self, addresses_df, addr_field, zip_field):
+        keys = addresses_df['cache_key'].astype(str)
+        hashes = np.array([int(hashlib.md5(key.encode()).hexdigest()[:12], 16) for key in keys], dtype=np.float64)
+        scaled = hashes / 16**12
+        matched = scaled < self.match_rate
+
+        xmin, ymin, xmax, ymax = self.extent
+        x = xmin + (scaled * 7919 % 1) * (xmax - xmin)
+        y = ymin + (scaled * 104729 % 1) * (ymax - ymin)
+
+        if self.seconds_per_address:
+            sleep(self.seconds_per_address * len(keys))
+
+        results_df = pd.DataFrame({
+            'key': keys.to_numpy(),
+            'status': np.where(matched, 'M', 'U'),
+            'x': np.where(matched, x, np.nan),
+            'y': np.where(matched, y, np.nan),
+        })
+        return results_df, self.wkid
+
+
+def _geocode_shard(geocoder, shard_df, addr_field, zip_field, result_path):
+    '''Worker: geocode one shard and save its results. Returns (rows, matched, wkid, seconds, error traceback or None).
+    '''
+
+    start = perf_counter()
+    try:
+        results_df, wkid = geocoder.geocode(shard_df, addr_field, zip_field)
+        pd.to_pickle((results_df, wkid), result_path)
+    except Exception:
+        return len(shard_df), 0, None, perf_counter() - start, traceback.format_exc()
+    return len(shard_df), int((results_df['status'] == 'M').sum()), wkid, perf_counter() - start, None
+
+
+def geocode_in_shards(
+    addresses_df, geocoder, shard_dir, addr_field, zip_field, shard_size=1000, max_workers=4, retries=1
+):
+    '''Geocode addresses_df in shards of shard_size rows across a process pool.
+
+    Each finished shard is saved in shard_dir under a hash of its keys and the geocoder's cache_id. Shards that already
+    have results there (ie, from a run that failed part way) are not geocoded again, and failed shards are retried up to
+    retries times.
+
+    Args:
+        addresses_df (DataFrame): Addresses to geocode, with a unique cache_key column
+        geocoder (Geocoder): Backend to geocode with
+        shard_dir (Path): Directory to save per-shard results in
+        addr_field (str): The address field in addresses_df
+        zip_field (str): The zip code field in addresses_df
+        shard_size (int, optional): Maximum addresses per shard. Defaults to 1000.
+        max_workers (int, optional): Number of worker processes. Defaults to 4.
+        retries (int, optional): Number of times to retry failed shards. Defaults to 1.
+
+    Raises:
+        RuntimeError: If any shards still fail after retrying. Their results are missing, but the successful shards'
+            results are kept in shard_dir for the next attempt.
+        ValueError: If the shards' coordinates came back in different spatial references
+
+    Returns:
+        (DataFrame, int): key, status, x, and y for every address, and the wkid of x/y
+    '''
+
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+
+    shards = {}
+    for start in range(0, len(addresses_df), shard_size):
+        shard_df = addresses_df.iloc[start:start + shard_size]
+        shard_hash = hashlib.sha1('\n'.join([geocoder.cache_id, *shard_df['cache_key']]).encode()).hexdigest()[:16]
+        shards[shard_dir / f'shard_{shard_hash}.pkl'] = shard_df
+
+    pending = {path: shard_df for path, shard_df in shards.items() if not path.exists()}
+    print(
+        f'Geocoding {len(addresses_df)} addresses in {len(shards)} shards ({len(shards) - len(pending)} already done)'
+    )
+
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        if attempt:
+            print(f'Retrying {len(pending)} failed shards (retry {attempt} of {retries})...')
+
+        failed = {}
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(_geocode_shard, geocoder, shard_df, addr_field, zip_field, path): path
+                for path, shard_df in pending.items()
+            }
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    rows, matched, _, seconds, error = future.result()
+                except Exception:
+                    rows, matched, seconds, error = len(pending[path]), 0, 0, traceback.format_exc()
+                if error:
+                    print(f'    {path.stem}: FAILED after {seconds:.1f}s\n{error}')
+                    failed[path] = pending[path]
+                    continue
+                rate = rows / max(seconds, 1e-6)
+                print(f'    {path.stem}: {rows} addresses, {matched} matched in {seconds:.1f}s ({rate:.0f}/s)')
+        pending = failed
+
+    if pending:
+        raise RuntimeError(
+            f'{len(pending)} of {len(shards)} geocoding shards failed; rerun to retry just those shards '
+            f'(finished shards are saved in {shard_dir})'
+        )
+
+    shard_results = [pd.read_pickle(path) for path in shards]
+    if not shard_results:
+        return pd.DataFrame(columns=RESULT_COLUMNS), None
+    wkids = {wkid for _, wkid in shard_results}
+    if len(wkids) > 1:
+        raise ValueError(f'Geocoding shards in {shard_dir} have different spatial references: {sorted(wkids)}')
+    results_df = pd.concat([shard_df for shard_df, _ in shard_results], ignore_index=True)
+    wkid = wkids.pop()
+
+    return results_df, wkid
+
+
+def clear_shards(shard_dir):
+    '''Remove saved shard results once they've been merged.
+    '''
+
+    for path in Path(shard_dir).glob('shard_*.pkl'):
+        path.unlink()
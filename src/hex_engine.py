@@ -0,0 +1,412 @@
+'''Closed-form hex binning with NumPy.
+
+Assigns points to the cells of a regular hexagon grid with axial/cube coordinate math instead of a polygon overlay, and
+counts points (optionally per group) for every occupied cell in one vectorized pass. HexIndex keeps a hex feature
+class's ids, centers, and bounds in memory-mapped arrays so later runs look points up without reading the polygons.
+Nothing here depends on arcpy; the arcpy glue lives in update_hexes.hex_bin.
+'''
+
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+SQRT3 = np.sqrt(3)
+
+#: Axial coordinates are packed into a single int64 key for grouping; this comfortably covers any state-sized grid
+KEY_OFFSET = 2**20
+KEY_MULTIPLIER = 2**21
+
+#: Files making up a saved HexIndex; the metadata is written last, so an interrupted save is never loaded
+HEX_INDEX_CELLS = 'cells.npy'
+HEX_INDEX_LOOKUP = 'lookup.npy'
+HEX_INDEX_METADATA = 'grid.json'
+HEX_INDEX_VERSION = 1
+CELL_DTYPE = np.dtype([
+    ('hex_id', np.int64),
+    ('key', np.int64),
+    ('center_x', np.float64),
+    ('center_y', np.float64),
+    ('xmin', np.float64),
+    ('ymin', np.float64),
+    ('xmax', np.float64),
+    ('ymax', np.float64),
+])
+
+
+@dataclass
+class HexGrid:
+    '''Geometry of a regular hexagon grid.
+
+    Attributes:
+        origin_x (float): X of the center of the cell at axial (0, 0)
+        origin_y (float): Y of the center of the cell at axial (0, 0)
+        size (float): Circumradius (center to vertex distance) of each cell
+        flat_top (bool): True if cells have flat tops (vertices to the left and right), False for pointy tops
+    '''
+    origin_x: float
+    origin_y: float
+    size: float
+    flat_top: bool = True
+
+    @classmethod
+    def from_polygons(cls, centers_x, centers_y, extent_widths, extent_heights, tolerance=0.01):
+        '''Infer the grid from the centers and extents of an existing set of hexagon polygons.
+
+        Args:
+            centers_x, centers_y (array-like): Polygon centroids
+            extent_widths, extent_heights (array-like): Polygon extent widths and heights
+            tolerance (float, optional): Maximum allowed distance from integer axial coordinates, in cell units.
+                Defaults to 0.01.
+
+        Raises:
+            ValueError: If the polygons aren't a regular hexagon grid
+
+        Returns:
+            HexGrid: The grid the polygons belong to
+        '''
+
+        width = float(np.median(extent_widths))
+        height = float(np.median(extent_heights))
+
+        #: A flat-topped hexagon is 2R wide and sqrt(3)R tall; a pointy-topped one is the other way around
+        flat_top = width > height
+        size = width / 2 if flat_top else height / 2
+        grid = cls(float(centers_x[0]), float(centers_y[0]), size, flat_top)
+
+        fractional_q, fractional_r = grid.fractional_axial(np.asarray(centers_x), np.asarray(centers_y))
+        drift = np.maximum(np.abs(fractional_q - np.round(fractional_q)), np.abs(fractional_r - np.round(fractional_r)))
+        if drift.max() > tolerance:
+            raise ValueError(f'Polygons are not a regular hexagon grid (max drift {drift.max():.3f} cells)')
+
+        return grid
+
+    def fractional_axial(self, x, y):
+        '''Convert map coordinates to fractional axial (q, r) coordinates.
+        '''
+
+        x = (np.asarray(x, dtype=np.float64) - self.origin_x) / self.size
+        y = (np.asarray(y, dtype=np.float64) - self.origin_y) / self.size
+        if self.flat_top:
+            q = 2 / 3 * x
+            r = -1 / 3 * x + SQRT3 / 3 * y
+        else:
+            q = SQRT3 / 3 * x - 1 / 3 * y
+            r = 2 / 3 * y
+        return q, r
+
+    def axial(self, x, y):
+        '''Get the integer axial (q, r) coordinates of the cells containing each point using cube rounding.
+
+        Args:
+            x, y (array-like): Point coordinates in the grid's spatial reference
+
+        Returns:
+            (np.ndarray, np.ndarray): int64 q and r arrays
+        '''
+
+        q, r = self.fractional_axial(x, y)
+        s = -q - r
+
+        rounded_q = np.round(q)
+        rounded_r = np.round(r)
+        rounded_s = np.round(s)
+
+        #: Fix up whichever component rounded furthest so q + r + s stays 0
+        q_diff = np.abs(rounded_q - q)
+        r_diff = np.abs(rounded_r - r)
+        s_diff = np.abs(rounded_s - s)
+        fix_q = (q_diff > r_diff) & (q_diff > s_diff)
+        fix_r = ~fix_q & (r_diff > s_diff)
+        rounded_q = np.where(fix_q, -rounded_r - rounded_s, rounded_q)
+        rounded_r = np.where(fix_r, -rounded_q - rounded_s, rounded_r)
+
+        return rounded_q.astype(np.int64), rounded_r.astype(np.int64)
+
+    def keys(self, x, y):
+        '''Get a single int64 cell key for each point.
+        '''
+
+        q, r = self.axial(x, y)
+        return pack_key(q, r)
+
+    def centers(self, q, r):
+        '''Convert integer axial coordinates back to cell center map coordinates.
+        '''
+
+        q = np.asarray(q, dtype=np.float64)
+        r = np.asarray(r, dtype=np.float64)
+        if self.flat_top:
+            x = self.size * 1.5 * q
+            y = self.size * SQRT3 * (r + q / 2)
+        else:
+            x = self.size * SQRT3 * (q + r / 2)
+            y = self.size * 1.5 * r
+        return x + self.origin_x, y + self.origin_y
+
+    def vertices(self, q, r):
+        '''Get the corners of cells as map coordinates.
+
+        Args:
+            q, r (array-like): Integer axial coordinates of the cells
+
+        Returns:
+            np.ndarray: (cell, corner, x/y) array with the six corners of each cell in order
+        '''
+
+        center_x, center_y = self.centers(q, r)
+        #: Flat-topped corners start at 0 degrees, pointy-topped ones at 30
+        angles = np.radians(np.arange(6) * 60 + (0 if self.flat_top else 30))
+        corner_x = np.asarray(center_x)[..., np.newaxis] + self.size * np.cos(angles)
+        corner_y = np.asarray(center_y)[..., np.newaxis] + self.size * np.sin(angles)
+        return np.stack([corner_x, corner_y], axis=-1)
+
+    def scaled(self, factor):
+        '''Get a coarser (or finer) grid with the same origin and orientation and factor times the cell size.
+        '''
+
+        return HexGrid(self.origin_x, self.origin_y, self.size * factor, self.flat_top)
+
+
+def pack_key(q, r):
+    '''Pack axial coordinates into int64 keys.
+    '''
+
+    return (np.asarray(q, dtype=np.int64) + KEY_OFFSET) * KEY_MULTIPLIER + (np.asarray(r, dtype=np.int64) + KEY_OFFSET)
+
+
+def unpack_key(keys):
+    '''Unpack int64 keys into axial (q, r) coordinates.
+    '''
+
+    keys = np.asarray(keys, dtype=np.int64)
+    return keys // KEY_MULTIPLIER - KEY_OFFSET, keys % KEY_MULTIPLIER - KEY_OFFSET
+
+
+def bin_points(grid, x, y, groups=None):
+    '''Count points per hex cell, and per group within each cell if groups are given.
+
+    Args:
+        grid (HexGrid): The hex grid to bin into
+        x, y (array-like): Point coordinates in the grid's spatial reference
+        groups (array-like, optional): Group label for each point (ie, department). Defaults to None.
+
+    Returns:
+        DataFrame: Indexed by cell key, with a Point_Count column followed by one count column per group (in sorted
+            group order) if groups were given. Only occupied cells are included.
+    '''
+
+    cell_keys = grid.keys(x, y)
+    unique_keys, cell_index = np.unique(cell_keys, return_inverse=True)
+    return count_cells(cell_index.ravel(), unique_keys, groups, 'cell_key')
+
+
+def count_cells(cell_index, cell_ids, groups=None, index_name='cell_key'):
+    '''Count points per cell (and per group within each cell) from each point's position in cell_ids.
+
+    Args:
+        cell_index (np.ndarray): Index into cell_ids of each point's cell
+        cell_ids (array-like): Id of each cell, used as the output's index
+        groups (array-like, optional): Group label for each point. Defaults to None.
+        index_name (str, optional): Name for the output's index. Defaults to 'cell_key'.
+
+    Returns:
+        DataFrame: Point_Count and per group count columns (see bin_points) for every cell in cell_ids
+    '''
+
+    counts = pd.DataFrame({'Point_Count': np.bincount(cell_index, minlength=len(cell_ids))}, index=cell_ids)
+    counts.index.name = index_name
+
+    if groups is None:
+        return counts
+
+    group_index, group_names = pd.factorize(np.asarray(groups), sort=True)
+    #: Flattened cell x group histogram in a single bincount
+    group_counts = np.bincount(
+        cell_index * len(group_names) + group_index, minlength=len(cell_ids) * len(group_names)
+    ).reshape(len(cell_ids), len(group_names))
+
+    return counts.join(pd.DataFrame(group_counts, index=cell_ids, columns=list(group_names)))
+
+
+def rollup_counts(fine_grid, fine_counts, coarse_grid):
+    '''Roll cell counts up into a coarser grid by adding each fine cell's counts to the coarse cell holding its center.
+
+    Args:
+        fine_grid (HexGrid): The grid fine_counts were binned into
+        fine_counts (DataFrame): Counts indexed by fine cell key (ie, from bin_points)
+        coarse_grid (HexGrid): The grid to roll up into
+
+    Returns:
+        DataFrame: The same columns summed per coarse cell, indexed by coarse cell key
+    '''
+
+    center_x, center_y = fine_grid.centers(*unpack_key(fine_counts.index.to_numpy()))
+    coarse_counts = fine_counts.groupby(coarse_grid.keys(center_x, center_y)).sum()
+    coarse_counts.index.name = 'cell_key'
+    return coarse_counts
+
+
+def rollup_levels(grid, counts, factors):
+    '''Roll cell counts up to several coarser resolutions, each level straight from grid's counts.
+
+    Rolling a level up from the next coarser one would compound the center-in-hex approximation of rollup_counts at
+    every level, so a coarse hex could pick up (or lose) whole medium hexes that straddle its edge.
+
+    Args:
+        grid (HexGrid): The finest grid, the one counts were binned into
+        counts (DataFrame): Counts indexed by cell key in grid
+        factors (list): Cell size of each level as a multiple of grid's
+
+    Returns:
+        dict: {factor: (HexGrid, DataFrame of counts indexed by cell key)} for each factor
+    '''
+
+    levels = {}
+    for factor in sorted(factors):
+        coarse_grid = grid.scaled(factor)
+        levels[factor] = (coarse_grid, rollup_counts(grid, counts, coarse_grid))
+    return levels
+
+
+class HexIndex:
+    '''Array-backed lookup from points to the hexes of a hex feature class, built once and memory-mapped afterwards.
+
+    Attributes:
+        grid (HexGrid): The grid the hexes belong to
+        cells (np.ndarray): One CELL_DTYPE record (hex id, cell key, center, and bounds) per hex
+        lookup (np.ndarray): 2D int32 array of the row in cells for each axial (q - q_min, r - r_min), -1 for no hex
+        q_min, r_min (int): Axial coordinates of lookup[0, 0]
+        source (str): Fingerprint of the hexes the index was built from, for telling when it's stale
+    '''
+
+    def __init__(self, grid, cells, lookup, q_min, r_min, source=None):
+        self.grid = grid
+        self.cells = cells
+        self.lookup = lookup
+        self.q_min = q_min
+        self.r_min = r_min
+        self.source = source
+
+    @classmethod
+    def build(cls, hex_ids, centers_x, centers_y, bounds, source=None):
+        '''Index a set of hexagon polygons.
+
+        Args:
+            hex_ids (array-like): Ids (ie, ObjectIDs) of the hex polygons
+            centers_x, centers_y (array-like): Polygon centroids
+            bounds (array-like): (xmin, ymin, xmax, ymax) row for each polygon
+            source (str, optional): Fingerprint of the hexes. Defaults to None.
+
+        Raises:
+            ValueError: If the polygons aren't a regular hexagon grid
+
+        Returns:
+            HexIndex: The index
+        '''
+
+        bounds = np.asarray(bounds, dtype=np.float64)
+        grid = HexGrid.from_polygons(centers_x, centers_y, bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1])
+        q, r = grid.axial(centers_x, centers_y)
+
+        cells = np.empty(len(q), dtype=CELL_DTYPE)
+        cells['hex_id'] = hex_ids
+        cells['key'] = pack_key(q, r)
+        cells['center_x'] = centers_x
+        cells['center_y'] = centers_y
+        for column, name in enumerate(['xmin', 'ymin', 'xmax', 'ymax']):
+            cells[name] = bounds[:, column]
+
+        q_min, r_min = int(q.min()), int(r.min())
+        lookup = np.full((int(q.max()) - q_min + 1, int(r.max()) - r_min + 1), -1, dtype=np.int32)
+        lookup[q - q_min, r - r_min] = np.arange(len(cells), dtype=np.int32)
+
+        return cls(grid, cells, lookup, q_min, r_min, source)
+
+    def save(self, index_dir):
+        '''Write the index's arrays and metadata to index_dir.
+        '''
+
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        (index_dir / HEX_INDEX_METADATA).unlink(missing_ok=True)
+        for name, array in [(HEX_INDEX_CELLS, self.cells), (HEX_INDEX_LOOKUP, self.lookup)]:
+            #: np.save adds .npy to names without it
+            temp_path = index_dir / f'{name}.tmp.npy'
+            np.save(temp_path, array)
+            os.replace(temp_path, index_dir / name)
+
+        metadata = {
+            'version': HEX_INDEX_VERSION,
+            'origin_x': self.grid.origin_x,
+            'origin_y': self.grid.origin_y,
+            'size': self.grid.size,
+            'flat_top': self.grid.flat_top,
+            'q_min': self.q_min,
+            'r_min': self.r_min,
+            'source': self.source,
+        }
+        (index_dir / HEX_INDEX_METADATA).write_text(json.dumps(metadata, indent=2))
+
+    @classmethod
+    def load(cls, index_dir):
+        '''Memory-map a saved index.
+
+        Args:
+            index_dir (Path): Directory the index was saved to
+
+        Returns:
+            HexIndex: The index, or None if there isn't a complete one of the current version in index_dir
+        '''
+
+        index_dir = Path(index_dir)
+        try:
+            metadata = json.loads((index_dir / HEX_INDEX_METADATA).read_text())
+            if metadata.get('version') != HEX_INDEX_VERSION:
+                return None
+            cells = np.load(index_dir / HEX_INDEX_CELLS, mmap_mode='r')
+            lookup = np.load(index_dir / HEX_INDEX_LOOKUP, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+
+        grid = HexGrid(metadata['origin_x'], metadata['origin_y'], metadata['size'], metadata['flat_top'])
+        return cls(grid, cells, lookup, metadata['q_min'], metadata['r_min'], metadata['source'])
+
+    def rows(self, x, y):
+        '''Get the row in cells of the hex containing each point with constant time arithmetic and an array lookup.
+
+        Args:
+            x, y (array-like): Point coordinates in the grid's spatial reference
+
+        Returns:
+            np.ndarray: Row for each point, -1 for points outside every hex
+        '''
+
+        q, r = self.grid.axial(x, y)
+        q = q - self.q_min
+        r = r - self.r_min
+        inside = (q >= 0) & (q < self.lookup.shape[0]) & (r >= 0) & (r < self.lookup.shape[1])
+        rows = np.full(len(q), -1, dtype=np.int64)
+        rows[inside] = self.lookup[q[inside], r[inside]]
+        return rows
+
+    def bin_points(self, x, y, groups=None):
+        '''Count points per hex, and per group within each hex if groups are given.
+
+        Args:
+            x, y (array-like): Point coordinates in the grid's spatial reference
+            groups (array-like, optional): Group label for each point (ie, department). Defaults to None.
+
+        Returns:
+            DataFrame: Indexed by hex id with the same columns as bin_points. Only hexes with points are included;
+                points outside every hex are dropped.
+        '''
+
+        rows = self.rows(x, y)
+        inside = rows >= 0
+        occupied_rows, cell_index = np.unique(rows[inside], return_inverse=True)
+        groups = None if groups is None else np.asarray(groups)[inside]
+        return count_cells(cell_index.ravel(), np.asarray(self.cells['hex_id'][occupied_rows]), groups, 'hex_id')
@@ -0,0 +1,178 @@
+'''
+instrumentation.py:
+Per-stage timing and memory instrumentation. Each named stage records wall
+time, CPU time, the change in RSS, the process's peak RSS, and (optionally) a
+row count, and is emitted as a single JSON line through whatever callable the
+caller provides (print, a logger's info, etc).
+
+CPU time is the stage's own thread's (stages running at the same time on other
+threads aren't counted). Memory is shared by every thread, so rss_delta_mb
+(resident set size at the end minus at the start) includes anything other
+threads allocated meanwhile, and proc_peak_rss_mb is the process's peak so far,
+not the stage's: a stage after the biggest one reports the same peak.
+
+Profiling is opt-in: set the FLEETSHARE_PROFILE_STAGE environment variable to
+a stage name (or 'all') to dump a cProfile .prof file and the top tracemalloc
+allocations for that stage into FLEETSHARE_PROFILE_DIR (the current directory
+by default). Only one stage is profiled at a time, so a stage nested in one
+being profiled is covered by the outer stage's profile.
+'''
+
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROFILE_STAGE_VARIABLE = 'FLEETSHARE_PROFILE_STAGE'
+PROFILE_DIR_VARIABLE = 'FLEETSHARE_PROFILE_DIR'
+
+
+def current_rss_mb():
+    '''
+    Returns the process's current resident set size in MB, or None if it
+    can't be determined on this platform.
+    '''
+
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    try:
+        #: The second field of statm is resident pages
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb():
+    '''
+    Returns the process's peak resident set size so far in MB, or None if it
+    can't be determined on this platform.
+    '''
+
+    if resource is not None:
+        #: ru_maxrss is KB on Linux, bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss / 2**20 if os.uname().sysname == 'Darwin' else max_rss / 2**10
+    if psutil is not None:
+        #: peak_wset is Windows' peak working set (resource isn't available there)
+        peak = getattr(psutil.Process().memory_info(), 'peak_wset', None)
+        return peak / 2**20 if peak is not None else None
+    return None
+
+
+class StageRecorder:
+    '''
+    Records metrics for named stages of a pipeline.
+
+    emit:           Callable that takes each stage's JSON string (ie, print or
+                    self.log.info)
+    profile_stage:  Stage name to profile, or 'all'. Defaults to the
+                    FLEETSHARE_PROFILE_STAGE environment variable.
+    profile_dir:    Where to write profiles. Defaults to the
+                    FLEETSHARE_PROFILE_DIR environment variable or the current
+                    directory.
+    '''
+
+    def __init__(self, emit=print, profile_stage=None, profile_dir=None):
+        self.emit = emit
+        self.profile_stage = profile_stage or os.environ.get(PROFILE_STAGE_VARIABLE)
+        self.profile_dir = Path(profile_dir or os.environ.get(PROFILE_DIR_VARIABLE, '.'))
+        self.records = []
+        #: Number of open stages that matched profile_stage; only the outermost one is profiled
+        self.profile_depth = 0
+
+    def should_profile(self, name):
+        return self.profile_stage in [name, 'all']
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        '''
+        Context manager that records the metrics for the code it wraps. Yields
+        the stage's record dict; set record['rows'] inside the block if the
+        row count isn't known up front.
+        '''
+
+        record = {'stage': name, 'rows': rows}
+        matched = self.should_profile(name)
+        profiling = matched and self.profile_depth == 0
+        if matched:
+            self.profile_depth += 1
+        if profiling:
+            profiler = cProfile.Profile()
+            #: Leave tracing alone if something else already started it
+            owns_tracing = not tracemalloc.is_tracing()
+            if owns_tracing:
+                tracemalloc.start()
+            profiler.enable()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        rss_start = current_rss_mb()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            record['wall_s'] = round(time.perf_counter() - wall_start, 3)
+            record['cpu_s'] = round(time.thread_time() - cpu_start, 3)
+            rss_end = current_rss_mb()
+            record['rss_delta_mb'] = round(rss_end - rss_start, 1) if None not in [rss_start, rss_end] else None
+            peak = peak_rss_mb()
+            record['proc_peak_rss_mb'] = round(peak, 1) if peak is not None else None
+
+            if matched:
+                self.profile_depth -= 1
+            if profiling:
+                profiler.disable()
+                record.update(self._dump_profile(name, profiler, owns_tracing))
+
+            self.records.append(record)
+            self.emit(json.dumps(record))
+
+    def _dump_profile(self, name, profiler, owns_tracing):
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        safe_name = ''.join(char if char.isalnum() else '_' for char in name)
+
+        profile_path = self.profile_dir / f'{safe_name}.prof'
+        profiler.dump_stats(str(profile_path))
+        dumped = {'profile': str(profile_path)}
+
+        if tracemalloc.is_tracing():
+            _, traced_peak = tracemalloc.get_traced_memory()
+            top_allocations = tracemalloc.take_snapshot().statistics('lineno')[:25]
+            if owns_tracing:
+                tracemalloc.stop()
+            allocations_path = self.profile_dir / f'{safe_name}.tracemalloc.txt'
+            allocations_path.write_text('\n'.join(str(statistic) for statistic in top_allocations))
+            dumped.update({'allocations': str(allocations_path), 'traced_peak_mb': round(traced_peak / 2**20, 1)})
+
+        return dumped
+
+    def summary(self):
+        '''
+        Returns a plain-text table of every recorded stage. The cpu s column is
+        each stage's thread CPU time, and proc peak MB is the process's peak
+        RSS when the stage finished (see the module docstring).
+        '''
+
+        columns = ['wall_s', 'cpu_s', 'rss_delta_mb', 'proc_peak_rss_mb', 'rows']
+        lines = [f'{"stage":<32}{"wall s":>10}{"cpu s":>10}{"RSS +MB":>10}{"proc peak MB":>14}{"rows":>10}']
+        for record in self.records:
+            wall, cpu, delta, peak, rows = ['' if record[column] is None else record[column] for column in columns]
+            lines.append(f'{record["stage"]:<32}{wall:>10}{cpu:>10}{delta:>10}{peak:>14}{rows:>10}')
+        return '\n'.join(lines)
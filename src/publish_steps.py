@@ -0,0 +1,119 @@
+'''
+publish_steps.py:
+Runs a sequence of named publishing steps, retrying from the step that failed
+instead of from the top. State the steps build up (the AGOL session, the
+staged service definition, etc) is kept in a shared dict between attempts so a
+retry only redoes what didn't finish.
+'''
+
+import logging
+import time
+
+#: Fragments of the errors AGOL returns for expired or invalid tokens
+SESSION_ERROR_MARKERS = ['Invalid token', 'Token Required', 'Error Code: 498', 'Error Code: 499']
+
+
+def is_session_error(error):
+    '''
+    Returns True if error looks like the AGOL session or token expired, in
+    which case retrying the failed step won't help until we log in again.
+    '''
+
+    message = str(error)
+    return any(marker in message for marker in SESSION_ERROR_MARKERS)
+
+
+def backoff_delay(retry, backoff_seconds, max_backoff_seconds):
+    '''
+    Seconds to wait before the retry'th retry (1-based): backoff_seconds
+    times the retry number squared, capped at max_backoff_seconds.
+    '''
+
+    return min(backoff_seconds * retry**2, max_backoff_seconds)
+
+
+class StepRunner:
+    '''
+    Runs steps in order, resuming at the failed step on each retry.
+
+    retries:                Number of times to retry after the first attempt
+                            fails
+    backoff_seconds:        Base wait between attempts; see backoff_delay
+    max_backoff_seconds:    Longest wait between attempts
+    session_steps:          Names of the steps that set up the AGOL/Portal
+                            session. If a later step fails with a session
+                            error, the retry redoes these and then picks up
+                            at the failed step again.
+    log:                    Logger for progress and errors
+    recorder:               Optional instrumentation.StageRecorder; each step
+                            run is recorded as a stage
+    '''
+
+    def __init__(
+        self,
+        retries=3,
+        backoff_seconds=1,
+        max_backoff_seconds=300,
+        session_steps=None,
+        log=None,
+        recorder=None,
+    ):
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.session_steps = session_steps or []
+        self.log = log or logging.getLogger(__name__)
+        self.recorder = recorder
+        self.sleep = time.sleep
+
+    def _run_step(self, name, step):
+        if self.recorder is None:
+            step()
+            return
+        with self.recorder.stage(name):
+            step()
+
+    def run(self, steps):
+        '''
+        Run steps, a list of (name, callable) tuples, in order. A failed step
+        is retried (after a backoff) without rerunning the steps before it;
+        if it was a session error, just the session_steps are rerun first.
+
+        returns: the number of retries it took
+        '''
+
+        names = [name for name, _ in steps]
+        session_names = [name for name in self.session_steps if name in names]
+        position = 0
+        retry = 0
+        #: Where to pick back up once the session steps are redone after a session error
+        resume_position = None
+        while position < len(steps):
+            name, step = steps[position]
+            try:
+                self._run_step(name, step)
+            except Exception as e:
+                if retry >= self.retries:
+                    self.log.exception(f'Step "{name}" failed; giving up after {self.retries} retries')
+                    raise e
+                retry += 1
+
+                restart = name
+                if session_names and is_session_error(e) and name not in session_names:
+                    restart = session_names[0]
+                    resume_position = position
+                position = names.index(restart)
+
+                delay = backoff_delay(retry, self.backoff_seconds, self.max_backoff_seconds)
+                self.log.exception(
+                    f'Step "{name}" failed; retry {retry} of {self.retries} from "{restart}" in {delay} seconds'
+                )
+                self.sleep(delay)
+                continue
+
+            position += 1
+            if resume_position is not None and name == session_names[-1]:
+                position = max(position, resume_position)
+                resume_position = None
+
+        return retry
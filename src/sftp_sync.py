@@ -0,0 +1,313 @@
+'''
+sftp_sync.py:
+Keeps a local copy of the fleet SFTP upload folder current by tracking a
+manifest of the remote files' names, sizes, and modification times so that
+only new or changed files are downloaded. Can also open a remote csv as a
+checksummed stream for reading it without a local copy.
+'''
+
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import shutil
+
+from pathlib import Path
+from types import SimpleNamespace
+
+VEHICLE_CSV_PATTERN = re.compile(r'^vehicle_data_(\d{8})\.csv$')
+MANIFEST_NAME = '.sftp_manifest.json'
+
+
+class NoVehicleCsvs(FileNotFoundError):
+    '''
+    Raised when a remote folder has no dated vehicle csvs to sync or publish.
+    '''
+
+
+def parse_csv_date(filename):
+    '''
+    Returns the datetime.date from a 'vehicle_data_yyyymmdd.csv' file name, or
+    None if the name doesn't match that pattern or holds an invalid date.
+    '''
+
+    match = VEHICLE_CSV_PATTERN.match(filename)
+    if not match:
+        return None
+    date_string = match.group(1)
+    try:
+        return datetime.date(int(date_string[:4]), int(date_string[4:6]), int(date_string[6:]))
+    except ValueError:
+        return None
+
+
+def list_vehicle_csvs(client, remote_dir):
+    '''
+    Returns {filename: {'size': int, 'mtime': int}} for every dated vehicle
+    csv in remote_dir. Only the directory listing is fetched, so this is cheap
+    enough to poll.
+
+    client:     Anything with a pysftp-style listdir_attr(remotepath)
+    remote_dir: Remote directory to list (ie, 'upload')
+    '''
+
+    listing = {}
+    for attributes in client.listdir_attr(remote_dir):
+        if parse_csv_date(attributes.filename) is None:
+            continue
+        listing[attributes.filename] = {'size': attributes.st_size, 'mtime': int(attributes.st_mtime)}
+    return listing
+
+
+def remote_fingerprint(name, entry):
+    '''
+    Returns a string identifying a remote file by its name, size, and mtime
+    (entry is from list_vehicle_csvs), for telling whether it's changed
+    without reading it.
+    '''
+
+    return f'{name}:{entry["size"]}:{entry["mtime"]}'
+
+
+class HashingReader(io.RawIOBase):
+    '''
+    Read-only binary stream that computes the sha256 and byte count of
+    everything read through it, so a file can be checksummed while it's parsed
+    instead of in a second pass.
+
+    raw:    Binary file object to read from (ie, an open pysftp file)
+    '''
+
+    def __init__(self, raw):
+        super().__init__()
+        self.raw = raw
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.raw.read(len(buffer))
+        buffer[:len(data)] = data
+        self.digest.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def hexdigest(self, chunk_size=2**20):
+        '''
+        Returns the sha256 hex digest of everything read, first reading
+        whatever hasn't been read yet if the stream is still open (a reader
+        like pandas may close it once it hits the end).
+        '''
+
+        while not self.closed and self.read(chunk_size):
+            pass
+        return self.digest.hexdigest()
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+
+def open_remote_csv(client, remotepath):
+    '''
+    Open a remote file for streaming through a HashingReader.
+
+    client:     Anything with a pysftp-style open(remotepath, mode)
+    remotepath: Path of the file on the server (ie, 'upload/<name>')
+
+    returns: HashingReader; close it (or use it in a with block) when done
+    '''
+
+    remote_file = client.open(remotepath, 'rb')
+    #: paramiko requests the next blocks in the background instead of one round trip per read
+    prefetch = getattr(remote_file, 'prefetch', None)
+    if prefetch is not None:
+        prefetch()
+    return HashingReader(remote_file)
+
+
+class LocalDirectoryClient:
+    '''
+    Stand-in for a pysftp.Connection that serves files from a local directory.
+    Implements just the listing, download, and open calls used by ManifestSync
+    and open_remote_csv.
+    '''
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def listdir_attr(self, remotepath='.'):
+        '''
+        Mirrors pysftp's listdir_attr: objects with filename, st_size, and
+        st_mtime attributes for every file in remotepath.
+        '''
+
+        attributes = []
+        for entry in os.scandir(self.root / remotepath):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            attributes.append(SimpleNamespace(filename=entry.name, st_size=stat.st_size, st_mtime=int(stat.st_mtime)))
+        return attributes
+
+    def get(self, remotepath, localpath=None, callback=None, preserve_mtime=False):
+        '''
+        Mirrors pysftp's get: copies remotepath to localpath. callback is
+        only there so callers can pass pysftp's arguments; a local copy has
+        no progress to report.
+        '''
+
+        source = self.root / remotepath
+        if localpath is None:
+            localpath = source.name
+        if preserve_mtime:
+            shutil.copy2(source, localpath)
+        else:
+            shutil.copyfile(source, localpath)
+
+    def open(self, remote_file, mode='r', bufsize=-1):
+        '''
+        Mirrors pysftp's open: opens remote_file for reading.
+        '''
+
+        return open(self.root / remote_file, mode, buffering=bufsize)  #: pylint: disable=consider-using-with
+
+
+class ManifestSync:
+    '''
+    Incrementally mirrors the 'vehicle_data_*.csv' files in a remote directory
+    to a local directory.
+
+    client:         Anything with pysftp-style listdir_attr(remotepath) and
+                    get(remotepath, localpath, preserve_mtime) methods, such as
+                    a pysftp.Connection or a LocalDirectoryClient.
+    remote_dir:     Remote directory to mirror (ie, 'upload').
+    local_dir:      Local directory to hold the downloaded files. Not cleared
+                    between runs; the manifest in it tracks what is current.
+    log:            Logger to report progress to.
+    '''
+
+    def __init__(self, client, remote_dir, local_dir, log=None):
+        self.client = client
+        self.remote_dir = remote_dir
+        self.local_dir = Path(local_dir)
+        self.manifest_path = self.local_dir / MANIFEST_NAME
+        self.log = log or logging.getLogger(__name__)
+
+    def list_remote(self):
+        '''
+        Returns {filename: {'size': int, 'mtime': int}} for every dated vehicle
+        csv in the remote directory.
+        '''
+
+        return list_vehicle_csvs(self.client, self.remote_dir)
+
+    @staticmethod
+    def latest_name(listing, remote_dir='upload'):
+        '''
+        Returns the file name in listing with the newest date in its name.
+
+        listing:    {filename: entry} from list_vehicle_csvs
+        remote_dir: Directory the listing is from, for the error message
+
+        raises: NoVehicleCsvs if there aren't any dated csvs
+        '''
+
+        dated = sorted((parse_csv_date(name), name) for name in listing if parse_csv_date(name) is not None)
+        if not dated:
+            raise NoVehicleCsvs(f'No vehicle_data_YYYYMMDD.csv files in {remote_dir}')
+        return dated[-1][1]
+
+    def load_manifest(self):
+        '''
+        Returns the manifest from the last sync, or an empty dict if there
+        isn't one or it can't be read.
+        '''
+
+        try:
+            with open(self.manifest_path) as manifest_file:
+                return json.load(manifest_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_manifest(self, manifest):
+        temp_path = self.manifest_path.with_suffix('.tmp')
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(temp_path, self.manifest_path)
+
+    def is_current(self, name, remote_entry, manifest):
+        '''
+        A local file is current if it exists and the manifest's size and mtime
+        for it match the remote listing.
+        '''
+
+        return (self.local_dir / name).is_file() and manifest.get(name) == remote_entry
+
+    def download(self, name):
+        '''
+        Download name to a temporary file and then move it into place so that a
+        failed transfer never leaves a partial csv behind.
+        '''
+
+        local_path = self.local_dir / name
+        temp_path = self.local_dir / f'{name}.part'
+        try:
+            self.client.get(f'{self.remote_dir}/{name}', str(temp_path), preserve_mtime=True)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        os.replace(temp_path, local_path)
+        return local_path
+
+    def sync(self, latest_only=True):
+        '''
+        Bring the local directory up to date with the remote directory.
+
+        latest_only:    Only consider the newest dated csv (default). Otherwise
+                        download every new or changed csv.
+
+        returns: (pathlib.Path to the newest local csv, list of downloaded names)
+        raises: NoVehicleCsvs if the remote directory has no dated csvs (the
+                local copies are left alone)
+        '''
+
+        self.local_dir.mkdir(parents=True, exist_ok=True)
+        listing = self.list_remote()
+        latest = self.latest_name(listing, self.remote_dir)
+        wanted = {latest: listing[latest]} if latest_only else listing
+
+        manifest = self.load_manifest()
+
+        #: Forget (and delete) anything that's no longer on the server or no longer wanted
+        for name in list(manifest):
+            if name not in wanted:
+                del manifest[name]
+        for local_path in self.local_dir.glob('vehicle_data_*.csv'):
+            if local_path.name not in wanted:
+                self.log.debug(f'Removing stale local copy {local_path.name}...')
+                local_path.unlink()
+
+        downloaded = []
+        for name, remote_entry in sorted(wanted.items()):
+            if self.is_current(name, remote_entry, manifest):
+                self.log.debug(f'{name} unchanged, skipping download')
+                continue
+            self.log.info(f'Downloading {self.remote_dir}/{name}...')
+            self.download(name)
+            manifest[name] = remote_entry
+            downloaded.append(name)
+
+            #: Save after each file so an interrupted sync doesn't redownload the finished ones
+            self.save_manifest(manifest)
+
+        self.save_manifest(manifest)
+        self.log.info(f'Synced {len(wanted)} file(s) from {self.remote_dir}, downloaded {len(downloaded)}')
+
+        return self.local_dir / latest, downloaded
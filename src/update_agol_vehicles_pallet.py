@@ -1,15 +1,17 @@
 '''
 update_agol_vehicles_pallet.py:
-Automates pulling csvs from an FTP folder and updating a hosted feature
+Automates syncing csvs from an FTP folder and updating a hosted feature
 service with the contents of the latest one.
 '''
 
+import argparse
 import datetime
+import io
 import os
+import shutil
 
+from contextlib import nullcontext
 from pathlib import Path
-from time import sleep
-from urllib.error import HTTPError, URLError
 
 import arcgis
 import arcpy
@@ -18,14 +20,196 @@ import pysftp
 from forklift.models import Pallet
 
 import fleetshare_secrets as secrets
+import vehicle_delta
+from checkpoints import file_digest
+from csv_points import (convert_csv_to_points, csv_text, field_name, infer_schema, override_fields,
+                        validate_coordinates)
+from fingerprints import FINGERPRINT_FILE_NAME, FingerprintStore, feature_class_digest
+from instrumentation import StageRecorder
+from publish_steps import StepRunner
+from sftp_sync import (ManifestSync, NoVehicleCsvs, list_vehicle_csvs, open_remote_csv, parse_csv_date,
+                       remote_fingerprint)
+from vehicle_history import VehicleHistory
+from vehicle_watch import LOCK_FILE_NAME, PublishLock, watch
 
 
 class AGOLVehiclesPallet(Pallet):
 
+    #: AGOL session kept between retries (and runs, if the pallet is reused) until it's older than SESSION_MAX_MINUTES
+    gis = None
+    gis_login_time = None
+    #: (path, date string) of the latest csv once it's been synced this run
+    latest_csv = None
+
     def requires_processing(self):
-        #: No crates, run process every time
+        #: No crates; only process if the latest csv isn't the one we last published
+        if self.publish_lock().is_held():
+            self.log.info('Another run is publishing (ie, watch mode); nothing to do')
+            return False
+        try:
+            if self.stream_enabled():
+                return not self.remote_already_published()
+            source_path, _ = self.sync_latest_csv()
+        except NoVehicleCsvs as e:
+            self.log.error(f'{e} on {secrets.SFTP_HOST}; nothing to publish')
+            return False
+        return not self.already_published(source_path)
+
+    def already_published(self, source_path):
+        '''
+        Returns True (and forgets the synced csv) if source_path hashes the
+        same as the last csv published to the features item.
+        '''
+
+        fingerprints = FingerprintStore(os.path.join(arcpy.env.scratchFolder, FINGERPRINT_FILE_NAME))
+        if fingerprints.is_unchanged(secrets.FEATURES_ITEM_ID, source=file_digest(source_path)):
+            self.log.info(f'{source_path} was already published; nothing to do')
+            self.latest_csv = None
+            return True
+        return False
+
+    def stream_enabled(self):
+        '''
+        Returns True if STREAM_CSV is set, VEHICLE_CSV_FIELDS gives the csv's
+        field types (a stream can't be read ahead to infer them), and nothing
+        else needs a local copy of the csv (delta publishing and the history
+        store read it back), in which case the latest csv is converted
+        straight from SFTP.
+        '''
+
+        if not getattr(secrets, 'STREAM_CSV', False):
+            return False
+        if not getattr(secrets, 'VEHICLE_CSV_FIELDS', None):
+            self.log.info('Streaming needs VEHICLE_CSV_FIELDS to type the csv; downloading the csv')
+            return False
+        if getattr(secrets, 'VEHICLE_KEY_FIELD', '') or getattr(secrets, 'VEHICLE_HISTORY_DIR', ''):
+            self.log.info('VEHICLE_KEY_FIELD and VEHICLE_HISTORY_DIR need a local copy; downloading the csv')
+            return False
         return True
 
+    def latest_remote_csv(self, sftp):
+        '''
+        Returns the name of the latest csv in the upload folder, its
+        sftp_sync.remote_fingerprint (name, size, and mtime), and its
+        {'size', 'mtime'} listing entry (see sftp_sync.list_vehicle_csvs).
+        '''
+
+        listing = list_vehicle_csvs(sftp, 'upload')
+        name = ManifestSync.latest_name(listing, 'upload')
+        return name, remote_fingerprint(name, listing[name]), listing[name]
+
+    def remote_already_published(self, client=None):
+        '''
+        Returns True if the latest csv in the upload folder has the same name,
+        size, and mtime as the last one streamed to the features item. Only
+        the folder listing is read.
+
+        client:     Optional open connection (see sync_latest_csv)
+        '''
+
+        connection = nullcontext(client) if client is not None else self.connect_sftp()
+        with connection as sftp:
+            name, remote, _ = self.latest_remote_csv(sftp)
+        fingerprints = FingerprintStore(os.path.join(arcpy.env.scratchFolder, FINGERPRINT_FILE_NAME))
+        if fingerprints.is_unchanged(secrets.FEATURES_ITEM_ID, remote=remote):
+            self.log.info(f'upload/{name} was already published; nothing to do')
+            return True
+        return False
+
+    def stream_latest_csv(self, output_path, rejects_path, recorder, client=None):
+        '''
+        Convert the latest csv in the upload folder straight from SFTP to
+        points without writing a local copy. The csv is parsed in chunks as it
+        arrives and hashed on the fly.
+
+        output_path:    Feature class to create
+        rejects_path:   csv for rows with bad coordinates
+        recorder:       instrumentation.StageRecorder for the transfer and
+                        conversion
+        client:         Optional open connection (see sync_latest_csv)
+
+        returns: (display path, date string, remote fingerprint, sha256 of the
+                 csv, csv_points.ConversionReport)
+        raises: ValueError if the bytes read don't match the listing's size
+                (ie, the file was replaced mid-transfer)
+        '''
+
+        connection = nullcontext(client) if client is not None else self.connect_sftp()
+        with recorder.stage('csv stream to points') as record, connection as sftp:
+            name, remote, entry = self.latest_remote_csv(sftp)
+            date_string = self.check_csv_date(name, previous_days=7)
+            source_path = f'{secrets.SFTP_HOST}/upload/{name}'
+            self.log.info(f'Streaming {source_path} to feature class {output_path}...')
+            with open_remote_csv(sftp, f'upload/{name}') as stream:
+                conversion = convert_csv_to_points(
+                    io.BufferedReader(stream, buffer_size=2**20),
+                    output_path,
+                    chunk_size=getattr(secrets, 'CSV_CHUNK_SIZE', 50000),
+                    bounds=getattr(secrets, 'VEHICLE_BOUNDS', None),
+                    rejects_path=rejects_path,
+                    fields=getattr(secrets, 'VEHICLE_CSV_FIELDS', None),
+                    log=self.log,
+                )
+                source_hash = stream.hexdigest()
+                size = stream.size
+            record['rows'] = conversion.written
+
+        if size != entry['size']:
+            raise ValueError(f'Read {size} of {entry["size"]} bytes of {source_path}; it may have changed mid-transfer')
+
+        return source_path, date_string, remote, source_hash, conversion
+
+    def publish_lock(self):
+        '''
+        Returns the vehicle_watch.PublishLock in the scratch folder that keeps
+        watch mode and a scheduled run from publishing at the same time.
+        '''
+
+        return PublishLock(os.path.join(arcpy.env.scratchFolder, LOCK_FILE_NAME), log=self.log)
+
+    def connect_sftp(self):
+        '''
+        Returns a pysftp.Connection to SFTP_HOST, checked against KNOWNHOSTS.
+        '''
+
+        if not secrets.KNOWNHOSTS or not os.path.isfile(secrets.KNOWNHOSTS):
+            raise FileNotFoundError(f'known_hosts file {secrets.KNOWNHOSTS} not found. Please create with ssh-keyscan.')
+
+        connection_opts = pysftp.CnOpts(knownhosts=secrets.KNOWNHOSTS)
+        return pysftp.Connection(
+            secrets.SFTP_HOST, username=secrets.SFTP_USERNAME, password=secrets.SFTP_PASSWORD, cnopts=connection_opts
+        )
+
+    def sync_latest_csv(self, recorder=None, client=None):
+        '''
+        Sync the latest csv in the upload folder on sftp to the fleet scratch
+        folder (skipping it if we already have it) and return its path and
+        date. The result is reused by process if requires_processing already
+        synced it.
+
+        recorder:   Optional instrumentation.StageRecorder for the sync
+        client:     Optional open connection to sync with (ie, watch mode's,
+                    or an sftp_sync.LocalDirectoryClient); by default a new
+                    SFTP connection is opened and closed
+
+        returns: path string and date string of the latest csv
+        raises: sftp_sync.NoVehicleCsvs if the upload folder is empty
+        '''
+
+        temp_csv_dir = os.path.join(arcpy.env.scratchFolder, 'fleet')
+        #: temp_csv_dir is kept between runs so the sync only has to download new or changed files
+        os.makedirs(temp_csv_dir, exist_ok=True)
+
+        recorder = recorder or StageRecorder(emit=self.log.info)
+        self.log.info(f'Syncing latest file from {secrets.SFTP_HOST}/upload...')
+        connection = nullcontext(client) if client is not None else self.connect_sftp()
+        with recorder.stage('sftp sync') as record, connection as sftp:
+            _, downloaded = ManifestSync(sftp, 'upload', temp_csv_dir, log=self.log).sync(latest_only=True)
+            record['rows'] = len(downloaded)
+
+        self.latest_csv = self.get_latest_csv(temp_csv_dir, previous_days=7)
+        return self.latest_csv
+
     def get_latest_csv(self, temp_csv_dir, previous_days=-1):
         '''
         Returns the path string and date of the latest 'vehicle_data_*.csv'
@@ -45,8 +229,17 @@ class AGOLVehiclesPallet(Pallet):
             self.log.exception(err_msg)
             raise e
 
+        return str(latest_csv), self.check_csv_date(str(latest_csv), previous_days)
+
+    def check_csv_date(self, latest_csv, previous_days=-1):
+        '''
+        Returns the date string from a 'vehicle_data_*.csv' path or name. Will
+        fail if previous_days is positive and the date does not fall within
+        that many preceding days.
+        '''
+
         #: Pull the date out of vehicle_data_yyyymmdd.csv to check recency
-        date_string = str(latest_csv).rsplit('_')[-1].split('.')[0]
+        date_string = latest_csv.rsplit('_')[-1].split('.')[0]
         try:
             csv_datetime = datetime.date(int(date_string[:4]), int(date_string[4:6]), int(date_string[6:]))
         except ValueError as e:
@@ -62,7 +255,7 @@ class AGOLVehiclesPallet(Pallet):
             self.log.exception(err_msg)
             raise ValueError(err_msg)
 
-        return str(latest_csv), date_string
+        return date_string
 
     def get_map_layer(self, project_path, fc_to_add):
         '''
@@ -90,10 +283,10 @@ class AGOLVehiclesPallet(Pallet):
 
         return layer, sharing_map
 
-    def update_agol_feature_service(self, sharing_map, layer, feature_service_name, sddraft_path, sd_path, sd_item):
+    def stage_service_definition(self, sharing_map, layer, feature_service_name, sddraft_path, sd_path):
         '''
-        Helper method for updating an AGOL hosted feature service from an ArcGIS
-        Pro arcpy.mp.Map and .Layer objects.
+        Draft and stage a service definition for updating an AGOL hosted
+        feature service from ArcGIS Pro arcpy.mp.Map and .Layer objects.
 
         sharing_map:            An arcpy.mp.Map object containing the layer to
                                 be shared.
@@ -104,9 +297,6 @@ class AGOLVehiclesPallet(Pallet):
                                 will fail.
         sddraft_path, sd_path:  Strings of the paths to save the service
                                 definition draft and final files.
-        sd_item:                The URL of the service definition item on AGOL
-                                originally used to publish the hosted feature
-                                service.
         '''
 
         for item in [sddraft_path, sd_path]:
@@ -117,92 +307,309 @@ class AGOLVehiclesPallet(Pallet):
         sharing_draft = sharing_map.getWebLayerSharingDraft('HOSTING_SERVER', 'FEATURE', feature_service_name, [layer])
         sharing_draft.exportToSDDraft(sddraft_path)
         arcpy.server.StageService(sddraft_path, sd_path)
-        sd_item.update(data=sd_path)
-        sd_item.publish(overwrite=True)
 
-    def process(self):
+    def get_gis(self, refresh=False):
+        '''
+        Returns an AGOL session, reusing the existing one unless it's older
+        than SESSION_MAX_MINUTES (55 by default, inside AGOL's token lifetime)
+        or refresh is True.
+        '''
+
+        max_age = datetime.timedelta(minutes=getattr(secrets, 'SESSION_MAX_MINUTES', 55))
+        now = datetime.datetime.now()
+        if refresh or self.gis is None or now - self.gis_login_time > max_age:
+            self.log.info(f'Connecting to AGOL as {secrets.AGOL_USERNAME}...')
+            self.gis = arcgis.gis.GIS('https://www.arcgis.com', secrets.AGOL_USERNAME, secrets.AGOL_PASSWORD)
+            self.gis_login_time = now
+        return self.gis
+
+    def get_delta(self, source_path, snapshot_path, history=None, published_date=None, workspace=None):
+        '''
+        Diff source_path against the last published snapshot so only the
+        changed vehicles need to be pushed to the service. The changed rows get
+        the field names and types the full overwrite would give them (from
+        VEHICLE_CSV_FIELDS or inferred from the new snapshot).
+
+        source_path:    Path string to the new vehicle csv
+        snapshot_path:  Path string to the copy of the last published csv
+        history:        Optional VehicleHistory that source_path has been
+                        ingested into. If it also holds published_date, both
+                        snapshots are read from it instead of the csvs.
+        published_date: datetime.date of the last published csv
+        workspace:      Workspace the full overwrite's feature class is written
+                        to, for validating field names
+
+        returns: vehicle_delta.VehicleDelta, or None if the full overwrite
+                 should be used (delta publishing turned off, no snapshot,
+                 schema change, or bad keys)
+        '''
+
+        key = getattr(secrets, 'VEHICLE_KEY_FIELD', '')
+        if not key:
+            return None
+
+        previous_df = current_df = None
+        if history is not None and published_date is not None:
+            previous_df = history.snapshot(published_date)
+            current_df = history.snapshot(parse_csv_date(os.path.basename(source_path)))
+        if previous_df is None or current_df is None:
+            if not os.path.isfile(snapshot_path):
+                self.log.info('No previously published snapshot; using full overwrite')
+                return None
+            previous_df = vehicle_delta.read_snapshot(snapshot_path)
+            current_df = vehicle_delta.read_snapshot(source_path)
+
+        #: Leave out the same bad coordinates the full overwrite rejects
+        bounds = getattr(secrets, 'VEHICLE_BOUNDS', None)
+        snapshots = []
+        for snapshot in [previous_df, current_df]:
+            if {'LONGITUDE', 'LATITUDE'} <= set(snapshot.columns):
+                reasons, _, _ = validate_coordinates(snapshot, 'LONGITUDE', 'LATITUDE', bounds)
+                snapshot = snapshot[reasons.isnull()]
+            snapshots.append(snapshot)
+
+        try:
+            delta = vehicle_delta.diff_snapshots(*snapshots, key)
+        except vehicle_delta.DeltaNotPossible as e:
+            self.log.info(f'{e}; using full overwrite')
+            return None
+
+        schema = infer_schema([csv_text(snapshots[1])], 'LONGITUDE', 'LATITUDE', source_path)
+        schema = override_fields(schema, getattr(secrets, 'VEHICLE_CSV_FIELDS', None))
+        delta = vehicle_delta.conform_delta(delta, schema, key, workspace)
+
+        self.log.info(f'Delta from last published snapshot: {delta}')
+        return delta
+
+    def watch(self, connect=None, max_polls=None):
+        '''
+        Keep polling the upload folder and sync, ingest, and publish each new
+        csv as soon as it has finished uploading (its size and mtime are the
+        same for WATCH_STABLE_POLLS polls in a row). Runs until interrupted.
+
+        connect:    Optional callable returning a client to watch instead of
+                    connecting to SFTP_HOST (ie, one returning an
+                    sftp_sync.LocalDirectoryClient for testing). Called again
+                    for a new client after a failed poll.
+        max_polls:  Stop after this many polls (default None, forever)
+
+        returns: number of csvs handled
+        '''
+
+        def handle(sftp, name):
+            if self.stream_enabled():
+                published = self.remote_already_published(sftp)
+            else:
+                source_path, _ = self.sync_latest_csv(client=sftp)
+                published = self.already_published(source_path)
+            if published:
+                self.log.info(f'{name} matches what was last published; skipping')
+                return
+            self.process(sftp)
+
+        return watch(
+            connect or self.connect_sftp,
+            handle,
+            interval_seconds=getattr(secrets, 'WATCH_INTERVAL_SECONDS', 60),
+            jitter=getattr(secrets, 'WATCH_JITTER', 0.2),
+            max_backoff_seconds=getattr(secrets, 'WATCH_MAX_BACKOFF_SECONDS', 900),
+            stable_polls=getattr(secrets, 'WATCH_STABLE_POLLS', 2),
+            max_polls=max_polls,
+            log=self.log,
+        )
+
+    def process(self, client=None):
+        #: Only one run publishes at a time; raises vehicle_watch.LockHeld if another one is
+        with self.publish_lock():
+            self.publish_latest_csv(client)
+
+    def publish_latest_csv(self, client=None):
+
+        #: Emits each stage's wall/cpu time, peak memory, and row counts as JSON to the log
+        recorder = StageRecorder(emit=self.log.info)
 
         #: Set up paths and directories
         feature_service_name = secrets.FEATURE_SERVICE_NAME
 
-        temp_csv_dir = os.path.join(arcpy.env.scratchFolder, 'fleet')
         temp_fc_path = os.path.join(arcpy.env.scratchGDB, feature_service_name)
         sddraft_path = os.path.join(arcpy.env.scratchFolder, f'{feature_service_name}.sddraft')
         sd_path = sddraft_path[:-5]
+        snapshot_path = os.path.join(arcpy.env.scratchFolder, 'fleet_published.csv')
+        rejects_path = os.path.join(arcpy.env.scratchFolder, 'fleet_rejects.csv')
+        fingerprints = FingerprintStore(os.path.join(arcpy.env.scratchFolder, FINGERPRINT_FILE_NAME))
 
-        paths = [temp_csv_dir, temp_fc_path, sddraft_path, sd_path]
+        paths = [temp_fc_path, sddraft_path, sd_path]
         for item in paths:
             if arcpy.Exists(item):
                 self.log.info(f'Deleting {item} prior to use...')
                 arcpy.Delete_management(item)
-        os.mkdir(temp_csv_dir)
 
-        if not secrets.KNOWNHOSTS or not os.path.isfile(secrets.KNOWNHOSTS):
-            raise FileNotFoundError(f'known_hosts file {secrets.KNOWNHOSTS} not found. Please create with ssh-keyscan.')
-
-        #: Download all the files in the upload folder on sftp to temp_csv_dir
-        self.log.info(f'Downloading all files from {secrets.SFTP_HOST}/upload...')
-        connection_opts = pysftp.CnOpts(knownhosts=secrets.KNOWNHOSTS)
-        with pysftp.Connection(
-            secrets.SFTP_HOST, username=secrets.SFTP_USERNAME, password=secrets.SFTP_PASSWORD, cnopts=connection_opts
-        ) as sftp:
-            sftp.get_d('upload', temp_csv_dir, preserve_mtime=True)
-
-        #: Get the latest file
-        source_path, source_date = self.get_latest_csv(temp_csv_dir, previous_days=7)
-
-        self.log.info(f'Converting {source_path} to feature class {temp_fc_path}...')
-        wgs84 = arcpy.SpatialReference(4326)
-        result = arcpy.management.XYTableToPoint(
-            source_path, temp_fc_path, 'LONGITUDE', 'LATITUDE', coordinate_system=wgs84
+        #: Stream the latest file straight into the feature class if nothing else needs it on disk
+        streamed = self.stream_enabled()
+        remote = delta = None
+        if streamed:
+            source_path, source_date, remote, source_hash, conversion = self.stream_latest_csv(
+                temp_fc_path, rejects_path, recorder, client
+            )
+            self.latest_csv = None
+        else:
+            #: Get the latest file, unless requires_processing already did
+            source_path, source_date = self.latest_csv or self.sync_latest_csv(recorder, client)
+            self.latest_csv = None
+            source_hash = file_digest(source_path)
+
+            #: Keep every day's csv in the (optional) history store
+            history = None
+            if getattr(secrets, 'VEHICLE_HISTORY_DIR', ''):
+                key = getattr(secrets, 'VEHICLE_KEY_FIELD', '') or None
+                history = VehicleHistory(secrets.VEHICLE_HISTORY_DIR, key, self.log)
+                with recorder.stage('history ingest'):
+                    history.ingest(source_path)
+
+            #: Only build the feature class if we have to do a full overwrite
+            published_date = fingerprints.get(secrets.FEATURES_ITEM_ID).get('snapshot_date')
+            published_date = datetime.date.fromisoformat(published_date) if published_date else None
+            with recorder.stage('delta diff') as record:
+                delta = self.get_delta(
+                    source_path, snapshot_path, history, published_date, os.path.dirname(temp_fc_path)
+                )
+                record['rows'] = len(delta) if delta is not None else None
+            if delta is None:
+                self.log.info(f'Converting {source_path} to feature class {temp_fc_path}...')
+                with recorder.stage('csv to points') as record:
+                    conversion = convert_csv_to_points(
+                        source_path,
+                        temp_fc_path,
+                        chunk_size=getattr(secrets, 'CSV_CHUNK_SIZE', 50000),
+                        bounds=getattr(secrets, 'VEHICLE_BOUNDS', None),
+                        rejects_path=rejects_path,
+                        fields=getattr(secrets, 'VEHICLE_CSV_FIELDS', None),
+                        log=self.log,
+                    )
+                    record['rows'] = conversion.written
+        source_day = parse_csv_date(os.path.basename(source_path))
+        if delta is None:
+            self.log.info(f'Converted {conversion}')
+            if conversion.rejected:
+                self.log.warning(f'Rejected rows written to {rejects_path}')
+
+        def keep_snapshot():
+            #: A streamed csv has no local copy to diff the next one against, so don't leave an older one around
+            if not streamed:
+                shutil.copyfile(source_path, snapshot_path)
+            elif os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
+
+        #: A new csv doesn't always mean new data (ie, the same rows in a different order)
+        output_hash = None
+        if delta is None:
+            with recorder.stage('fingerprint'):
+                output_hash = feature_class_digest(temp_fc_path)
+            unchanged = fingerprints.is_unchanged(secrets.FEATURES_ITEM_ID, output=output_hash)
+        else:
+            unchanged = not len(delta)
+        if unchanged:
+            self.log.info(f'{source_path} has the same data that was last published; skipping publishing')
+            fingerprints.record(
+                secrets.FEATURES_ITEM_ID,
+                source=source_hash,
+                output=output_hash,
+                snapshot_date=source_day.isoformat(),
+                remote=remote,
+            )
+            keep_snapshot()
+            self.log.info(f'Stage metrics:\n{recorder.summary()}')
+            return
+
+        #: Each step's results are kept in state so a retry resumes at the step that failed
+        state = {}
+
+        def login():
+            #: Running this again means the session went bad, so get a new one
+            state['gis'] = self.get_gis(refresh='gis' in state)
+            state['feature_item'] = state['gis'].content.get(secrets.FEATURES_ITEM_ID)
+            if delta is None:
+                state['sd_item'] = state['gis'].content.get(secrets.SD_ITEM_ID)
+
+        def apply_edits():
+            #: Safe to rerun on retry; apply_delta reconciles against what's already on the server
+            key = field_name(secrets.VEHICLE_KEY_FIELD, os.path.dirname(temp_fc_path))
+            edit_counts = vehicle_delta.apply_delta(state['feature_item'].layers[0], delta, key, log=self.log)
+            self.log.info(f'Sent {edit_counts}')
+
+        def portal_sign_in():
+            arcpy.SignInToPortal(arcpy.GetActivePortalURL(), secrets.AGOL_USERNAME, secrets.AGOL_PASSWORD)
+
+        def map_layer():
+            state['layer'], state['fleet_map'] = self.get_map_layer(secrets.PROJECT_PATH, temp_fc_path)
+
+        def stage():
+            self.stage_service_definition(
+                state['fleet_map'], state['layer'], feature_service_name, sddraft_path, sd_path
+            )
+
+        def upload():
+            state['sd_item'].update(data=sd_path)
+
+        def publish():
+            state['sd_item'].publish(overwrite=True)
+
+        def update_description():
+            year = source_date[:4]
+            month = source_date[4:6]
+            day = source_date[6:]
+            description = f'Vehicle location data obtained from Fleet; updated on {year}-{month}-{day}'
+            state['feature_item'].update(item_properties={'description': description})
+
+        if delta is not None:
+            steps = [('agol login', login), ('apply edits', apply_edits)]
+        else:
+            #: draft, stage, update, publish
+            steps = [
+                ('agol login', login),
+                ('portal sign in', portal_sign_in),
+                ('map layer', map_layer),
+                ('stage service definition', stage),
+                ('upload service definition', upload),
+                ('publish', publish),
+            ]
+        steps.append(('update description', update_description))
+
+        runner = StepRunner(
+            retries=getattr(secrets, 'PUBLISH_RETRIES', 3),
+            backoff_seconds=getattr(secrets, 'PUBLISH_BACKOFF_SECONDS', 1),
+            max_backoff_seconds=getattr(secrets, 'PUBLISH_MAX_BACKOFF_SECONDS', 300),
+            session_steps=['agol login', 'portal sign in'],
+            log=self.log,
+            recorder=recorder,
+        )
+        self.log.info('Updating service...')
+        retries = runner.run(steps)
+        self.log.info(f'Service updated after {retries} retries')
+
+        #: Keep what we just published to diff the next csv against, and its fingerprints to skip it next time
+        keep_snapshot()
+        fingerprints.record(
+            secrets.FEATURES_ITEM_ID,
+            source=source_hash,
+            output=output_hash,
+            snapshot_date=source_day.isoformat(),
+            remote=remote,
         )
-        self.log.debug(result.getMessages())
-
-        try_count = 1
-        while True:
-            try:
-                self.log.info(f'Updating service, try {try_count} of 3...')
-
-                self.log.info(f'Connecting to AGOL as {secrets.AGOL_USERNAME}...')
-                gis = arcgis.gis.GIS('https://www.arcgis.com', secrets.AGOL_USERNAME, secrets.AGOL_PASSWORD)
-                sd_item = gis.content.get(secrets.SD_ITEM_ID)
-
-                self.log.info('Getting map and layer...')
-                arcpy.SignInToPortal(arcpy.GetActivePortalURL(), secrets.AGOL_USERNAME, secrets.AGOL_PASSWORD)
-                layer, fleet_map = self.get_map_layer(secrets.PROJECT_PATH, temp_fc_path)
-
-                #: draft, stage, update, publish
-                self.log.info('Staging and updating...')
-                self.update_agol_feature_service(fleet_map, layer, feature_service_name, sddraft_path, sd_path, sd_item)
-
-                #: Update item description
-                self.log.info('Updating item description...')
-                feature_item = gis.content.get(secrets.FEATURES_ITEM_ID)
-                year = source_date[:4]
-                month = source_date[4:6]
-                day = source_date[6:]
-                description = f'Vehicle location data obtained from Fleet; updated on {year}-{month}-{day}'
-                feature_item.update(item_properties={'description': description})
-
-            except Exception as e:
-                err_msg = f'Error on attempt {try_count} of 3; retrying.'
-                self.log.exception(err_msg)
-
-                #: Fail for good if 3x retry fails, otherwise increment, sleep,
-                #: and retry
-                if try_count > 3:
-                    err_msg = 'Connection errors; giving up after 3 retries'
-                    self.log.exception(err_msg)
-                    raise e
-                sleep(try_count**2)
-                try_count += 1
-                continue
-
-            #: If we haven't gotten an error, break out of while True.
-            break
+
+        self.log.info(f'Stage metrics:\n{recorder.summary()}')
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Publish the latest fleet vehicle csv to AGOL')
+    parser.add_argument(
+        '--watch', action='store_true', help='keep polling SFTP and publish each new csv as soon as it lands'
+    )
+    args = parser.parse_args()
+
     pallet = AGOLVehiclesPallet()
     pallet.configure_standalone_logging()
-    pallet.process()
+    if args.watch:
+        pallet.watch()
+    else:
+        pallet.process()
@@ -1,15 +1,21 @@
 '''Ok, it's not pretty, but it gets the job done.
     1. Set all the relevant variables in the specific_info and common_info classes
-    2. Call from the command line twice, once for WFH and again for approved operators:
-        python update_hexes.py w
-        python update_hexes.py o
-        (arcpy.SummarizeWithin _really_ does not like to be called twice in the same script)
+    2. Call from the command line with the methods to run, "w" for WFH and/or "o" for approved operators (or "all"):
+        python update_hexes.py w o
+        Running both in one call loads the DHRM data and geocodes the shared employees only once.
+    3. Rerunning skips every stage whose inputs haven't changed (and doesn't republish unchanged hexes); add
+       --force-from <stage> to rerun from a stage anyway:
+        python update_hexes.py w --force-from geocode
 '''
 
 import datetime
-from dataclasses import dataclass, field
+import hashlib
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 from getpass import getpass
-from os.path import join
+from os.path import join, split
 from pathlib import Path
 from sys import argv
 
@@ -19,7 +25,50 @@ import pandas as pd
 import arcpy
 import arcgis
 
+import hex_engine
 import hex_secrets as secrets
+from checkpoints import STAGES, CheckpointStore, file_digest, hash_parts, stat_fingerprint, tree_fingerprint
+from ein_index import EINIndex, normalize_eins
+from fingerprints import FINGERPRINT_FILE_NAME, FingerprintStore, feature_class_digest
+from geocode_cache import GeocodeCache, normalize_address_keys
+from geocoders import Geocoder, LocatorGeocoder, clear_shards, geocode_in_shards
+from instrumentation import StageRecorder
+
+#: Bump whenever get_dhrm_dataframe's processing changes so old cached frames are ignored
+DHRM_CACHE_VERSION = 4
+
+#: The only DHRM columns the rest of the script uses (get_dhrm_dataframe's default projection)
+DHRM_COLUMNS = (
+    'EIN', 'DEPT_NAME', 'physical_address_line1', 'Empl Physical ZIP', 'mailing_address_line1', 'Empl Mail ZIP'
+)
+#: Area of the HEX_FC_PATH hexes, as stated in the layer descriptions
+BASE_HEX_SQUARE_MILES = 5
+#: CommonInfo.intermediate_workspace options and where each keeps the intermediates (None for scratch_gdb)
+INTERMEDIATE_WORKSPACES = {'scratch': None, 'memory': 'memory'}
+#: Employee columns written to the csv for geocoding (plus the in_<method> flags); geocode_points adds the USER_ prefix
+GEOCODE_COLUMNS = ['real_addr', 'real_zip', 'DEPT_NAME']
+
+#: The only WFH survey columns get_wfh_eins uses
+WFH_REPORT_COLUMNS = ['New', 'Q5', 'Q1_4']
+
+
+@dataclass
+class HexResolution:
+    '''A coarser hex layer rolled up from the base hexes
+
+    Attributes:
+        factor (float): Hex size as a multiple of the base hexes' (ie, 3 for hexes with 9 times the area)
+        sd_itemid (str): Service definition item of the layer's feature service
+        fs_itemid (str): The layer's feature service item
+        fs_name (str): The layer's feature service name
+        description (str, optional): Item description. Defaults to None (the base layer's, with its hex area scaled
+            to this layer's).
+    '''
+    factor: float
+    sd_itemid: str
+    fs_itemid: str
+    fs_name: str
+    description: str = None
 
 
 @dataclass
@@ -30,6 +79,9 @@ class SpecificInfo:
     fs_itemid: str
     fs_name: str
     description: str
+    resolutions: list = field(default_factory=list)
+    #: Area of the base hexes, which the rolled up layers' default descriptions scale
+    hex_square_miles: float = BASE_HEX_SQUARE_MILES
     simple_summary: bool = field(init=False)
 
     def __post_init__(self):
@@ -40,6 +92,31 @@ class SpecificInfo:
         else:
             raise NotImplementedError(f'Method {self.method} not recognized...')
 
+    def resolution_info(self, resolution):
+        '''Get a copy of this info for one of its rolled up resolutions' layers
+        '''
+
+        #: Hex area grows with the square of the hex size
+        square_miles = self.hex_square_miles * resolution.factor**2
+        description = resolution.description or self.description.replace(
+            f'{self.hex_square_miles:g} sq mile', f'{square_miles:g} sq mile'
+        )
+        return replace(
+            self,
+            sd_itemid=resolution.sd_itemid,
+            fs_itemid=resolution.fs_itemid,
+            fs_name=resolution.fs_name,
+            description=description,
+            resolutions=[],
+            hex_square_miles=square_miles,
+        )
+
+    def layers(self):
+        '''Get this info and one copy for each of its resolutions, for every layer it publishes
+        '''
+
+        return [self] + [self.resolution_info(resolution) for resolution in self.resolutions]
+
 
 @dataclass
 class CommonInfo:
@@ -52,18 +129,54 @@ class CommonInfo:
     username: str
     scratch_gdb: Path
     working_dir_path: Path
+    binning_engine: str = 'numpy'
+    #: 'scratch' to keep intermediates in scratch_gdb between runs or 'memory' to keep them in the memory workspace
+    intermediate_workspace: str = 'scratch'
+    geocode_cache_path: Path = None
+    geocode_cache_max_age: int = 90
+    geocode_shard_size: int = 1000
+    geocode_workers: int = 4
+    publish_workers: int = 2
     csv_path: Path = field(init=False)
+    cache_dir: Path = field(init=False)
+    geocode_shard_dir: Path = field(init=False)
     geocoded_points_path: Path = field(init=False)
     hexes_fc_path: Path = field(init=False)
     within_table_path: Path = field(init=False)
     trimmed_hex_fc_path: Path = field(init=False)
+    rollup_hex_fc_path: Path = field(init=False)
+    checkpoint_path: Path = field(init=False)
+    fingerprint_path: Path = field(init=False)
+    geocode_matches_path: Path = field(init=False)
+    hex_index_dir: Path = field(init=False)
 
     def __post_init__(self):
         self.csv_path = self.working_dir_path / 'ein_records.csv'
-        self.geocoded_points_path = self.scratch_gdb / 'geocoded_points'
-        self.hexes_fc_path = self.scratch_gdb / 'hexes'
-        self.within_table_path = self.scratch_gdb / 'within_table'
+        #: geocode_points writes its matches next to csv_path
+        self.geocode_matches_path = self.working_dir_path / 'geocode_matches.csv'
+        self.checkpoint_path = self.working_dir_path / 'checkpoints.json'
+        self.fingerprint_path = self.working_dir_path / FINGERPRINT_FILE_NAME
+        self.cache_dir = self.working_dir_path / 'cache'
+        self.hex_index_dir = self.cache_dir / 'hex_index'
+        self.geocode_shard_dir = self.working_dir_path / 'geocode_shards'
+        if self.intermediate_workspace not in INTERMEDIATE_WORKSPACES:
+            raise NotImplementedError(f'Intermediate workspace {self.intermediate_workspace} not recognized...')
+        #: Only the layers that get published have to be on disk
+        intermediate_dir = Path(INTERMEDIATE_WORKSPACES[self.intermediate_workspace] or self.scratch_gdb)
+        self.geocoded_points_path = intermediate_dir / 'geocoded_points'
+        self.hexes_fc_path = intermediate_dir / 'hexes'
+        self.within_table_path = intermediate_dir / 'within_table'
         self.trimmed_hex_fc_path = self.scratch_gdb / 'trimmed_hexes'
+        self.rollup_hex_fc_path = self.scratch_gdb / 'rollup_hexes'
+        if self.geocode_cache_path is None:
+            self.geocode_cache_path = self.working_dir_path / 'geocode_cache.sqlite'
+
+    @staticmethod
+    def method_path(path, method):
+        '''Get the per-method version of one of the scratch paths (ie, hexes -> hexes_wfh)
+        '''
+
+        return path.with_name(f'{path.name}_{method}')
 
 
 def clean_field_name(name):
@@ -73,67 +186,138 @@ def clean_field_name(name):
     return name
 
 
-def get_wfh_eins(report_dir_path, monthly_dhrm_data, output_csv_path):
-    '''Create a csv of the employee data that have matching records in the WFH survey
+def read_wfh_report(report_path, cache_dir=None):
+    '''Read the columns get_wfh_eins needs from a WFH survey report, dropping the two extra header rows
+
+    Past reports never change, so if cache_dir is given the parsed report is cached there keyed on its path and
+    modification time and only re-read if the file changes.
+
+    Args:
+        report_path (Path): WFH survey report csv
+        cache_dir (Path, optional): Directory to cache the parsed report in. Defaults to None (no caching).
+
+    Returns:
+        (DataFrame, bool): The report's New, Q5, and Q1_4 columns as strings and whether it came from the cache
+    '''
+
+    cache_path = None
+    if cache_dir is not None:
+        path_hash = hashlib.sha1(str(Path(report_path).resolve()).encode()).hexdigest()[:16]
+        source_stat = Path(report_path).stat()
+        cache_path = Path(cache_dir) / 'wfh' / f'{path_hash}_{source_stat.st_mtime_ns}_{source_stat.st_size}.pkl'
+        if cache_path.exists():
+            return pd.read_pickle(cache_path), True
+
+    report_df = pd.read_csv(report_path, header=0, usecols=WFH_REPORT_COLUMNS, dtype=str)
+    report_df.drop([0, 1], inplace=True)
+
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        #: Drop any cached versions of this report from before it changed
+        for old_cache in cache_path.parent.glob(f'{path_hash}_*.pkl'):
+            old_cache.unlink()
+        report_df.to_pickle(cache_path)
+
+    return report_df, False
+
+
+def get_wfh_eins(
+    report_dir_path, monthly_dhrm_data, output_csv_path=None, cache_dir=None, max_workers=8, ein_index=None
+):
+    '''Get the employee data that have matching records in the WFH survey, optionally saving them to a csv
 
     Args:
         report_dir_path (Path): directory of non-cumulative csvs of the WFH survey data
         monthly_dhrm_data (DataFrame): monthly employee data
-        output_csv_path (Path): output csv file
+        output_csv_path (Path, optional): output csv file. Defaults to None (don't save).
+        cache_dir (Path, optional): Directory to cache parsed reports in. Defaults to None (no caching).
+        max_workers (int, optional): Number of reports to read at once. Defaults to 8.
+        ein_index (EINIndex, optional): Index of monthly_dhrm_data's EINint column. Defaults to None (build one).
+
+    Returns:
+        DataFrame: The matching employee records
     '''
 
     print(f'\nReading WFH surveys from {report_dir_path}...')
 
-    wfh_reports = report_dir_path.glob('*.csv')
-    report_dfs = []
+    report_paths = sorted(report_dir_path.glob('*.csv'))
 
-    #: Read in each report, trim out weird row, and concat into a single data frame
-    for report in wfh_reports:
-        report_df = pd.read_csv(report, header=0)
-        report_df.drop([0, 1], inplace=True)
-        report_dfs.append(report_df)
-    survey_df = pd.concat(report_dfs)
+    #: Read in each report (trimming out weird rows) concurrently, and concat into a single data frame
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda report_path: read_wfh_report(report_path, cache_dir), report_paths))
+    cached_count = sum(from_cache for _, from_cache in results)
+    print(f'{len(report_paths)} reports ({cached_count} from cache, {len(report_paths) - cached_count} parsed)')
+    survey_df = pd.concat([report_df for report_df, _ in results])
 
     #: Drop rows that aren't new or that are UTNG (they don't use EINs)
     non_update_df = survey_df[(survey_df['New'] == 'Yes') & ~(survey_df['Q5'] == 'UTNG')]
 
-    #: Non-na EINs as a series
-    eins = non_update_df[non_update_df['Q1_4'].notna()].loc[:, 'Q1_4']
+    #: "join" by only including the employee records whose EIN is in the survey; malformed EINs (not 6 digits) and
+    #: duplicates are counted and dropped by the index
+    ein_index = ein_index or EINIndex(monthly_dhrm_data['EINint'])
+    dhrm_rows, stats = ein_index.match(non_update_df['Q1_4'], 'WFH survey', text_length=6)
+    wfh_records = monthly_dhrm_data.iloc[dhrm_rows]
+    print(stats)
+    print(f'Employee records with matching EIN in WFH survey: {wfh_records.shape[0]}')
 
-    #: Drop malformed EINs (not 6 digits) and duplicate EINs
-    wfh_eins_int = eins[eins.str.len() == 6].astype(int)
-    wfh_eins_int = wfh_eins_int.drop_duplicates()
+    if output_csv_path is not None:
+        print(f'Saving output data to {output_csv_path}...')
+        wfh_records.to_csv(output_csv_path)
 
-    #: "join" by only including rows where EINint is in series of EINs from WFH survey
-    wfh_records = monthly_dhrm_data[monthly_dhrm_data['EINint'].isin(wfh_eins_int)]
-    print(
-        f'Employee records with matching EIN in WFH survey: {wfh_records.shape[0]} (out of {wfh_eins_int.count()} EINs from survey)'
-    )
+    return wfh_records
 
-    print(f'Saving output data to {output_csv_path}...')
-    wfh_records.to_csv(output_csv_path)
 
+def frame_megabytes(dataframe):
+    '''Get a frame's memory footprint (including the contents of object columns) in MB
+    '''
+
+    return dataframe.memory_usage(deep=True).sum() / 2**20
 
-def get_dhrm_dataframe(monthly_employee_data_path):
+
+def get_dhrm_dataframe(monthly_employee_data_path, cache_dir=None, columns=DHRM_COLUMNS):
     '''Read and process monthly DHRM employee data dump.
 
     Creates real_addr/real_zip field with mailing address/zip if provided, physical address/zip otherwise.
-    Creates EINint field by converting EIN to int, ignoring any errors
+    Creates EINint field by converting EIN to a nullable Int32, with <NA> for malformed EINs (see ein_index).
+
+    By default only DHRM_COLUMNS are kept and the frame is typed to save memory: the address and zip columns real_addr
+    and real_zip are built from are dropped, as is the raw EIN, and the department and zip become categoricals. Any
+    other columns asked for are kept as read. The frame's memory footprint before and after is printed.
+
+    If cache_dir is given, the processed frame is cached there as Parquet keyed on a hash of the xls's contents, so
+    later runs on the same file skip the Excel parse and a new or changed file is re-read automatically. Parquet keeps
+    the categoricals and the nullable EINint; a frame Parquet can't store (ie, an untyped columns=None frame with
+    numbers and text mixed in one column) just isn't cached.
 
     Args:
         monthly_employee_data_path (Path): xls file from DHRM
+        cache_dir (Path, optional): Directory to cache the processed frame in. Defaults to None (no caching).
+        columns (tuple, optional): DHRM columns to load, or None for every column (and no typing). Defaults to
+            DHRM_COLUMNS.
 
     Returns:
         DataFrame: DHRM data with real_addr, real_zip, and EINint fields added.
     '''
+
+    cache_path = None
+    if cache_dir is not None:
+        content_hash = file_digest(monthly_employee_data_path)
+        columns_hash = hash_parts(*columns)[:8] if columns is not None else 'all'
+        cache_path = Path(cache_dir) / f'dhrm_v{DHRM_CACHE_VERSION}_{columns_hash}_{content_hash}.parquet'
+        if cache_path.exists():
+            print(f'\nLoading cached DHRM employee data {cache_path}...')
+            return pd.read_parquet(cache_path)
+
     print(f'\nReading DHRM employee data {monthly_employee_data_path}...')
-    monthly_df = pd.read_excel(monthly_employee_data_path)
-    #: Use different row for header
-    monthly_df.columns = monthly_df.iloc[0]
-    #: Drop old header row
-    monthly_df = monthly_df.drop(monthly_df.index[0])
-    #: Drop "Page" row at bottom
+    #: The real header is the second row; the last row is a "Page" footer
+    monthly_df = pd.read_excel(
+        monthly_employee_data_path,
+        header=1,
+        usecols=(lambda name: name in columns) if columns is not None else None,
+        dtype=object,
+    )
     monthly_df = monthly_df.drop(monthly_df.index[-1])
+    read_megabytes = frame_megabytes(monthly_df)
     #: Use physical addr if available, otherwise stick with mailing (improves geocode by 1% :shrug:)
     monthly_df['real_addr'] = np.where(
         monthly_df['physical_address_line1'].isnull(), monthly_df['mailing_address_line1'],
@@ -143,70 +327,226 @@ def get_dhrm_dataframe(monthly_employee_data_path):
         monthly_df['Empl Physical ZIP'].isnull(), monthly_df['Empl Mail ZIP'].str.strip().str.slice(stop=5),
         monthly_df['Empl Physical ZIP'].str.strip().str.slice(stop=5)
     )
-    #: Convert EINs to ints
-    monthly_df['EINint'] = monthly_df['EIN'].astype(int, errors='ignore')
+    #: Convert EINs to ints; astype(int, errors='ignore') left the whole column as objects if any EIN was bad
+    monthly_df['EINint'] = normalize_eins(monthly_df['EIN'])
+    invalid_count = int(monthly_df['EINint'].isna().sum())
+    if invalid_count:
+        print(f'{invalid_count} employee records have a malformed EIN')
+
+    if columns is not None:
+        built_from = [column for column in DHRM_COLUMNS if column != 'DEPT_NAME' and column in monthly_df.columns]
+        monthly_df = monthly_df.drop(columns=built_from)
+        for column in ['DEPT_NAME', 'real_zip']:
+            if column in monthly_df.columns:
+                monthly_df[column] = monthly_df[column].astype('category')
+        print(f'DHRM frame is {frame_megabytes(monthly_df):.1f} MB typed ({read_megabytes:.1f} MB as read)')
+
+    if cache_path is not None:
+        print(f'Caching processed DHRM data to {cache_path}...')
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        #: Only one month's dump is worth keeping around (this also clears out caches from older versions)
+        for old_cache in cache_path.parent.glob('dhrm_*'):
+            old_cache.unlink()
+        temp_path = cache_path.with_suffix('.tmp')
+        try:
+            monthly_df.to_parquet(temp_path)
+        except (TypeError, ValueError) as error:
+            #: pyarrow's ArrowTypeError and ArrowInvalid
+            print(f'Not caching DHRM data, it can\'t be stored as Parquet: {error}')
+            temp_path.unlink(missing_ok=True)
+        else:
+            temp_path.replace(cache_path)
 
     return monthly_df
 
 
-def geocode_points(points_csv, out_fc, locator, addr_field, zip_field):
+def geocode_points(
+    points_csv, out_fc, locator, addr_field, zip_field, cache=None, shard_dir=None, shard_size=1000, max_workers=4
+):
     '''Geocode the points_csv, only saving the points that have a valid match to out_fc
 
+    Each unique address (after normalizing) is only geocoded once. Addresses missing from cache are split into shards
+    and geocoded in parallel (see geocoders.geocode_in_shards), then all the matched rows are written to out_fc with the
+    same USER_ field prefix that GeocodeAddresses gives them.
+
     Args:
         points_csv (str): The csv holding the points
         out_fc (str): The feature class to save the geocoded points
-        locator (str): The full path to the geolocator to use
+        locator (str or Geocoder): The full path to the geolocator to use, or a Geocoder (ie, a StubGeocoder)
         addr_field (str): The address field in points_csv
         zip_field (str): The zip code field in points_csv
+        cache (GeocodeCache, optional): Only send addresses missing from this cache to the locator. Defaults to None
+            (geocode every address).
+        shard_dir (Path, optional): Directory for per-shard results. Defaults to None (a folder next to points_csv).
+        shard_size (int, optional): Maximum addresses per shard. Defaults to 1000.
+        max_workers (int, optional): Number of shards to geocode at once. Defaults to 4.
+
+    Returns:
+        int: Number of matched points written to out_fc
+
+    Raises:
+        ValueError: If the cached and new coordinates are in different spatial references
     '''
 
-    #: using 'memory' seems to limit the geocode to 1000, use 'in_memory' instead.
-    geocode_fc = r'in_memory\temp_geocode_fc'
+    points_csv = Path(points_csv)
+    shard_dir = Path(shard_dir) if shard_dir is not None else points_csv.with_name('geocode_shards')
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    geocoder = locator if isinstance(locator, Geocoder) else LocatorGeocoder(locator, shard_dir)
+
+    points_df = pd.read_csv(points_csv, index_col=0, dtype={addr_field: str, zip_field: str})
+    points_df['cache_key'] = normalize_address_keys(points_df[addr_field], points_df[zip_field])
+    results_df = cache.lookup(points_df['cache_key'], geocoder.cache_id) if cache is not None else pd.DataFrame(
+        columns=['key', 'status', 'x', 'y', 'wkid']
+    )
 
-    if arcpy.Exists(geocode_fc):
-        arcpy.management.Delete(geocode_fc)
+    misses_df = points_df[~points_df['cache_key'].isin(results_df['key'])].drop_duplicates('cache_key')
+    print(f'\n{len(results_df)} addresses found in geocode cache, geocoding {len(misses_df)} new or stale addresses...')
 
-    fields_str = f"'Address or Place' {addr_field} VISIBLE NONE;Address2 <None> VISIBLE NONE;Address3 <None> VISIBLE NONE;Neighborhood <None> VISIBLE NONE;City <None> VISIBLE NONE;County <None> VISIBLE NONE;State <None> VISIBLE NONE;ZIP {zip_field} VISIBLE NONE;ZIP4 <None> VISIBLE NONE;Country <None> VISIBLE NONE"
-    print(f'\nGeocoding {points_csv} (this could take a while)...')
-    geocode_results = arcpy.geocoding.GeocodeAddresses(points_csv, locator, fields_str, geocode_fc)
+    if not misses_df.empty:
+        new_results_df, wkid = geocode_in_shards(
+            misses_df, geocoder, shard_dir, addr_field, zip_field, shard_size=shard_size, max_workers=max_workers
+        )
+        if cache is not None:
+            cache.store(new_results_df, wkid, geocoder.cache_id)
+        new_results_df['wkid'] = wkid
+        results_df = pd.concat([results_df, new_results_df], ignore_index=True)
+        clear_shards(shard_dir)
 
-    print(geocode_results.getMessages())
+    if cache is not None:
+        print(cache.stats())
 
     print('Copying out only the matched points...')
-    query = "Status = 'M'"
+    matched_df = points_df.merge(results_df[results_df['status'] == 'M'], left_on='cache_key', right_on='key')
+    matched_df = matched_df.drop(columns=['cache_key', 'key', 'status', 'wkid'])
+    matched_df.columns = [f'USER_{column}' if column not in ['x', 'y'] else column.upper() for column in matched_df]
+    matched_df['Status'] = 'M'
+    matched_csv = points_csv.with_name('geocode_matches.csv')
+    matched_df.to_csv(matched_csv, index=False)
 
-    if arcpy.Exists(geocode_fc):
-        arcpy.management.Delete('geocode_layer')
+    #: Cache entries are per locator, so this only fails if the locator's spatial reference changed under a cache entry
+    if results_df['wkid'].nunique() > 1:
+        raise ValueError(f'Geocoded points are in more than one spatial reference: {results_df["wkid"].unique()}')
+    wkid = int(results_df['wkid'].iloc[0]) if not results_df.empty else 4326
+    arcpy.management.XYTableToPoint(str(matched_csv), out_fc, 'X', 'Y', coordinate_system=arcpy.SpatialReference(wkid))
 
-    arcpy.management.MakeFeatureLayer(geocode_fc, 'geocode_layer', query)
-    arcpy.management.CopyFeatures('geocode_layer', out_fc)
+    return len(matched_df)
 
 
-def get_operator_eins(operators_path, monthly_dhrm_data, output_csv_path):
-    '''Read and process approved operator data
+def get_operator_eins(operators_path, monthly_dhrm_data, output_csv_path=None, ein_index=None):
+    '''Read and process approved operator data, optionally saving the matching employee records to a csv
 
     Args:
         operators_path (Path): xlsx of approved operators from Fleet
         monthly_dhrm_data (DataFrame): Monthly DHRM data
-        out_path (Path): output csv file
+        output_csv_path (Path, optional): output csv file. Defaults to None (don't save).
+        ein_index (EINIndex, optional): Index of monthly_dhrm_data's EINint column. Defaults to None (build one).
+
+    Returns:
+        DataFrame: The employee records merged with their approved operator records
     '''
     print(f'\nReading approved operator data {operators_path}...')
     operators_df = pd.read_excel(operators_path, engine='openpyxl')
-    cleaned_operators = operators_df[(operators_df['EIN'] >= 100000) & (operators_df['EIN'] <= 999999)]
-    op_merged = pd.merge(monthly_dhrm_data, cleaned_operators, how='inner', left_on='EINint', right_on='EIN')
+
+    #: Inner join on EIN through the index; shared column names get pd.merge's _x/_y suffixes
+    ein_index = ein_index or EINIndex(monthly_dhrm_data['EINint'])
+    dhrm_rows, operator_rows, stats = ein_index.pairs(operators_df['EIN'], 'approved operators', min_value=100000)
+    print(stats)
+    shared_columns = monthly_dhrm_data.columns.intersection(operators_df.columns)
+    employee_part = monthly_dhrm_data.iloc[dhrm_rows].reset_index(drop=True)
+    operator_part = operators_df.iloc[operator_rows].reset_index(drop=True)
+    op_merged = pd.concat([
+        employee_part.rename(columns={name: f'{name}_x' for name in shared_columns}),
+        operator_part.rename(columns={name: f'{name}_y' for name in shared_columns}),
+    ], axis=1)
+    if output_csv_path is not None:
+        print(f'Saving output data to {output_csv_path}...')
+        op_merged.to_csv(output_csv_path)
+
+    return op_merged
+
+
+def get_method_records(specific_infos, monthly_dhrm_data, output_csv_path, cache_dir=None):
+    '''Flag which methods each employee record belongs to and save the records used by any of them to a csv
+
+    Adds an in_<method> column (1 or 0) per method so the union of all the methods' employees can be geocoded once and
+    split back out afterwards.
+
+    Args:
+        specific_infos (list[SpecificInfo]): The methods being run
+        monthly_dhrm_data (DataFrame): Monthly DHRM data
+        output_csv_path (Path): output csv file
+        cache_dir (Path, optional): Directory to cache parsed source data in. Defaults to None (no caching).
+
+    Raises:
+        NotImplementedError: If a method other than 'wfh' or 'operator' is provided
+
+    Returns:
+        DataFrame: The flagged employee records that were saved
+    '''
+
+    #: Every method's source list is matched against the same index
+    ein_index = EINIndex(monthly_dhrm_data['EINint'])
+    index_summary = f'{ein_index.duplicates} duplicates, {ein_index.invalid} invalid'
+    print(f'\nIndexed {len(ein_index.eins)} employee EINs ({index_summary})')
+    flags = {}
+    for specific_info in specific_infos:
+        if specific_info.method == 'wfh':
+            method_records = get_wfh_eins(
+                specific_info.data_source, monthly_dhrm_data, cache_dir=cache_dir, ein_index=ein_index
+            )
+        elif specific_info.method == 'operator':
+            method_records = get_operator_eins(specific_info.data_source, monthly_dhrm_data, ein_index=ein_index)
+        else:
+            raise NotImplementedError(f'Method {specific_info.method} not recognized...')
+        flags[f'in_{specific_info.method}'] = monthly_dhrm_data['EINint'].isin(method_records['EINint']).astype('int8')
+
+    flagged_records = monthly_dhrm_data.assign(**flags)
+    union_records = flagged_records[flagged_records[list(flags)].any(axis=1)]
+    print(f'\n{union_records.shape[0]} employee records used by {", ".join(flags)}')
+
+    #: Only what geocoding, selecting each method's points, and binning need
+    union_records = union_records[GEOCODE_COLUMNS + list(flags)]
     print(f'Saving output data to {output_csv_path}...')
-    op_merged.to_csv(output_csv_path)
+    union_records.to_csv(output_csv_path)
+
+    return union_records
+
 
+def select_method_points(points_fc, method, output_fc):
+    '''Copy the geocoded points flagged for method (see get_method_records) to a new feature class
 
-def hex_bin(points_fc, hex_fc, output_fc, simple_count=True, within_table=None):
+    Args:
+        points_fc (str): All the geocoded points
+        method (str): 'wfh' or 'operator'
+        output_fc (str): Output path for the method's points
+    '''
+
+    query = f'USER_in_{method} = 1'
+    arcpy.management.MakeFeatureLayer(points_fc, 'method_layer', query)
+    arcpy.management.CopyFeatures('method_layer', output_fc)
+    arcpy.management.Delete('method_layer')
+
+
+def hex_bin(
+    points_fc, hex_fc, output_fc, simple_count=True, within_table=None, engine='numpy', hex_index_dir=None
+):
     '''Bin points_fc into hexes from hex_fc, adding total category counts if needed
 
+    The numpy engine needs hex_fc to be a regular hexagon grid. If it isn't (ie, the hexes were clipped to a boundary),
+    a warning is printed and the points are binned with SummarizeWithin instead.
+
     Args:
         points_fc (str): Path to points feature class
         hex_fc (str): Path to hexes to use for binning
         output_fc (str): Location of final output
         simple_count (bool, optional): Just bin (default) or both bin and add category counts. Defaults to True.
         within_table (str, optional): Output table for bin grouping if simple_count=False. Defaults to None.
+        engine (str, optional): 'numpy' (default) to bin with hex_engine or 'summarize' to use SummarizeWithin.
+        hex_index_dir (Path, optional): Where to keep the precomputed hex index for the numpy engine. Defaults to None
+            (build it in memory every time).
+
+    Raises:
+        NotImplementedError: If engine is not 'numpy' or 'summarize'
     '''
 
     print('Summarizing...')
@@ -215,6 +555,16 @@ def hex_bin(points_fc, hex_fc, output_fc, simple_count=True, within_table=None):
     print(arcpy.management.GetCount(points_fc))
     print(arcpy.management.GetCount(hex_fc))
 
+    if engine == 'numpy':
+        #: The hex grid is checked before anything is written, so a failure here leaves no partial output_fc behind
+        try:
+            numpy_hex_bin(points_fc, hex_fc, output_fc, simple_count, hex_index_dir)
+            return
+        except ValueError as error:
+            print(f'WARNING: {hex_fc} can\'t be binned by the numpy engine ({error}), falling back to SummarizeWithin')
+    elif engine != 'summarize':
+        raise NotImplementedError(f'Hex binning engine {engine} not recognized...')
+
     #: Run a simple summarize and return if groupings aren't needed
     if simple_count:
         arcpy.analysis.SummarizeWithin(hex_fc, points_fc, output_fc, keep_all_polygons='ONLY_INTERSECTING')
@@ -231,51 +581,249 @@ def hex_bin(points_fc, hex_fc, output_fc, simple_count=True, within_table=None):
     )
 
     print('Joining...')
-    #: Get our table into a dataframe we can play with
-    grouped_table_dict = {}
-    with arcpy.da.SearchCursor(within_table, '*') as table_cursor:
-        grouped_table_dict = {row[0]: row[1:] for row in table_cursor}
+    #: The group table's first three non-ObjectID fields are the join id, department, and count
+    group_fields = [table_field.name for table_field in arcpy.ListFields(within_table) if table_field.type != 'OID'][:3]
+    groups = arcpy.da.TableToNumPyArray(within_table, group_fields, null_value={group_fields[1]: 'Unknown'})
+    join_ids, departments, count_matrix = department_count_matrix(
+        groups[group_fields[0]], groups[group_fields[1]], groups[group_fields[2]]
+    )
 
-    groups_df = pd.DataFrame.from_dict(grouped_table_dict, orient='index', columns=['JoinID', 'Dept', 'Count'])
-    all_departments = groups_df['Dept'].unique()
+    print('Writing output data...')
+    reserved = [output_field.name for output_field in arcpy.ListFields(output_fc)]
+    write_department_counts(output_fc, join_ids, department_field_names(departments, reserved), count_matrix)
 
-    #: pivot so each row is now a unique join id and the columns are the counts of each department's count value
-    joins = pd.pivot(data=groups_df, values='Count', index='JoinID', columns=['Dept'])
-    joins.fillna(0, inplace=True)
 
-    #: dump our dataframe to a dict we can use in an insert cursor
-    #: {joinid: {dept1:count, dept2:count}}
-    joins_dict = joins.to_dict('index')
+def department_field_names(departments, reserved=()):
+    '''Get a unique, valid field name for each department
 
-    #: prep output feature class
-    new_fields = [[name, 'LONG'] for name in all_departments]
-    arcpy.management.AddFields(output_fc, new_fields)
+    Departments whose names collide after clean_field_name (ie, 'Parks & Rec' and 'Parks - Rec'), or with an existing
+    field, get _2, _3, etc. added.
 
-    print('Writing output data...')
-    #: Write our new data to the output feature class
-    insert_fields = ['Join_ID']
-    insert_fields.extend([clean_field_name(name) for name in all_departments])
-    with arcpy.da.UpdateCursor(output_fc, insert_fields) as updater:
+    Args:
+        departments (list): Department names, in output order
+        reserved (list, optional): Field names already in use. Defaults to ().
+
+    Returns:
+        list: Field name for each department, in the same order
+    '''
+
+    used = {name.lower() for name in reserved}
+    field_names = []
+    for department in departments:
+        base_name = clean_field_name(str(department))
+        field_name = base_name
+        suffix = 2
+        #: Field names are case insensitive in a gdb
+        while field_name.lower() in used:
+            field_name = f'{base_name}_{suffix}'
+            suffix += 1
+        used.add(field_name.lower())
+        field_names.append(field_name)
+    return field_names
+
+
+def department_count_matrix(join_ids, departments, counts):
+    '''Pivot long (join id, department, count) rows into a join id x department count matrix
+
+    Args:
+        join_ids (array-like): Hex join id of each row
+        departments (array-like): Department of each row
+        counts (array-like): Points of that department in that hex
+
+    Returns:
+        (np.ndarray, list, np.ndarray): The sorted unique join ids, the sorted unique departments, and an int64 matrix
+            with a row per join id and a column per department (0 where a hex has none of a department)
+    '''
+
+    join_index, unique_join_ids = pd.factorize(np.asarray(join_ids), sort=True)
+    department_index, unique_departments = pd.factorize(np.asarray(departments), sort=True)
+
+    #: One bincount over the flattened matrix adds up every row, including repeated (join id, department) pairs
+    count_matrix = np.bincount(
+        join_index * len(unique_departments) + department_index,
+        weights=np.asarray(counts, dtype=np.float64),
+        minlength=len(unique_join_ids) * len(unique_departments),
+    ).astype(np.int64).reshape(len(unique_join_ids), len(unique_departments))
+
+    return np.asarray(unique_join_ids), list(unique_departments), count_matrix
+
+
+def department_update_rows(join_ids, count_matrix):
+    '''Get {join id: [join id, count, count, ...]} rows ready for an UpdateCursor on Join_ID plus the count fields
+    '''
+
+    return {join_id: [join_id] + counts for join_id, counts in zip(join_ids.tolist(), count_matrix.tolist())}
+
+
+def write_department_counts(output_fc, join_ids, field_names, count_matrix):
+    '''Add a LONG field per department to output_fc and fill it from the count matrix, matching rows on Join_ID
+
+    Args:
+        output_fc (str): The hexes, with a Join_ID field
+        join_ids (np.ndarray): Join id of each row of count_matrix
+        field_names (list): Field name of each column of count_matrix (see department_field_names)
+        count_matrix (np.ndarray): Join id x department counts (see department_count_matrix)
+    '''
+
+    arcpy.management.AddFields(output_fc, [[name, 'LONG'] for name in field_names])
+
+    rows = department_update_rows(join_ids, count_matrix)
+    empty_counts = [0] * len(field_names)
+    with arcpy.da.UpdateCursor(output_fc, ['Join_ID'] + field_names) as updater:
         for row in updater:
-            join_id = row[0]
-            new_list = [join_id]
-            for department in all_departments:
-                new_list.append(joins_dict[join_id][department])
-            row = new_list
-            updater.updateRow(row)
+            updater.updateRow(rows.get(row[0]) or [row[0]] + empty_counts)
+
+
+def load_hex_index(hex_fc, index_dir=None):
+    '''Get the precomputed hex_engine.HexIndex for hex_fc, building (and saving) it if it's missing or hex_fc changed
+
+    Args:
+        hex_fc (str): Path to the hexes. Must be a regular hexagon grid (ie, from GenerateTessellation).
+        index_dir (Path, optional): Where the index is kept. Defaults to None (build it without saving).
+
+    Returns:
+        hex_engine.HexIndex: The index, memory-mapped from index_dir if it was already built
+    '''
+
+    source = feature_class_fingerprint(hex_fc)
+    if index_dir is not None:
+        hex_index = hex_engine.HexIndex.load(index_dir)
+        if hex_index is not None and hex_index.source == source:
+            return hex_index
+
+    #: The only full read of the polygons; later runs just memory-map the arrays
+    print('Indexing hex grid...')
+    with arcpy.da.SearchCursor(hex_fc, ['OID@', 'SHAPE@X', 'SHAPE@Y', 'SHAPE@']) as hex_cursor:
+        hexes = np.array([(hex_id, x, y, shape.extent.XMin, shape.extent.YMin, shape.extent.XMax, shape.extent.YMax)
+                          for hex_id, x, y, shape in hex_cursor])
+    hex_index = hex_engine.HexIndex.build(hexes[:, 0].astype(np.int64), hexes[:, 1], hexes[:, 2], hexes[:, 3:], source)
+    if index_dir is not None:
+        hex_index.save(index_dir)
+    return hex_index
+
+
+def numpy_hex_bin(points_fc, hex_fc, output_fc, simple_count=True, hex_index_dir=None):
+    '''Bin points_fc into hexes from hex_fc with hex_engine's closed-form hex math instead of a polygon overlay
+
+    Writes the same Point_Count (and, if simple_count is False, Join_ID and per-department count) fields as the
+    SummarizeWithin path. Points are assigned to hexes through the precomputed hex index, so only the polygons of the
+    hexes that actually have points are read.
+
+    Args:
+        points_fc (str): Path to points feature class
+        hex_fc (str): Path to hexes to use for binning. Must be a regular hexagon grid (ie, from GenerateTessellation).
+        output_fc (str): Location of final output
+        simple_count (bool, optional): Just bin (default) or both bin and add category counts. Defaults to True.
+        hex_index_dir (Path, optional): Where to keep the hex index. Defaults to None (build it in memory).
+    '''
+
+    hex_description = arcpy.Describe(hex_fc)
+    oid_field = hex_description.OIDFieldName
+    hex_index = load_hex_index(hex_fc, hex_index_dir)
+
+    print('Binning points...')
+    point_fields = ['SHAPE@X', 'SHAPE@Y']
+    if not simple_count:
+        point_fields.append('USER_DEPT_NAME')
+    points = arcpy.da.FeatureClassToNumPyArray(
+        points_fc,
+        point_fields,
+        spatial_reference=hex_description.spatialReference,
+        null_value={'USER_DEPT_NAME': 'Unknown'} if not simple_count else None
+    )
+    groups = None if simple_count else points['USER_DEPT_NAME']
+    counts = hex_index.bin_points(points['SHAPE@X'], points['SHAPE@Y'], groups)
+    print(f'{counts["Point_Count"].sum()} points binned into {len(counts)} hexes')
+
+    print('Writing output data...')
+    #: Output has the same schema as the hexes plus our count fields
+    out_path, out_name = split(output_fc)
+    arcpy.management.CreateFeatureclass(
+        out_path, out_name, 'POLYGON', template=hex_fc, spatial_reference=hex_description.spatialReference
+    )
+    template_fields = [
+        hex_field.name for hex_field in arcpy.ListFields(hex_fc)
+        if hex_field.editable and hex_field.type not in ['OID', 'Geometry']
+    ]
+    departments = list(counts.columns[1:])
+    count_fields = ['Point_Count'] if simple_count else ['Join_ID', 'Point_Count']
+    count_fields.extend(department_field_names(departments, template_fields + count_fields))
+    arcpy.management.AddFields(output_fc, [[name, 'LONG'] for name in count_fields])
+
+    count_rows = dict(zip(counts.index.tolist(), counts.to_numpy().tolist()))
+    if not count_rows:
+        return
+    where_clause = f'{oid_field} IN ({", ".join(str(hex_id) for hex_id in count_rows)})'
+    with arcpy.da.SearchCursor(hex_fc, ['OID@', 'SHAPE@'] + template_fields, where_clause) as hex_cursor, \
+        arcpy.da.InsertCursor(output_fc, ['SHAPE@'] + template_fields + count_fields) as inserter:
+        for hex_id, shape, *attributes in hex_cursor:
+            join_id = [] if simple_count else [hex_id]
+            inserter.insertRow([shape] + attributes + join_id + count_rows[hex_id])
 
 
 def remove_single_count_hexes(input_hex_fc, output_hex_fc):
     '''Create a new feature class with hexes that only have 2 or more points
 
+    The count is applied as a where clause on the one write to output_hex_fc instead of through a feature layer and a
+    copy, which also means no 'hex_layer' is left behind to collide with the next method's trim.
+
     Args:
         input_hex_fc (str): The hexagons with point counts
         output_hex_fc (str): Output path for trimmed data
     '''
 
-    query = "Point_Count > 1"
-    arcpy.management.MakeFeatureLayer(input_hex_fc, 'hex_layer', query)
-    arcpy.management.CopyFeatures('hex_layer', output_hex_fc)
+    out_path, out_name = split(output_hex_fc)
+    arcpy.conversion.FeatureClassToFeatureClass(input_hex_fc, out_path, out_name, where_clause='Point_Count > 1')
+
+
+def rollup_hexes(input_hex_fc, hex_fc, grid, output_fcs):
+    '''Roll the binned hexes' counts up to coarser hex resolutions, writing a trimmed (Point_Count > 1) feature class
+    for each one
+
+    Only the binned hexes are read, so the points aren't binned again. Each coarser hex gets the counts of the finer
+    hexes whose centers it holds (see hex_engine.rollup_levels), so its counts can differ a little from binning the
+    points into it directly.
+
+    Args:
+        input_hex_fc (str): The untrimmed hexes with point counts (and department counts)
+        hex_fc (str): The hexes input_hex_fc was binned into
+        grid (hex_engine.HexGrid): The grid of hex_fc
+        output_fcs (dict): {factor: output path} with each resolution's hex size as a multiple of the base hexes'
+
+    Returns:
+        dict: {factor: number of hexes written}
+    '''
+
+    #: Count fields are whatever binning added to the hexes' own fields
+    hex_fields = {hex_field.name for hex_field in arcpy.ListFields(hex_fc)}
+    count_fields = [
+        count_field.name for count_field in arcpy.ListFields(input_hex_fc)
+        if count_field.type in ['Integer', 'SmallInteger', 'Double'] and count_field.name not in hex_fields and
+        count_field.name != 'Join_ID'
+    ]
+    hexes = arcpy.da.FeatureClassToNumPyArray(input_hex_fc, ['SHAPE@X', 'SHAPE@Y'] + count_fields, null_value=0)
+    counts = pd.DataFrame(
+        {name: hexes[name] for name in count_fields}, index=grid.keys(hexes['SHAPE@X'], hexes['SHAPE@Y'])
+    ).groupby(level=0).sum()
+
+    spatial_reference = arcpy.Describe(input_hex_fc).spatialReference
+    written = {}
+    for factor, (level_grid, level_counts) in hex_engine.rollup_levels(grid, counts, list(output_fcs)).items():
+        level_counts = level_counts[level_counts['Point_Count'] > 1]
+        output_fc = str(output_fcs[factor])
+        out_path, out_name = split(output_fc)
+        arcpy.management.CreateFeatureclass(out_path, out_name, 'POLYGON', spatial_reference=spatial_reference)
+        arcpy.management.AddFields(output_fc, [[name, 'LONG'] for name in ['Join_ID'] + count_fields])
+
+        corners = level_grid.vertices(*hex_engine.unpack_key(level_counts.index.to_numpy()))
+        with arcpy.da.InsertCursor(output_fc, ['SHAPE@', 'Join_ID'] + count_fields) as inserter:
+            for join_id, (hex_corners, row) in enumerate(zip(corners, level_counts.to_numpy().tolist()), start=1):
+                ring = arcpy.Array([arcpy.Point(*corner) for corner in hex_corners])
+                inserter.insertRow([arcpy.Polygon(ring, spatial_reference), join_id] + row)
+        written[factor] = len(level_counts)
+        print(f'{output_fc}: {len(level_counts)} hexes at {factor}x')
+
+    return written
 
 
 def symbolize_new_layer(new_data, template_layer, output_layer_file):
@@ -323,16 +871,58 @@ def add_layer_to_map(project_path, map_name, feature_class_path):
     return layer, sharing_map
 
 
-def update_agol_feature_service(sharing_map, layer, sd_item, feature_layer_item, specific_info):
-    '''Helper method for updating an AGOL hosted feature service from an ArcGIS Pro arcpy.mp.Map and .Layer objects.
+def get_item_information(feature_layer_item, description):
+    '''Get the item info (and thumbnail) that publishing overwrites so it can be reapplied afterwards
+
+    Only talks to AGOL, so it can run in a background thread while the service definition is staged. The thumbnail is
+    downloaded to its own temporary folder; call discard_thumbnail once it's been reapplied.
+
+    Args:
+        feature_layer_item (arcgis.Item): Target feature service AGOL item.
+        description (str): New description for the item
+
+    Returns:
+        (dict, str): Item properties to reapply and the path to the downloaded thumbnail (None if it has none)
+    '''
+
+    item_information = {
+        'title': feature_layer_item.title,
+        'tags': feature_layer_item.tags,
+        'snippet': feature_layer_item.snippet,
+        'description': description,
+        'accessInformation': feature_layer_item.accessInformation
+    }
+    #: Thumbnails usually share a file name (ie, thumbnail.png), so in one shared folder they'd overwrite each other
+    save_folder = tempfile.mkdtemp(prefix=f'{feature_layer_item.id}_')
+    thumbnail = feature_layer_item.download_thumbnail(save_folder=save_folder)
+    if thumbnail is None:
+        shutil.rmtree(save_folder, ignore_errors=True)
+    return item_information, thumbnail
+
+
+def discard_thumbnail(thumbnail):
+    '''Delete a thumbnail from get_item_information along with its temporary folder
+
+    Args:
+        thumbnail (str): Path to the thumbnail, or None
+    '''
+
+    if thumbnail is not None:
+        shutil.rmtree(Path(thumbnail).parent, ignore_errors=True)
+
+
+def stage_service_definition(sharing_map, layer, specific_info):
+    '''Draft and stage a service definition for specific_info's feature service from an ArcGIS Pro arcpy.mp.Map and
+    .Layer objects.
 
     Args:
         sharing_map (arcpy.mp.Map): Map object containing the layer to be shared.
         layer (arcpy.mp.Layer): Layer object created from the feature class that holds your new data.
-        sd_item (arcgis.Item): Service definition item on AGOL originally used to publish the hosted feature service.
-        feature_layer_item (arcgis.Item): Target feature service AGOL item.
         specific_info (SpecificInfo): Information about this particular run. NOTE: specific_info.fs_name must match the
             existing feature service name exactly or the update will fail.
+
+    Returns:
+        str: Path to the staged .sd file
     '''
 
     sddraft_path = join(arcpy.env.scratchFolder, f'{specific_info.fs_name.replace(" ", "_")}.sddraft')
@@ -342,30 +932,57 @@ def update_agol_feature_service(sharing_map, layer, sd_item, feature_layer_item,
             print(f'Deleting {item} prior to use...')
             arcpy.Delete_management(item)
 
-    #: Get item info that can get overwritten
-    item_information = {
-        'title': feature_layer_item.title,
-        'tags': feature_layer_item.tags,
-        'snippet': feature_layer_item.snippet,
-        'description': specific_info.description,
-        'accessInformation': feature_layer_item.accessInformation
-    }
-    thumbnail = feature_layer_item.download_thumbnail()
-
     print(f'Creating SD for {specific_info.fs_name}...')
     sharing_draft = sharing_map.getWebLayerSharingDraft('HOSTING_SERVER', 'FEATURE', specific_info.fs_name, [layer])
     sharing_draft.exportToSDDraft(sddraft_path)
     arcpy.server.StageService(sddraft_path, sd_path)
-    print(f'Updating service definition...')
+
+    return sd_path
+
+
+def publish_service_definition(sd_path, sd_item, feature_layer_item, item_information, thumbnail):
+    '''Upload and publish a staged service definition, then reapply the item info that publishing breaks
+
+    Only talks to AGOL (no arcpy), so several services can be published at once from separate threads.
+
+    Args:
+        sd_path (str): Path to the staged .sd file
+        sd_item (arcgis.Item): Service definition item on AGOL originally used to publish the hosted feature service.
+        feature_layer_item (arcgis.Item): Target feature service AGOL item.
+        item_information (dict): Item properties to reapply (from get_item_information)
+        thumbnail (str): Path to the thumbnail to reapply (from get_item_information)
+    '''
+
+    print(f'Updating service definition {sd_item.title}...')
     sd_item.update(data=sd_path)
-    print(f'Publishing service definition...')
+    print(f'Publishing service definition {sd_item.title}...')
     sd_item.publish(overwrite=True)
 
     #: Reapply item info
-    print('Resetting all of the stuff that publishing breaks...')
+    print(f'Resetting all of the stuff that publishing breaks on {feature_layer_item.title}...')
     feature_layer_item.update(item_information, thumbnail=thumbnail)
 
 
+def update_agol_feature_service(sharing_map, layer, sd_item, feature_layer_item, specific_info):
+    '''Helper method for updating an AGOL hosted feature service from an ArcGIS Pro arcpy.mp.Map and .Layer objects.
+
+    Args:
+        sharing_map (arcpy.mp.Map): Map object containing the layer to be shared.
+        layer (arcpy.mp.Layer): Layer object created from the feature class that holds your new data.
+        sd_item (arcgis.Item): Service definition item on AGOL originally used to publish the hosted feature service.
+        feature_layer_item (arcgis.Item): Target feature service AGOL item.
+        specific_info (SpecificInfo): Information about this particular run. NOTE: specific_info.fs_name must match the
+            existing feature service name exactly or the update will fail.
+    '''
+
+    item_information, thumbnail = get_item_information(feature_layer_item, specific_info.description)
+    try:
+        sd_path = stage_service_definition(sharing_map, layer, specific_info)
+        publish_service_definition(sd_path, sd_item, feature_layer_item, item_information, thumbnail)
+    finally:
+        discard_thumbnail(thumbnail)
+
+
 def get_item(portal, username, item_id, password=None):
     '''Log into an arcgis portal and get the item referenced by item_id.
 
@@ -385,65 +1002,377 @@ def get_item(portal, username, item_id, password=None):
     return item
 
 
-def one_function_to_rule_them_all(common_info: CommonInfo, specific_info: SpecificInfo):
-    '''Calls all the previous functions in appropriate order
+def one_function_to_rule_them_all(common_info: CommonInfo, specific_info: SpecificInfo, force_from=None):
+    '''Calls all the previous functions in appropriate order for a single method
 
     Args:
         common_info (CommonInfo): Info common to all layers (wfh and operator)
         specific_info (SpecificInfo): Info specific to a particular layer (wfh or operator)
+        force_from (str, optional): Rerun this stage (see checkpoints.STAGES) and every later stage even if their
+            inputs haven't changed. Defaults to None.
+    '''
+
+    run_methods(common_info, [specific_info], force_from=force_from)
+
+
+def delete_existing(paths):
+    '''Delete any of paths that exist so a stage can recreate them
+
+    Args:
+        paths (list): Feature classes, tables, or files to delete
+    '''
+
+    for path in paths:
+        if arcpy.Exists(str(path)):
+            print(f'Deleting existing {path}...')
+            arcpy.management.Delete(str(path))
+
+
+def feature_class_fingerprint(fc_path):
+    '''Cheap stand-in for a content hash of a feature class that's too big to hash every run: its path, row count, and
+    extent
+
+    Args:
+        fc_path (str): Feature class to fingerprint
+
+    Returns:
+        str: Hex digest
+    '''
+
+    return hash_parts(fc_path, arcpy.management.GetCount(fc_path)[0], arcpy.Describe(fc_path).extent.JSON)
+
+
+def run_methods(common_info: CommonInfo, specific_infos, recorder=None, force_from=None):
+    '''Calls all the previous functions in appropriate order for one or more methods in a single process
+
+    The login, scratch gdb, DHRM load, and geocoding are done once for all the methods' employees; only the binning
+    and publishing are done per method. Each step's wall time, CPU time, peak memory, and row count are printed as JSON
+    as it finishes and summarized at the end (see instrumentation.py for profiling a step).
+
+    The scratch gdb is kept between runs and each stage's outputs are checkpointed with a hash of their inputs (see
+    checkpoints.py), so a rerun skips every stage whose inputs haven't changed and resumes at the first one that has.
+    With common_info.intermediate_workspace='memory', the geocoded points, each method's points, and the untrimmed hexes
+    only live in the memory workspace for this run, so their stages always rerun; the trimmed and rolled-up hexes are
+    still written to (and reused from) the scratch gdb.
+    A layer is only published if its trimmed hexes are different from what was last published (see fingerprints.py).
+
+    Args:
+        common_info (CommonInfo): Info common to all layers (wfh and operator)
+        specific_infos (list[SpecificInfo]): Info specific to each layer to update (wfh and/or operator)
+        recorder (StageRecorder, optional): Recorder for the step metrics. Defaults to None (a new one that prints).
+        force_from (str, optional): Rerun this stage (see checkpoints.STAGES) and every later stage even if their
+            inputs haven't changed. Defaults to None.
 
     Raises:
         NotImplementedError: If a method other than 'wfh' or 'operator' is provided
     '''
 
+    recorder = recorder or StageRecorder()
+    checkpoints = CheckpointStore(common_info.checkpoint_path, force_from, exists=arcpy.Exists)
+
     print('Getting AGOL references...')
     password = getpass('Enter Password: ')
-    gis = arcgis.gis.GIS(common_info.portal, common_info.username, password)
-    sd_item = gis.content.get(specific_info.sd_itemid)
-    fs_item = gis.content.get(specific_info.fs_itemid)
-
-    #: Because Pro signs itself out randomly...
-    arcpy.SignInToPortal(arcpy.GetActivePortalURL(), common_info.username, password)
-
-    print('Cleaning up scratch areas...')
-    if arcpy.Exists(str(common_info.scratch_gdb)):
-        print(f'Deleting existing {common_info.scratch_gdb}...')
-        arcpy.management.Delete(str(common_info.scratch_gdb))
-    print(f'Creating {common_info.scratch_gdb}...')
-    arcpy.management.CreateFileGDB(str(common_info.scratch_gdb.parent), str(common_info.scratch_gdb.name))
-
-    dhrm_data = get_dhrm_dataframe(common_info.employee_data_path)
-
-    if specific_info.method == 'wfh':
-        get_wfh_eins(specific_info.data_source, dhrm_data, common_info.csv_path)
-    elif specific_info.method == 'operator':
-        get_operator_eins(specific_info.data_source, dhrm_data, common_info.csv_path)
-    else:
-        raise NotImplementedError(f'Method {specific_info.method} not recognized...')
-
-    geocode_points(
-        str(common_info.csv_path),
-        str(common_info.geocoded_points_path),
-        str(common_info.locator_path),
-        'real_addr',
-        'real_zip',
+    with recorder.stage('agol login'):
+        gis = arcgis.gis.GIS(common_info.portal, common_info.username, password)
+        items = {
+            layer_info.fs_itemid: (gis.content.get(layer_info.sd_itemid), gis.content.get(layer_info.fs_itemid))
+            for specific_info in specific_infos
+            for layer_info in specific_info.layers()
+        }
+
+        #: Because Pro signs itself out randomly...
+        arcpy.SignInToPortal(arcpy.GetActivePortalURL(), common_info.username, password)
+
+    if not arcpy.Exists(str(common_info.scratch_gdb)):
+        with recorder.stage('scratch gdb'):
+            print(f'Creating {common_info.scratch_gdb}...')
+            arcpy.management.CreateFileGDB(str(common_info.scratch_gdb.parent), str(common_info.scratch_gdb.name))
+
+    records_key = hash_parts(
+        DHRM_CACHE_VERSION,
+        file_digest(common_info.employee_data_path),
+        #: Sources can be whole folders of reports, so they're only checked by size and modification time
+        *[f'{info.method}|{tree_fingerprint(info.data_source)}' for info in specific_infos],
     )
+    if checkpoints.is_current('records', records_key, [common_info.csv_path]):
+        print(f'\nInputs unchanged, reusing {common_info.csv_path}...')
+    else:
+        checkpoints.invalidate('records')
+        with recorder.stage('dhrm') as record:
+            dhrm_data = get_dhrm_dataframe(common_info.employee_data_path, common_info.cache_dir)
+            record['rows'] = len(dhrm_data)
+
+        with recorder.stage('method records') as record:
+            record['rows'] = len(
+                get_method_records(specific_infos, dhrm_data, common_info.csv_path, common_info.cache_dir)
+            )
+        checkpoints.complete('records', records_key, file_digest(common_info.csv_path))
+
+    geocode_key = hash_parts(checkpoints.output_hash('records'), stat_fingerprint(common_info.locator_path))
+    if checkpoints.is_current('geocode', geocode_key, [common_info.geocoded_points_path]):
+        print(f'\nInputs unchanged, reusing {common_info.geocoded_points_path}...')
+    else:
+        checkpoints.invalidate('geocode')
+        with recorder.stage('geocode') as record:
+            delete_existing([common_info.geocoded_points_path])
+            geocode_cache = GeocodeCache(common_info.geocode_cache_path, common_info.geocode_cache_max_age)
+            print(f'Evicted {geocode_cache.evict_stale()} stale entries from {common_info.geocode_cache_path}')
+            record['rows'] = geocode_points(
+                str(common_info.csv_path),
+                str(common_info.geocoded_points_path),
+                str(common_info.locator_path),
+                'real_addr',
+                'real_zip',
+                cache=geocode_cache,
+                shard_dir=common_info.geocode_shard_dir,
+                shard_size=common_info.geocode_shard_size,
+                max_workers=common_info.geocode_workers,
+            )
+        checkpoints.complete('geocode', geocode_key, file_digest(common_info.geocode_matches_path))
+
+    #: Publishing is mostly waiting on AGOL, so each layer's upload/publish runs in the background while the next
+    #: layer is binned and staged (arcpy work stays on this thread). The item info publishing overwrites is fetched
+    #: up front for the first layers, one per worker; the later layers fetch theirs when they publish.
+    layer_infos = [layer_info for specific_info in specific_infos for layer_info in specific_info.layers()]
+    item_information = {}
+    try:
+        with ThreadPoolExecutor(max_workers=common_info.publish_workers) as executor:
+            for layer_info in layer_infos[:common_info.publish_workers]:
+                item_information[layer_info.fs_itemid] = executor.submit(
+                    get_item_information, items[layer_info.fs_itemid][1], layer_info.description
+                )
+            publishes = {}
+            for specific_info in specific_infos:
+                with recorder.stage(specific_info.method):
+                    publishes.update(
+                        bin_and_publish(
+                            common_info, specific_info, items, recorder, checkpoints, executor, item_information
+                        )
+                    )
+
+            #: Let every publish finish before raising the first failure so one bad service doesn't orphan the others
+            errors = {}
+            for layer_name, publish in publishes.items():
+                if publish is None:
+                    continue
+                try:
+                    publish.result()
+                except Exception as error:
+                    print(f'Publishing {layer_name} failed: {error}')
+                    errors[layer_name] = error
+    finally:
+        #: Layers that didn't publish (ie, unchanged hexes) never used their prefetched thumbnails
+        for future in item_information.values():
+            if future.done() and future.exception() is None:
+                discard_thumbnail(future.result()[1])
+
+    print(f'\n{recorder.summary()}')
+    if errors:
+        raise next(iter(errors.values()))
+
+
+def bin_and_publish(
+    common_info: CommonInfo,
+    specific_info: SpecificInfo,
+    items,
+    recorder=None,
+    checkpoints=None,
+    executor=None,
+    item_information=None,
+):
+    '''Bin a method's geocoded points into hexes, roll them up to its other resolutions, and publish each resolution to
+    its feature service
+
+    The select, bin, trim, and rollup stages are skipped if their checkpoints are current (see run_methods), and each
+    layer's publish is skipped if its hexes' contents match the last publish to its item (unless forced with
+    --force-from publish).
 
-    hex_bin(
-        str(common_info.geocoded_points_path),
-        str(common_info.hex_fc_path),
-        str(common_info.hexes_fc_path),
-        simple_count=specific_info.simple_summary,
-        within_table=str(common_info.within_table_path)
-    )
+    Args:
+        common_info (CommonInfo): Info common to all layers (wfh and operator)
+        specific_info (SpecificInfo): Info specific to a particular layer (wfh or operator)
+        items (dict): {feature service item id: (service definition arcgis.Item, feature service arcgis.Item)} for
+            every layer in specific_info.layers()
+        recorder (StageRecorder, optional): Recorder for the step metrics. Defaults to None (a new one that prints).
+        checkpoints (CheckpointStore, optional): Stage checkpoints. Defaults to None (common_info's checkpoints).
+        executor (Executor, optional): Where to run the uploads and publishes. Defaults to None (publish before
+            returning).
+        item_information (dict, optional): {feature service item id: Future of get_item_information}. Defaults to None
+            (fetch it when publishing).
 
-    remove_single_count_hexes(str(common_info.hexes_fc_path), str(common_info.trimmed_hex_fc_path))
+    Returns:
+        dict: {feature service name: Future of the upload and publish, or None if it was published before returning
+            or unchanged} for each layer
+    '''
 
-    sharing_layer, sharing_map = add_layer_to_map(
-        str(common_info.project_path), common_info.map_name, str(common_info.trimmed_hex_fc_path)
+    recorder = recorder or StageRecorder()
+    checkpoints = checkpoints or CheckpointStore(common_info.checkpoint_path, exists=arcpy.Exists)
+    method = specific_info.method
+    print(f'\nBinning and publishing {method}...')
+    method_points_path = common_info.method_path(common_info.geocoded_points_path, method)
+    hexes_fc_path = common_info.method_path(common_info.hexes_fc_path, method)
+    within_table_path = common_info.method_path(common_info.within_table_path, method)
+    trimmed_hex_fc_path = common_info.method_path(common_info.trimmed_hex_fc_path, method)
+
+    select_key = hash_parts(checkpoints.output_hash('geocode'), method)
+    if checkpoints.is_current(f'select:{method}', select_key, [method_points_path]):
+        print(f'Inputs unchanged, reusing {method_points_path}...')
+    else:
+        checkpoints.invalidate(f'select:{method}')
+        with recorder.stage(f'{method}: select points') as record:
+            delete_existing([method_points_path])
+            select_method_points(str(common_info.geocoded_points_path), method, str(method_points_path))
+            record['rows'] = int(arcpy.management.GetCount(str(method_points_path))[0])
+        checkpoints.complete(f'select:{method}', select_key)
+
+    bin_outputs = [hexes_fc_path]
+    if common_info.binning_engine == 'summarize' and not specific_info.simple_summary:
+        bin_outputs.append(within_table_path)
+    bin_key = hash_parts(
+        checkpoints.output_hash(f'select:{method}'),
+        feature_class_fingerprint(str(common_info.hex_fc_path)),
+        common_info.binning_engine,
+        specific_info.simple_summary,
     )
+    if checkpoints.is_current(f'bin:{method}', bin_key, bin_outputs):
+        print(f'Inputs unchanged, reusing {hexes_fc_path}...')
+    else:
+        checkpoints.invalidate(f'bin:{method}')
+        with recorder.stage(f'{method}: hex bin') as record:
+            delete_existing([hexes_fc_path, within_table_path])
+            hex_bin(
+                str(method_points_path),
+                str(common_info.hex_fc_path),
+                str(hexes_fc_path),
+                simple_count=specific_info.simple_summary,
+                within_table=str(within_table_path),
+                engine=common_info.binning_engine,
+                hex_index_dir=common_info.hex_index_dir,
+            )
+            record['rows'] = int(arcpy.management.GetCount(str(hexes_fc_path))[0])
+        checkpoints.complete(f'bin:{method}', bin_key)
+
+    trim_key = hash_parts(checkpoints.output_hash(f'bin:{method}'))
+    if checkpoints.is_current(f'trim:{method}', trim_key, [trimmed_hex_fc_path]):
+        print(f'Inputs unchanged, reusing {trimmed_hex_fc_path}...')
+    else:
+        checkpoints.invalidate(f'trim:{method}')
+        with recorder.stage(f'{method}: trim') as record:
+            delete_existing([trimmed_hex_fc_path])
+            remove_single_count_hexes(str(hexes_fc_path), str(trimmed_hex_fc_path))
+            record['rows'] = int(arcpy.management.GetCount(str(trimmed_hex_fc_path))[0])
+        checkpoints.complete(f'trim:{method}', trim_key)
+
+    layers = [(specific_info, trimmed_hex_fc_path, method)]
+    if specific_info.resolutions:
+        #: ie, rollup_hexes_wfh_3
+        method_rollup_path = common_info.method_path(common_info.rollup_hex_fc_path, method)
+        rollup_fc_paths = {
+            resolution.factor: common_info.method_path(method_rollup_path, f'{resolution.factor:g}'.replace('.', '_'))
+            for resolution in specific_info.resolutions
+        }
+        rollup_key = hash_parts(
+            checkpoints.output_hash(f'bin:{method}'),
+            feature_class_fingerprint(str(common_info.hex_fc_path)),
+            *sorted(rollup_fc_paths),
+        )
+        if checkpoints.is_current(f'rollup:{method}', rollup_key, rollup_fc_paths.values()):
+            print(f'Inputs unchanged, reusing {", ".join(str(path) for path in rollup_fc_paths.values())}...')
+        else:
+            checkpoints.invalidate(f'rollup:{method}')
+            with recorder.stage(f'{method}: rollup') as record:
+                delete_existing(rollup_fc_paths.values())
+                grid = load_hex_index(str(common_info.hex_fc_path), common_info.hex_index_dir).grid
+                record['rows'] = sum(
+                    rollup_hexes(str(hexes_fc_path), str(common_info.hex_fc_path), grid, rollup_fc_paths).values()
+                )
+            checkpoints.complete(f'rollup:{method}', rollup_key)
+        for resolution in specific_info.resolutions:
+            layer_info = specific_info.resolution_info(resolution)
+            layers.append((layer_info, rollup_fc_paths[resolution.factor], f'{method} {resolution.factor:g}x'))
+
+    publishes = {}
+    for layer_info, layer_fc_path, label in layers:
+        sd_item, fs_item = items[layer_info.fs_itemid]
+        publishes[layer_info.fs_name] = publish_hexes(
+            common_info,
+            layer_info,
+            layer_fc_path,
+            sd_item,
+            fs_item,
+            label,
+            recorder,
+            checkpoints,
+            executor,
+            item_information.get(layer_info.fs_itemid) if item_information is not None else None,
+        )
+    return publishes
+
+
+def publish_hexes(
+    common_info: CommonInfo,
+    layer_info: SpecificInfo,
+    hex_fc_path,
+    sd_item,
+    fs_item,
+    label,
+    recorder,
+    checkpoints,
+    executor=None,
+    item_information=None,
+):
+    '''Publish a layer's final hexes to its feature service, unless they match the last publish to it
+
+    The service definition is staged here, but if executor is given the upload and publish are submitted to it and the
+    future is returned so the caller can go on to the next layer.
 
-    update_agol_feature_service(sharing_map, sharing_layer, sd_item, fs_item, specific_info)
+    Args:
+        common_info (CommonInfo): Info common to all layers (wfh and operator)
+        layer_info (SpecificInfo): Info for the layer (see SpecificInfo.layers)
+        hex_fc_path (Path): The hexes to publish
+        sd_item (arcgis.Item): Service definition item for the layer's feature service
+        fs_item (arcgis.Item): The layer's feature service item
+        label (str): Name for the layer in the step metrics (ie, 'wfh' or 'wfh 3x')
+        recorder (StageRecorder): Recorder for the step metrics
+        checkpoints (CheckpointStore): Stage checkpoints, for whether publishing is forced
+        executor (Executor, optional): Where to run the upload and publish. Defaults to None (publish before returning).
+        item_information (Future, optional): Future of get_item_information for fs_item. Defaults to None (fetch it
+            here).
+
+    Returns:
+        Future: The upload and publish if executor was given and the hexes changed, otherwise None
+    '''
+
+    fingerprints = FingerprintStore(common_info.fingerprint_path)
+    with recorder.stage(f'{label}: fingerprint'):
+        output_hash = feature_class_digest(str(hex_fc_path))
+    if not checkpoints.is_forced(f'publish:{label}') and fingerprints.is_unchanged(
+        layer_info.fs_itemid, output=output_hash
+    ):
+        print(f'{hex_fc_path} is the same as what was last published to {layer_info.fs_name}, skipping...')
+        return None
+
+    with recorder.stage(f'{label}: stage'):
+        sharing_layer, sharing_map = add_layer_to_map(
+            str(common_info.project_path), common_info.map_name, str(hex_fc_path)
+        )
+        sd_path = stage_service_definition(sharing_map, sharing_layer, layer_info)
+
+    def publish():
+        with recorder.stage(f'{label}: publish'):
+            if item_information is not None:
+                information, thumbnail = item_information.result()
+            else:
+                information, thumbnail = get_item_information(fs_item, layer_info.description)
+            try:
+                publish_service_definition(sd_path, sd_item, fs_item, information, thumbnail)
+            finally:
+                discard_thumbnail(thumbnail)
+        fingerprints.record(layer_info.fs_itemid, source=checkpoints.output_hash('records'), output=output_hash)
+
+    if executor is None:
+        publish()
+        return None
+    return executor.submit(publish)
 
 
 if __name__ == '__main__':
@@ -458,6 +1387,7 @@ if __name__ == '__main__':
         map_name=secrets.MAP_NAME,
         portal=secrets.AGOL_PORTAL,
         username=secrets.AGOL_USERNAME,
+        intermediate_workspace=getattr(secrets, 'INTERMEDIATE_WORKSPACE', 'scratch'),
     )
 
     wfh_info = SpecificInfo(
@@ -468,8 +1398,10 @@ if __name__ == '__main__':
         fs_name=secrets.WFH_FS_NAME,
         description=(
             f'Last Updated: {datetime.datetime.today().strftime("%d %b %Y")}<br />'
-            'WFH locations per 5 sq mile hex (two locations or more).'
-        )
+            f'WFH locations per {BASE_HEX_SQUARE_MILES:g} sq mile hex (two locations or more).'
+        ),
+        #: ie, [{'factor': 3, 'sd_itemid': '...', 'fs_itemid': '...', 'fs_name': '...'}] for a 45 sq mile layer too
+        resolutions=[HexResolution(**resolution) for resolution in getattr(secrets, 'WFH_RESOLUTIONS', [])],
     )
 
     operator_info = SpecificInfo(
@@ -480,17 +1412,33 @@ if __name__ == '__main__':
         fs_name=secrets.OPERATOR_FS_NAME,
         description=(
             f'Last Updated: {datetime.datetime.today().strftime("%d %b %Y")}<br />'
-            'Approved operator locations per 5 sq mile hex (two locations or more). Data from Fleet.'
-        )
+            f'Approved operator locations per {BASE_HEX_SQUARE_MILES:g} sq mile hex (two locations or more). '
+            'Data from Fleet.'
+        ),
+        resolutions=[HexResolution(**resolution) for resolution in getattr(secrets, 'OPERATOR_RESOLUTIONS', [])],
     )
 
-    if len(argv) != 2:
+    available_methods = {'w': [wfh_info], 'o': [operator_info], 'all': [wfh_info, operator_info]}
+
+    args = argv[1:]
+    force_from = None
+    if '--force-from' in args:
+        force_index = args.index('--force-from')
+        force_from = args[force_index + 1] if force_index + 1 < len(args) else None
+        del args[force_index:force_index + 2]
+
+    if not args:
         print(
-            'Syntax: `python update_hexes.py <method>`, where method is either "w" for WFH or "o" for Approved Operators'
+            'Syntax: `python update_hexes.py <method> [<method>...] [--force-from <stage>]`, where method is "w" for '
+            f'WFH, "o" for Approved Operators, or "all" for both and stage is one of {", ".join(STAGES)}'
         )
-    elif argv[1] == 'w':
-        one_function_to_rule_them_all(common_info, wfh_info)
-    elif argv[1] == 'o':
-        one_function_to_rule_them_all(common_info, operator_info)
+    elif any(arg not in available_methods for arg in args):
+        unavailable = [arg for arg in args if arg not in available_methods]
+        print(f'Method "{unavailable[0]}" not available.')
+    elif '--force-from' in argv and force_from not in STAGES:
+        print(f'Stage "{force_from}" not available; must be one of {", ".join(STAGES)}.')
     else:
-        print(f'Method "{argv[1]}" not available.')
+        requested_infos = []
+        for arg in args:
+            requested_infos.extend(info for info in available_methods[arg] if info not in requested_infos)
+        run_methods(common_info, requested_infos, force_from=force_from)
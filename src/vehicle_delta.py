@@ -0,0 +1,243 @@
+'''
+vehicle_delta.py:
+Diffs a new vehicle csv against the last published snapshot and pushes only
+the added, changed, and removed vehicles to a hosted feature layer in bounded
+batches instead of overwriting the whole service.
+'''
+
+import logging
+from dataclasses import dataclass, field
+
+import pandas as pd
+
+from csv_points import conform_rows
+
+WGS84 = {'wkid': 4326}
+
+
+class DeltaNotPossible(Exception):
+    '''
+    Raised when a delta can't be computed (no snapshot, schema change, bad
+    keys) and the full overwrite should be used instead.
+    '''
+
+
+@dataclass
+class VehicleDelta:
+    '''
+    The difference between two vehicle snapshots.
+
+    adds:       Rows for vehicles only in the new snapshot
+    updates:    Rows for vehicles in both snapshots whose values changed
+    deletes:    Keys of vehicles only in the old snapshot
+    '''
+    adds: pd.DataFrame
+    updates: pd.DataFrame
+    deletes: list = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.adds) + len(self.updates) + len(self.deletes)
+
+    def __str__(self):
+        return f'{len(self.adds)} adds, {len(self.updates)} updates, {len(self.deletes)} deletes'
+
+
+def read_snapshot(csv_path):
+    '''
+    Read a vehicle csv with pandas' normal type inference.
+    '''
+
+    return pd.read_csv(csv_path)
+
+
+def diff_snapshots(previous_df, current_df, key):
+    '''
+    Compare two vehicle snapshots on key.
+
+    previous_df:    DataFrame of the last published vehicle csv
+    current_df:     DataFrame of the new vehicle csv
+    key:            Column that uniquely identifies a vehicle
+
+    returns: VehicleDelta (rows keep current_df's types)
+    raises: DeltaNotPossible if the columns differ or key is missing or not
+            unique in either snapshot
+    '''
+
+    if list(previous_df.columns) != list(current_df.columns):
+        raise DeltaNotPossible('Vehicle csv schema changed since last publish')
+    if key not in current_df.columns:
+        raise DeltaNotPossible(f'Key field {key} not in vehicle csv')
+    for name, snapshot in [('previous', previous_df), ('current', current_df)]:
+        if snapshot[key].isnull().any() or snapshot[key].duplicated().any():
+            raise DeltaNotPossible(f'Key field {key} has null or duplicate values in {name} snapshot')
+
+    previous_indexed = previous_df.set_index(key)
+    current_indexed = current_df.set_index(key)
+
+    added_keys = current_indexed.index.difference(previous_indexed.index)
+    deleted_keys = previous_indexed.index.difference(current_indexed.index)
+    common_keys = current_indexed.index.intersection(previous_indexed.index)
+
+    #: Compare as strings so float noise from type inference can't hide or invent a change
+    previous_common = previous_indexed.loc[common_keys].astype(str)
+    current_common = current_indexed.loc[common_keys].astype(str)
+    changed = (previous_common != current_common).any(axis=1)
+
+    return VehicleDelta(
+        adds=current_indexed.loc[added_keys].reset_index(),
+        updates=current_indexed.loc[changed[changed].index].reset_index(),
+        deletes=deleted_keys.tolist(),
+    )
+
+
+def conform_delta(delta, schema, key, workspace=None):
+    '''
+    Convert the delta's rows to the field names and types the full overwrite
+    publishes (see csv_points.conform_rows) so the edits match the layer's
+    fields. Vehicles with a value that doesn't fit its field are deleted
+    instead, the way the full overwrite leaves them out.
+
+    delta:      VehicleDelta from diff_snapshots
+    schema:     {column: (field type, text length or None)} of the vehicle csv
+    key:        Column that uniquely identifies a vehicle
+    workspace:  Workspace the field names are validated for
+
+    returns: VehicleDelta whose rows are named by field
+    '''
+
+    rows = {}
+    rejected = []
+    for name, rows_df in [('adds', delta.adds), ('updates', delta.updates)]:
+        conformed, reasons = conform_rows(rows_df, schema, workspace)
+        valid = reasons.isnull()
+        rows[name] = conformed[valid]
+        rejected += rows_df.loc[~valid, key].tolist()
+    return VehicleDelta(adds=rows['adds'], updates=rows['updates'], deletes=delta.deletes + rejected)
+
+
+def to_features(rows_df, x_field='LONGITUDE', y_field='LATITUDE', object_ids=None, oid_field='OBJECTID'):
+    '''
+    Convert vehicle rows to ArcGIS REST feature dicts with WGS84 point
+    geometry, adding object ids (for updates) if given.
+    '''
+
+    features = []
+    cleaned = rows_df.astype(object).where(rows_df.notnull(), None)
+    for position, attributes in enumerate(cleaned.to_dict('records')):
+        if object_ids is not None:
+            attributes[oid_field] = object_ids[position]
+        features.append({
+            'attributes': attributes,
+            'geometry': {
+                'x': attributes[x_field],
+                'y': attributes[y_field],
+                'spatialReference': WGS84
+            }
+        })
+    return features
+
+
+def batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def get_published_ids(feature_layer, key, oid_field='OBJECTID'):
+    '''
+    Returns {key value: object id} for every feature in feature_layer.
+    '''
+
+    feature_set = feature_layer.query(where='1=1', out_fields=f'{oid_field},{key}', return_geometry=False)
+    return {feature.attributes[key]: feature.attributes[oid_field] for feature in feature_set.features}
+
+
+def as_text(value):
+    #: A whole-number float key (ie, inferred from a csv with blanks) is 1001 on the server, not 1001.0
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def as_integer(value):
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+def key_caster(published_ids):
+    '''
+    Returns a function converting a key value to the type of the published
+    keys (str, int, or float) so keys read as strings (ie, from the vehicle
+    history) or inferred as numbers (from a csv) match the server's. Keys are
+    left alone if nothing is published.
+    '''
+
+    sample = next(iter(published_ids), None)
+    if sample is None:
+        return lambda value: value
+    if isinstance(sample, str):
+        return as_text
+    if isinstance(sample, float):
+        return float
+    return as_integer
+
+
+def check_results(results, operation):
+    '''
+    Raise a RuntimeError if any edit in an edit_features response failed.
+    '''
+
+    failures = [result for result in results.get(f'{operation}Results', []) if not result.get('success')]
+    if failures:
+        raise RuntimeError(f'{len(failures)} {operation} edits failed, first error: {failures[0].get("error")}')
+
+
+def apply_delta(feature_layer, delta, key, batch_size=250, oid_field='OBJECTID', log=None):
+    '''
+    Push a VehicleDelta to a hosted feature layer through edit_features.
+
+    The published features are re-queried first so the edits are reconciled
+    against what is actually on the server: an "add" whose key is already
+    there becomes an update, and deletes for keys that are gone are dropped.
+    This makes re-running a partially applied delta safe. The delta's keys are
+    cast to the type of the server's keys first (see key_caster).
+
+    feature_layer:  Anything with arcgis FeatureLayer-style query(where,
+                    out_fields, return_geometry) and edit_features(adds,
+                    updates, deletes) methods, like arcgis.features.FeatureLayer
+    delta:          VehicleDelta to apply
+    key:            Column that uniquely identifies a vehicle
+    batch_size:     Maximum number of features per edit_features call
+
+    returns: dict of the number of adds, updates, and deletes sent
+    raises: ValueError if the server's keys are numbers and a delta key isn't
+    '''
+
+    log = log or logging.getLogger(__name__)
+    published_ids = get_published_ids(feature_layer, key, oid_field)
+    cast = key_caster(published_ids)
+
+    changed = pd.concat([delta.adds, delta.updates], ignore_index=True)
+    changed[key] = changed[key].map(cast).astype(object)
+    on_server = changed[key].isin(list(published_ids))
+    adds_df = changed[~on_server]
+    updates_df = changed[on_server]
+    update_ids = [published_ids[vehicle] for vehicle in updates_df[key]]
+    deletes = [cast(vehicle) for vehicle in delta.deletes]
+    delete_ids = [published_ids[vehicle] for vehicle in deletes if vehicle in published_ids]
+
+    adds = to_features(adds_df, oid_field=oid_field)
+    updates = to_features(updates_df, object_ids=update_ids, oid_field=oid_field)
+
+    for batch in batches(adds, batch_size):
+        log.debug(f'Adding {len(batch)} features...')
+        check_results(feature_layer.edit_features(adds=batch), 'add')
+    for batch in batches(updates, batch_size):
+        log.debug(f'Updating {len(batch)} features...')
+        check_results(feature_layer.edit_features(updates=batch), 'update')
+    for batch in batches(delete_ids, batch_size):
+        log.debug(f'Deleting {len(batch)} features...')
+        check_results(feature_layer.edit_features(deletes=','.join(str(oid) for oid in batch)), 'delete')
+
+    return {'adds': len(adds), 'updates': len(updates), 'deletes': len(delete_ids)}
@@ -0,0 +1,264 @@
+'''
+vehicle_history.py:
+A date-partitioned Parquet store of every daily vehicle csv the pallet
+ingests, so trend questions don't mean re-downloading and re-parsing the whole
+SFTP folder. Each vehicle_data_YYYYMMDD.csv becomes one
+snapshot_date=YYYY-MM-DD/part-0.parquet partition with typed columns, written
+once (re-ingesting the same file is a no-op; a changed file replaces its
+partition). Reads prune partitions by date and row groups by vehicle, and only
+read the columns asked for.
+
+    python vehicle_history.py <store_dir> ingest <csv or directory of csvs>
+    python vehicle_history.py <store_dir> query [--start 2021-01-01] [--end 2021-03-31] [--vehicles V1 V2]
+        [--columns LATITUDE LONGITUDE] [--output out.csv]
+'''
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from checkpoints import file_digest
+from sftp_sync import parse_csv_date
+
+PARTITION_FIELD = 'snapshot_date'
+#: Files starting with _ are skipped by pyarrow's dataset discovery
+MANIFEST_NAME = '_ingested.json'
+PARTITIONING = ds.partitioning(pa.schema([(PARTITION_FIELD, pa.date32())]), flavor='hive')
+
+
+def typed_table(snapshot_df, key_field=None):
+    '''
+    Convert a vehicle csv frame to an Arrow table with explicit types: the key
+    field and any text columns as strings, numbers as int64 or float64.
+    '''
+
+    columns = {}
+    for column in snapshot_df.columns:
+        values = snapshot_df[column]
+        if column != key_field and pd.api.types.is_bool_dtype(values):
+            columns[column] = pa.array(values, type=pa.bool_())
+        elif column != key_field and pd.api.types.is_integer_dtype(values):
+            columns[column] = pa.array(values, type=pa.int64())
+        elif column != key_field and pd.api.types.is_numeric_dtype(values):
+            columns[column] = pa.array(values, type=pa.float64())
+        else:
+            strings = values.astype(object).where(values.notnull(), None)
+            columns[column] = pa.array(strings.map(lambda value: value if value is None else str(value)), pa.string())
+    return pa.table(columns)
+
+
+def unify_schemas(schemas):
+    '''
+    Merge the partitions' schemas, widening int64 to float64 and anything else
+    that disagrees to string, so a column whose type drifted between days can
+    still be read across them.
+    '''
+
+    fields = {}
+    for schema in schemas:
+        for schema_field in schema:
+            existing = fields.get(schema_field.name)
+            if existing is None or existing == schema_field.type:
+                fields[schema_field.name] = schema_field.type
+            elif pa.types.is_integer(existing) and pa.types.is_floating(schema_field.type) or \
+                pa.types.is_floating(existing) and pa.types.is_integer(schema_field.type):
+                fields[schema_field.name] = pa.float64()
+            else:
+                fields[schema_field.name] = pa.string()
+    return pa.schema(list(fields.items()))
+
+
+class VehicleHistory:
+    '''
+    Date-partitioned Parquet store of daily vehicle snapshots.
+
+    root:       Directory holding the store; created on the first ingest
+    key_field:  Column that identifies a vehicle (always stored as a string),
+                used to filter reads by vehicle
+    log:        Logger to report progress to
+    '''
+
+    def __init__(self, root, key_field=None, log=None):
+        self.root = Path(root)
+        self.key_field = key_field
+        self.log = log or logging.getLogger(__name__)
+        self.manifest_path = self.root / MANIFEST_NAME
+
+    def load_manifest(self):
+        '''
+        Returns {iso date: {'source': csv name, 'sha256': digest, 'rows': int}}
+        for every ingested snapshot.
+        '''
+
+        try:
+            return json.loads(self.manifest_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_manifest(self, manifest):
+        temp_path = self.manifest_path.with_suffix('.tmp')
+        temp_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+        os.replace(temp_path, self.manifest_path)
+
+    def partition_dir(self, snapshot_date):
+        return self.root / f'{PARTITION_FIELD}={snapshot_date.isoformat()}'
+
+    def dates(self):
+        '''
+        Returns the sorted datetime.dates of every ingested snapshot.
+        '''
+
+        return sorted(datetime.date.fromisoformat(date_string) for date_string in self.load_manifest())
+
+    def ingest(self, csv_path, snapshot_date=None):
+        '''
+        Add a daily vehicle csv to the store, unless the same file was already
+        ingested. A different file for an already-ingested date replaces that
+        date's partition.
+
+        csv_path:       Path to a vehicle csv
+        snapshot_date:  datetime.date of the snapshot. Defaults to the date in
+                        a vehicle_data_YYYYMMDD.csv file name.
+
+        returns: True if the csv was written to the store, False if it was
+                 already there
+        raises: ValueError if snapshot_date isn't given and can't be parsed
+                from the file name
+        '''
+
+        csv_path = Path(csv_path)
+        snapshot_date = snapshot_date or parse_csv_date(csv_path.name)
+        if snapshot_date is None:
+            raise ValueError(f'Can\'t get a snapshot date from {csv_path.name}')
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        manifest = self.load_manifest()
+        digest = file_digest(csv_path)
+        entry = manifest.get(snapshot_date.isoformat())
+        if entry is not None and entry['sha256'] == digest and self.partition_dir(snapshot_date).exists():
+            self.log.debug(f'{csv_path.name} already in vehicle history')
+            return False
+
+        dtype = {self.key_field: str} if self.key_field else None
+        table = typed_table(pd.read_csv(csv_path, dtype=dtype), self.key_field)
+
+        #: Write next to the partition and swap it in so readers never see a partial day
+        partition_dir = self.partition_dir(snapshot_date)
+        temp_dir = self.root / f'_{partition_dir.name}.tmp'
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        temp_dir.mkdir()
+        pq.write_table(table, temp_dir / 'part-0.parquet')
+        shutil.rmtree(partition_dir, ignore_errors=True)
+        os.replace(temp_dir, partition_dir)
+
+        manifest[snapshot_date.isoformat()] = {'source': csv_path.name, 'sha256': digest, 'rows': table.num_rows}
+        self.save_manifest(manifest)
+        self.log.info(f'Added {csv_path.name} ({table.num_rows} vehicles) to vehicle history')
+        return True
+
+    def dataset(self, start=None, end=None):
+        '''
+        pyarrow dataset over the partitions between start and end (inclusive
+        datetime.dates, optional), or None if there aren't any.
+        '''
+
+        dates = [
+            snapshot_date for snapshot_date in self.dates()
+            if (start is None or snapshot_date >= start) and (end is None or snapshot_date <= end)
+        ]
+        if not dates:
+            return None
+        paths = [str(self.partition_dir(snapshot_date) / 'part-0.parquet') for snapshot_date in dates]
+        schema = unify_schemas(pq.read_schema(path) for path in paths).append(pa.field(PARTITION_FIELD, pa.date32()))
+        return ds.dataset(
+            paths, schema=schema, format='parquet', partitioning=PARTITIONING, partition_base_dir=str(self.root)
+        )
+
+    def query(self, start=None, end=None, vehicles=None, columns=None):
+        '''
+        Read snapshots from the store, only touching the partitions and
+        columns needed.
+
+        start, end:     Optional inclusive datetime.date range
+        vehicles:       Optional list of key_field values to read
+        columns:        Optional list of columns to read (snapshot_date and
+                        key_field are always included)
+
+        returns: DataFrame with a snapshot_date column
+        raises: ValueError if vehicles is given without a key_field
+        '''
+
+        #: Partitions outside the dates are never opened
+        dataset = self.dataset(start, end)
+        if dataset is None:
+            return pd.DataFrame(columns=[PARTITION_FIELD] + list(columns or []))
+
+        expression = None
+        conditions = []
+        if vehicles is not None:
+            if not self.key_field:
+                raise ValueError('Filtering by vehicle needs a key_field')
+            conditions.append(ds.field(self.key_field).isin([str(vehicle) for vehicle in vehicles]))
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+
+        if columns is not None:
+            always = [PARTITION_FIELD] + ([self.key_field] if self.key_field else [])
+            columns = always + [column for column in columns if column not in always]
+
+        return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+    def snapshot(self, snapshot_date):
+        '''
+        Returns one day's vehicles as a DataFrame (without the snapshot_date
+        column), or None if that date isn't in the store.
+        '''
+
+        if snapshot_date not in self.dates():
+            return None
+        table = pq.read_table(self.partition_dir(snapshot_date) / 'part-0.parquet')
+        return table.to_pandas()
+
+
+def _parse_date(date_string):
+    return datetime.date.fromisoformat(date_string)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest into or query the vehicle history store')
+    parser.add_argument('store_dir', type=Path)
+    parser.add_argument('--key-field', help='column that identifies a vehicle')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = subparsers.add_parser('ingest', help='add vehicle_data_YYYYMMDD.csv files to the store')
+    ingest_parser.add_argument('source', type=Path, help='a csv or a directory of them')
+    query_parser = subparsers.add_parser('query', help='read a date range and/or set of vehicles')
+    query_parser.add_argument('--start', type=_parse_date, help='first date (YYYY-MM-DD) to read')
+    query_parser.add_argument('--end', type=_parse_date, help='last date (YYYY-MM-DD) to read')
+    query_parser.add_argument('--vehicles', nargs='+', help='key field values to read')
+    query_parser.add_argument('--columns', nargs='+', help='columns to read')
+    query_parser.add_argument('--output', type=Path, help='csv to write the results to instead of printing them')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    history = VehicleHistory(args.store_dir, args.key_field)
+    if args.command == 'ingest':
+        sources = sorted(args.source.glob('vehicle_data_*.csv')) if args.source.is_dir() else [args.source]
+        added = sum(history.ingest(source) for source in sources)
+        print(f'Added {added} of {len(sources)} csvs')
+    else:
+        results = history.query(args.start, args.end, args.vehicles, args.columns)
+        if args.output:
+            results.to_csv(args.output, index=False)
+            print(f'Wrote {len(results)} rows to {args.output}')
+        else:
+            print(results)
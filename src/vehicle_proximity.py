@@ -0,0 +1,361 @@
+'''
+vehicle_proximity.py:
+Finds sharing candidates in the vehicle data: the vehicles within N miles of
+a point (ie, an office) and clusters of under-used vehicles that are all
+within N miles of another vehicle in the cluster. Vehicles are bucketed into a
+grid of square cells over locally projected coordinates, so a query only
+measures the distance to the vehicles in the few cells around it instead of
+the whole fleet.
+
+    python vehicle_proximity.py <vehicle csv> nearby --point -111.89 40.76 [--point LON LAT] --miles 5
+        [--output nearby.csv]
+    python vehicle_proximity.py <vehicle csv> clusters --miles 2 [--history <store_dir> --days 30 --max-driven 100]
+        [--min-size 2] [--output clusters.csv]
+
+Outputs ending in .csv are written as a csv; anything else is converted to
+points with csv_points (a feature class, or GeoJSON without arcpy) so it can
+be published next to the vehicle points.
+'''
+
+import argparse
+import datetime
+import logging
+import os
+import tempfile
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from csv_points import convert_csv_to_points, validate_coordinates
+from hex_engine import pack_key
+from vehicle_history import VehicleHistory
+
+EARTH_RADIUS_MILES = 3958.7613
+#: Candidate searches are widened by this much on top of the projection's worst stretch, to cover the difference
+#: between the flat projected distance and the great circle one
+SEARCH_PADDING = 1.01
+DISTANCE_FIELD = 'distance_miles'
+POINT_FIELD = 'point_id'
+CLUSTER_FIELD = 'cluster_id'
+CLUSTER_SIZE_FIELD = 'cluster_size'
+DRIVEN_FIELD = 'miles_driven'
+
+
+def haversine_miles(lon1, lat1, lon2, lat2):
+    '''
+    Great circle distance in miles between arrays of WGS84 coordinates.
+    '''
+
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(values, dtype=np.float64)) for values in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def expand_ranges(starts, ends):
+    '''
+    Returns (owner, position) for every position in each [start, end) range:
+    owner is the range's index and position runs from its start to end - 1.
+    '''
+
+    counts = ends - starts
+    owners = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, starts[owners] + offsets
+
+
+class GridIndex:
+    '''
+    Points bucketed into square cells, stored as the point indices sorted by
+    cell with the start and end of each occupied cell's run.
+
+    x, y:       Projected coordinates of the points
+    cell_size:  Width of a cell in the coordinates' units; queries are
+                fastest when it's close to the search radius
+    '''
+
+    def __init__(self, x, y, cell_size):
+        self.cell_size = float(cell_size)
+        self.cell_x = np.floor(np.asarray(x, dtype=np.float64) / self.cell_size).astype(np.int64)
+        self.cell_y = np.floor(np.asarray(y, dtype=np.float64) / self.cell_size).astype(np.int64)
+
+        keys = pack_key(self.cell_x, self.cell_y)
+        self.order = np.argsort(keys, kind='stable')
+        self.cell_keys, self.starts, counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+        self.ends = self.starts + counts
+
+    def cell_ranges(self, cell_x, cell_y):
+        '''
+        Returns the (start, end) into order of each cell; empty cells get
+        start == end.
+        '''
+
+        keys = pack_key(cell_x, cell_y)
+        found = np.searchsorted(self.cell_keys, keys)
+        found = np.minimum(found, len(self.cell_keys) - 1)
+        occupied = self.cell_keys[found] == keys
+        return np.where(occupied, self.starts[found], 0), np.where(occupied, self.ends[found], 0)
+
+    def candidates(self, x, y, radius):
+        '''
+        Returns the indices of every point in the cells that overlap the
+        square around (x, y) with sides 2 * radius; a superset of the points
+        within radius.
+        '''
+
+        xmin, xmax = np.floor((x - radius) / self.cell_size), np.floor((x + radius) / self.cell_size)
+        ymin, ymax = np.floor((y - radius) / self.cell_size), np.floor((y + radius) / self.cell_size)
+        cell_x, cell_y = np.meshgrid(
+            np.arange(xmin, xmax + 1, dtype=np.int64), np.arange(ymin, ymax + 1, dtype=np.int64)
+        )
+        starts, ends = self.cell_ranges(cell_x.ravel(), cell_y.ravel())
+        _, positions = expand_ranges(starts, ends)
+        return self.order[positions]
+
+    def neighbor_pairs(self):
+        '''
+        Returns (i, j) arrays with every pair of points (i != j, each pair
+        once) that are in the same or adjacent cells; a superset of the pairs
+        within cell_size of each other.
+        '''
+
+        sorted_x, sorted_y = self.cell_x[self.order], self.cell_y[self.order]
+        first, second = [], []
+        #: Half of the 3 x 3 neighborhood, so each pair of cells is only visited once
+        for offset_x, offset_y in [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]:
+            starts, ends = self.cell_ranges(sorted_x + offset_x, sorted_y + offset_y)
+            owners, positions = expand_ranges(starts, ends)
+            if offset_x == offset_y == 0:
+                keep = positions > owners
+                owners, positions = owners[keep], positions[keep]
+            first.append(self.order[owners])
+            second.append(self.order[positions])
+        return np.concatenate(first), np.concatenate(second)
+
+
+class VehicleIndex:
+    '''
+    Grid index over a snapshot of vehicle locations.
+
+    vehicles_df:    DataFrame of vehicles; rows with invalid coordinates (see
+                    csv_points.validate_coordinates) are left out
+    miles:          Typical search radius, used to size the grid cells
+    x_field:        Longitude column
+    y_field:        Latitude column
+    '''
+
+    def __init__(self, vehicles_df, miles=5, x_field='LONGITUDE', y_field='LATITUDE'):
+        reasons, x, y = validate_coordinates(vehicles_df, x_field, y_field)
+        valid = reasons.isnull().to_numpy()
+        self.vehicles = vehicles_df[valid].reset_index(drop=True)
+        self.lon = x[valid].to_numpy(dtype=np.float64)
+        self.lat = y[valid].to_numpy(dtype=np.float64)
+        if not len(self.vehicles):
+            raise ValueError('No vehicles with valid coordinates to index')
+
+        #: Equirectangular projection in miles around the fleet's center. East-west distances are stretched by
+        #: cos(origin) / cos(latitude); searches are widened by the worst stretch and then measured exactly.
+        self.origin_lon = float(self.lon.mean())
+        self.origin_lat = float(self.lat.mean())
+        self.x, self.y = self.project(self.lon, self.lat)
+        self.stretch = self.max_stretch(self.lat)
+        self.grid = GridIndex(self.x, self.y, miles * self.stretch * SEARCH_PADDING)
+
+    def project(self, lon, lat):
+        scale = np.radians(1) * EARTH_RADIUS_MILES
+        x = (np.asarray(lon, dtype=np.float64) - self.origin_lon) * scale * np.cos(np.radians(self.origin_lat))
+        y = (np.asarray(lat, dtype=np.float64) - self.origin_lat) * scale
+        return x, y
+
+    def max_stretch(self, lat):
+        cosines = np.cos(np.radians([np.min(lat), np.max(lat), self.origin_lat]))
+        return float(max(cosines.max() / cosines.min(), 1))
+
+    def within(self, lon, lat, miles):
+        '''
+        Vehicles within miles of a point.
+
+        lon, lat:   WGS84 coordinates of the point
+        miles:      Search radius
+
+        returns: DataFrame of the vehicles with a distance_miles column,
+                 nearest first
+        '''
+
+        x, y = self.project(lon, lat)
+        radius = miles * max(self.stretch, self.max_stretch([lat])) * SEARCH_PADDING
+        candidates = self.grid.candidates(float(x), float(y), radius)
+        distances = haversine_miles(lon, lat, self.lon[candidates], self.lat[candidates])
+        close = distances <= miles
+        order = np.argsort(distances[close], kind='stable')
+        return self.vehicles.iloc[candidates[close][order]].assign(**{DISTANCE_FIELD: distances[close][order]})
+
+    def nearby(self, points, miles):
+        '''
+        Vehicles within miles of each of several points.
+
+        points:     List of (lon, lat) tuples
+        miles:      Search radius
+
+        returns: DataFrame of the matches with the point's index in point_id
+                 and a distance_miles column; a vehicle near two points is
+                 listed for each
+        '''
+
+        matches = [self.within(lon, lat, miles).assign(**{POINT_FIELD: number}) for number, (lon, lat) in
+                   enumerate(points)]
+        return pd.concat(matches, ignore_index=True)
+
+    def clusters(self, miles, candidates=None, min_size=2):
+        '''
+        Group vehicles that are chained together within miles of each other
+        (single linkage: every vehicle in a cluster is within miles of at
+        least one other vehicle in it).
+
+        miles:          Linking distance
+        candidates:     Optional boolean array (aligned with the indexed
+                        vehicles) of the vehicles to consider, ie the
+                        under-used ones. Defaults to all of them.
+        min_size:       Smallest cluster to return
+
+        returns: DataFrame of the clustered vehicles with cluster_id and
+                 cluster_size columns, biggest cluster first
+        '''
+
+        #: Pairs come from the grid built for the index's radius; rebuild it if this distance is bigger
+        grid = self.grid
+        if miles * self.stretch * SEARCH_PADDING > grid.cell_size:
+            grid = GridIndex(self.x, self.y, miles * self.stretch * SEARCH_PADDING)
+
+        first, second = grid.neighbor_pairs()
+        if candidates is not None:
+            candidates = np.asarray(candidates, dtype=bool)
+            keep = candidates[first] & candidates[second]
+            first, second = first[keep], second[keep]
+        close = haversine_miles(self.lon[first], self.lat[first], self.lon[second], self.lat[second]) <= miles
+        first, second = first[close], second[close]
+
+        #: Connected components: push the smallest label across every link, then jump to labels' labels, until stable
+        labels = np.arange(len(self.vehicles))
+        while True:
+            previous = labels.copy()
+            smallest = np.minimum(labels[first], labels[second])
+            np.minimum.at(labels, first, smallest)
+            np.minimum.at(labels, second, smallest)
+            labels = labels[labels]
+            if np.array_equal(labels, previous):
+                break
+
+        if candidates is not None:
+            labels = np.where(candidates, labels, -1)
+        _, inverse, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+        vehicle_sizes = sizes[inverse.ravel()]
+        keep = (vehicle_sizes >= min_size) & (labels >= 0)
+
+        clustered = self.vehicles[keep].assign(**{CLUSTER_FIELD: labels[keep], CLUSTER_SIZE_FIELD: vehicle_sizes[keep]})
+        clustered = clustered.sort_values([CLUSTER_SIZE_FIELD, CLUSTER_FIELD], ascending=[False, True], kind='stable')
+        #: Number the clusters 1..n, biggest first
+        clustered[CLUSTER_FIELD] = pd.factorize(clustered[CLUSTER_FIELD])[0] + 1
+        return clustered.reset_index(drop=True)
+
+
+def miles_driven(history, key_field, start=None, end=None, odometer_field='ODOMETER'):
+    '''
+    How far each vehicle was driven over a date range of the vehicle history,
+    from the spread of its odometer readings.
+
+    history:            vehicle_history.VehicleHistory with a key_field
+    key_field:          Column that identifies a vehicle
+    start, end:         Optional inclusive datetime.date range
+    odometer_field:     Odometer column
+
+    returns: Series of miles driven indexed by key_field value (as strings)
+    '''
+
+    readings = history.query(start, end, columns=[odometer_field])
+    odometers = pd.to_numeric(readings[odometer_field], errors='coerce')
+    grouped = odometers.groupby(readings[key_field].astype(str))
+    return (grouped.max() - grouped.min()).rename(DRIVEN_FIELD)
+
+
+def write_output(results_df, output_path, x_field='LONGITUDE', y_field='LATITUDE', log=None):
+    '''
+    Write results to a csv, or to points (a feature class or .geojson) via
+    csv_points for any other output_path.
+    '''
+
+    output_path = str(output_path)
+    if output_path.lower().endswith('.csv'):
+        results_df.to_csv(output_path, index=False)
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_csv = os.path.join(temp_dir, 'results.csv')
+        results_df.to_csv(temp_csv, index=False)
+        report = convert_csv_to_points(temp_csv, output_path, x_field, y_field, log=log)
+    if log is not None:
+        log.info(f'{output_path}: {report}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find vehicles near a point or clusters of under-used vehicles')
+    parser.add_argument('vehicle_csv', type=Path)
+    #: Shared by both commands so they can go after the command name
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument('--x-field', default='LONGITUDE')
+    common_parser.add_argument('--y-field', default='LATITUDE')
+    common_parser.add_argument(
+        '--output', type=Path, help='csv, feature class, or .geojson to write instead of printing'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    nearby_parser = subparsers.add_parser(
+        'nearby', parents=[common_parser], help='vehicles within --miles of one or more points'
+    )
+    nearby_parser.add_argument(
+        '--point', nargs=2, type=float, action='append', required=True, metavar=('LON', 'LAT')
+    )
+    nearby_parser.add_argument('--miles', type=float, required=True)
+
+    clusters_parser = subparsers.add_parser(
+        'clusters', parents=[common_parser], help='groups of vehicles within --miles of each other'
+    )
+    clusters_parser.add_argument('--miles', type=float, required=True)
+    clusters_parser.add_argument('--min-size', type=int, default=2)
+    clusters_parser.add_argument('--history', type=Path, help='vehicle history store to measure use from')
+    clusters_parser.add_argument('--key-field', default='VEHICLE_NUMBER', help='column that identifies a vehicle')
+    clusters_parser.add_argument('--odometer-field', default='ODOMETER')
+    clusters_parser.add_argument('--days', type=int, default=30, help='days of history to measure use over')
+    clusters_parser.add_argument(
+        '--max-driven', type=float, help='only cluster vehicles driven at most this many miles over --days'
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    log = logging.getLogger('vehicle_proximity')
+    vehicles = pd.read_csv(args.vehicle_csv, dtype={getattr(args, 'key_field', None) or 'VEHICLE_NUMBER': str})
+    index = VehicleIndex(vehicles, args.miles, args.x_field, args.y_field)
+
+    if args.command == 'nearby':
+        results = index.nearby([tuple(point) for point in args.point], args.miles)
+    else:
+        underused = None
+        if args.max_driven is not None:
+            if args.history is None:
+                parser.error('--max-driven needs --history')
+            end = datetime.date.today()
+            driven = miles_driven(
+                VehicleHistory(args.history, args.key_field), args.key_field,
+                end - datetime.timedelta(days=args.days), end, args.odometer_field
+            )
+            index.vehicles[DRIVEN_FIELD] = index.vehicles[args.key_field].astype(str).map(driven)
+            #: Vehicles without history aren't known to be under-used
+            underused = (index.vehicles[DRIVEN_FIELD] <= args.max_driven).to_numpy()
+        results = index.clusters(args.miles, underused, args.min_size)
+
+    if args.output:
+        write_output(results, args.output, args.x_field, args.y_field, log)
+        print(f'Wrote {len(results)} rows to {args.output}')
+    else:
+        print(results)
@@ -0,0 +1,241 @@
+'''
+vehicle_watch.py:
+Watches the fleet SFTP upload folder so a new vehicle csv can be published as
+soon as it finishes uploading instead of at the pallet's next scheduled run.
+Each poll only fetches the folder listing. A file is handed off once its size
+and modification time have held steady across consecutive polls, and a lock
+file keeps a watcher and a scheduled run from publishing at the same time.
+'''
+
+import json
+import logging
+import os
+import random
+import time
+
+from publish_steps import backoff_delay
+from sftp_sync import ManifestSync, list_vehicle_csvs
+
+LOCK_FILE_NAME = 'fleet_publish.lock'
+
+
+class LockHeld(RuntimeError):
+    '''
+    Raised when another run already holds the publish lock.
+    '''
+
+
+class PublishLock:
+    '''
+    Lock file that only one process can hold at a time. Its contents are
+    written to a temporary file first and then hard linked into place, which
+    fails if the lock already exists, so the lock is never seen half written.
+    Use as a context manager around a publish.
+
+    path:           Path to the lock file
+    stale_seconds:  A lock file older than this is assumed to be left behind by
+                    a run that crashed and is taken over (default 6 hours)
+    log:            Logger to report progress to
+    '''
+
+    def __init__(self, path, stale_seconds=6 * 60 * 60, log=None):
+        self.path = str(path)
+        self.stale_seconds = stale_seconds
+        self.log = log or logging.getLogger(__name__)
+
+    def holder(self):
+        '''
+        Returns the {'pid', 'acquired'} info written by whoever holds the lock,
+        or None if it isn't held (or is stale). A lock that can't be read is
+        still held until it's stale, with None for its info.
+        '''
+
+        try:
+            if time.time() - os.path.getmtime(self.path) >= self.stale_seconds:
+                return None
+            with open(self.path) as lock_file:
+                return json.load(lock_file)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            return {'pid': None, 'acquired': None}
+
+    def is_held(self):
+        return self.holder() is not None
+
+    def acquire(self):
+        '''
+        Take the lock, taking over a stale one.
+
+        raises: LockHeld if another run holds it
+        '''
+
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as temp_file:
+            json.dump({'pid': os.getpid(), 'acquired': time.time()}, temp_file)
+        try:
+            for attempt in range(2):
+                try:
+                    os.link(temp_path, self.path)
+                except FileExistsError:
+                    holder = self.holder()
+                    if attempt or holder is not None:
+                        raise LockHeld(f'Publish lock {self.path} is held by {holder}') from None
+                    self.log.warning(f'Removing stale publish lock {self.path}')
+                    self._remove()
+                    continue
+                return self
+        finally:
+            os.remove(temp_path)
+
+    def release(self):
+        self._remove()
+
+    def _remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def watch_delay(interval_seconds, jitter, failures=0, max_backoff_seconds=900, uniform=random.uniform):
+    '''
+    Seconds to wait before the next poll: interval_seconds, or after failed
+    polls the publish_steps backoff (interval_seconds times the failure count
+    squared, capped at max_backoff_seconds), spread by +/- jitter (a fraction)
+    so several watchers don't hit the server in step.
+    '''
+
+    delay = backoff_delay(failures, interval_seconds, max_backoff_seconds) if failures else interval_seconds
+    return delay * uniform(1 - jitter, 1 + jitter)
+
+
+class UploadWatcher:
+    '''
+    Decides from successive folder listings when the newest dated csv has
+    finished uploading.
+
+    stable_polls:   Number of consecutive polls the newest csv's size and
+                    mtime must be the same (and the size non-zero) before it
+                    counts as complete
+    '''
+
+    def __init__(self, stable_polls=2):
+        self.stable_polls = stable_polls
+        #: (name, size, mtime) of the newest csv and how many polls in a row it's looked the same
+        self.candidate = None
+        self.steady_polls = 0
+        #: (name, size, mtime) of the last csv handed off
+        self.handled = None
+
+    def check(self, listing):
+        '''
+        listing:    {filename: {'size', 'mtime'}} from sftp_sync.list_vehicle_csvs
+
+        returns: the newest csv's name if it's complete and hasn't been handed
+                 off yet, otherwise None
+        '''
+
+        if not listing:
+            return None
+        name = ManifestSync.latest_name(listing)
+        entry = (name, listing[name]['size'], listing[name]['mtime'])
+        if entry == self.candidate:
+            self.steady_polls += 1
+        else:
+            self.candidate = entry
+            self.steady_polls = 1
+
+        if entry == self.handled or not entry[1] or self.steady_polls < self.stable_polls:
+            return None
+        return name
+
+    def mark_handled(self):
+        '''
+        Record the current candidate as handed off so it isn't returned again
+        (until it changes on the server).
+        '''
+
+        self.handled = self.candidate
+
+
+def watch(
+    connect,
+    handle,
+    remote_dir='upload',
+    interval_seconds=60,
+    jitter=0.2,
+    max_backoff_seconds=900,
+    stable_polls=2,
+    max_polls=None,
+    log=None,
+    sleep=time.sleep,
+):
+    '''
+    Poll remote_dir and call handle(client, name) for each new vehicle csv
+    once it has finished uploading. A failed poll or handle is logged, the
+    connection is reopened on the next poll, and polling backs off until one
+    succeeds; a file whose handle failed is tried again. If handle raises
+    LockHeld (a scheduled run is publishing), the file is tried again on the
+    next poll without backing off.
+
+    connect:                Callable returning a client with pysftp-style
+                            listdir_attr (ie, a pysftp.Connection or
+                            sftp_sync.LocalDirectoryClient). Closed with its
+                            close() method, if it has one.
+    handle:                 Callable taking the client and the csv's name
+    remote_dir:             Remote directory to watch
+    interval_seconds:       Base time between polls
+    jitter:                 Fraction to randomly spread each wait by
+    max_backoff_seconds:    Longest wait after failed polls
+    stable_polls:           See UploadWatcher
+    max_polls:              Stop after this many polls (default None, forever)
+    log:                    Logger to report progress to
+    sleep:                  Called with the seconds to wait between polls
+
+    returns: number of csvs handled
+    '''
+
+    log = log or logging.getLogger(__name__)
+    watcher = UploadWatcher(stable_polls)
+    client = None
+    failures = handled = polls = 0
+    log.info(f'Watching {remote_dir} every {interval_seconds}s for new vehicle csvs...')
+    try:
+        while max_polls is None or polls < max_polls:
+            polls += 1
+            try:
+                if client is None:
+                    client = connect()
+                name = watcher.check(list_vehicle_csvs(client, remote_dir))
+                if name is not None:
+                    log.info(f'{remote_dir}/{name} finished uploading; processing...')
+                    handle(client, name)
+                    watcher.mark_handled()
+                    handled += 1
+                failures = 0
+            except LockHeld as e:
+                log.info(f'{e}; trying again next poll')
+            except Exception:
+                failures += 1
+                log.exception(f'Watch poll failed ({failures} in a row); reconnecting next poll')
+                _close(client)
+                client = None
+            if max_polls is None or polls < max_polls:
+                sleep(watch_delay(interval_seconds, jitter, failures, max_backoff_seconds))
+    finally:
+        _close(client)
+
+    return handled
+
+
+def _close(client):
+    close = getattr(client, 'close', None)
+    if close is not None:
+        close()
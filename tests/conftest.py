@@ -0,0 +1,54 @@
+'''Puts src on the path and stands in for the ArcGIS, Forklift, SFTP, and secrets modules (see benchmarks/stubs.py) so
+the modules under test can be imported outside of an ArcGIS Pro environment. Also holds the FakeArcpy hex grid that the
+hex binning and update_hexes tests share.
+'''
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'benchmarks'))
+
+import stubs  # noqa: E402  pylint: disable=wrong-import-position
+
+stubs.install()
+
+#: pylint: disable=wrong-import-position
+import hex_engine  # noqa: E402
+import update_hexes  # noqa: E402
+from fake_arcpy import FakeArcpy, FakeShape  # noqa: E402
+
+HEX_SIZE = 1000.0
+
+
+@pytest.fixture
+def arcpy(monkeypatch):
+    '''A hex grid of 5 x 5 flat-topped hexes and some points in it, in a FakeArcpy patched into update_hexes
+    '''
+
+    fake = FakeArcpy()
+    grid = hex_engine.HexGrid(0, 0, HEX_SIZE)
+    q, r = np.meshgrid(np.arange(5), np.arange(5))
+    corners = grid.vertices(q.ravel(), r.ravel())
+    fake.add_table('hexes.gdb/hexes', [('GRID_ID', 'String')], [
+        {'SHAPE': FakeShape(hex_corners), 'GRID_ID': f'hex {number}'} for number, hex_corners in enumerate(corners)
+    ])
+
+    rng = np.random.default_rng(0)
+    point_q = rng.integers(0, 5, 200)
+    point_r = rng.integers(0, 5, 200)
+    x, y = grid.centers(point_q, point_r)
+    #: Jitter inside the inscribed circle so every point stays in its hex
+    angle = rng.uniform(0, 2 * np.pi, 200)
+    radius = rng.uniform(0, 0.8, 200) * HEX_SIZE
+    fake.add_table('scratch.gdb/points', [('USER_DEPT_NAME', 'String')], [
+        {'SHAPE': FakeShape([point_x, point_y]), 'USER_DEPT_NAME': rng.choice(['Parks', 'Roads', None])}
+        for point_x, point_y in zip(x + radius * np.cos(angle), y + radius * np.sin(angle))
+    ])
+
+    monkeypatch.setattr(update_hexes, 'arcpy', fake)
+    #: For the modules that import arcpy where they use it (ie, fingerprints)
+    monkeypatch.setitem(sys.modules, 'arcpy', fake)
+    return fake
@@ -0,0 +1,197 @@
+'''Just enough of arcpy, backed by in-memory tables, to run the feature class plumbing in update_hexes.
+
+Feature classes are registered with add_table and read back with rows(). Shapes are FakeShapes; SHAPE@X/SHAPE@Y read
+their centroid.
+'''
+
+import json
+import operator
+import re
+from contextlib import contextmanager
+from os.path import join
+from types import SimpleNamespace
+
+import numpy as np
+
+#: The where clause comparisons update_hexes uses (ie, USER_in_wfh = 1 and Point_Count > 1)
+COMPARISONS = {'=': operator.eq, '>': operator.gt}
+
+
+class FakeShape:
+    '''A geometry with a centroid and an extent (ie, a hexagon from its corners, or a point).
+    '''
+
+    def __init__(self, coordinates):
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        self.coordinates = coordinates
+        self.centroid = SimpleNamespace(X=coordinates[:, 0].mean(), Y=coordinates[:, 1].mean())
+        xmin, ymin = coordinates.min(axis=0)
+        xmax, ymax = coordinates.max(axis=0)
+        self.extent = SimpleNamespace(XMin=xmin, YMin=ymin, XMax=xmax, YMax=ymax)
+
+
+class FakeUpdateCursor:
+    '''Iterates rows as lists of fields' values; updateRow writes values back to the row last iterated.
+    '''
+
+    def __init__(self, rows, fields, value):
+        self.rows = rows
+        self.fields = fields
+        self.value = value
+        self.current = None
+
+    def __iter__(self):
+        for row in self.rows:
+            self.current = row
+            yield [self.value(row, field) for field in self.fields]
+
+    def updateRow(self, values):  #: pylint: disable=invalid-name
+        self.current.update(zip(self.fields, values))
+
+
+class FakeArcpy:
+    '''The arcpy functions update_hexes' numpy engine calls, over {path: {'fields': [...], 'rows': [dict]}} tables.
+    '''
+
+    def __init__(self):
+        self.tables = {}
+        self.management = SimpleNamespace(
+            GetCount=lambda path: [str(len(self.tables[str(path)]['rows']))],
+            CreateFeatureclass=self.create_feature_class,
+            AddFields=self.add_fields,
+            MakeFeatureLayer=self.copy,
+            CopyFeatures=self.copy,
+            Delete=lambda path: self.tables.pop(str(path)),
+        )
+        self.conversion = SimpleNamespace(
+            FeatureClassToFeatureClass=lambda in_path, out_path, out_name, where_clause=None: self.copy(
+                in_path, join(out_path, out_name), where_clause
+            ),
+        )
+        self.da = SimpleNamespace(
+            SearchCursor=self.search_cursor,
+            InsertCursor=self.insert_cursor,
+            UpdateCursor=self.update_cursor,
+            FeatureClassToNumPyArray=self.to_numpy,
+        )
+
+    def add_table(self, path, fields, rows):
+        '''Register a feature class: fields is [(name, type)] besides OBJECTID and SHAPE, rows are dicts with SHAPE.
+        '''
+
+        self.tables[str(path)] = {
+            'fields': [('OBJECTID', 'OID'), ('SHAPE', 'Geometry')] + list(fields),
+            'rows': [{'OBJECTID': oid, **row} for oid, row in enumerate(rows, start=1)],
+        }
+
+    def rows(self, path):
+        return self.tables[str(path)]['rows']
+
+    #: Polygons are built from an Array of Points like arcpy's, straight into a FakeShape
+    Array = list
+
+    @staticmethod
+    def Point(x, y):  #: pylint: disable=invalid-name
+        return SimpleNamespace(X=x, Y=y)
+
+    @staticmethod
+    def Polygon(points, spatial_reference=None):  #: pylint: disable=invalid-name
+        return FakeShape([[point.X, point.Y] for point in points])
+
+    @staticmethod
+    def ValidateFieldName(name, workspace=None):  #: pylint: disable=invalid-name
+        #: Like arcpy, anything that can't be in a field name becomes an underscore
+        return re.sub(r'\W', '_', name)
+
+    def Exists(self, path):  #: pylint: disable=invalid-name
+        return str(path) in self.tables
+
+    def Describe(self, path):  #: pylint: disable=invalid-name
+        rows = self.rows(path)
+        extents = [row['SHAPE'].extent for row in rows]
+        extent = [min(e.XMin for e in extents), min(e.YMin for e in extents)] if extents else []
+        return SimpleNamespace(
+            OIDFieldName='OBJECTID', spatialReference=None, extent=SimpleNamespace(JSON=json.dumps(extent))
+        )
+
+    def ListFields(self, path):  #: pylint: disable=invalid-name
+        return [
+            SimpleNamespace(name=name, type=field_type, editable=field_type not in ['OID', 'Geometry'])
+            for name, field_type in self.tables[str(path)]['fields']
+        ]
+
+    def create_feature_class(self, out_path, out_name, geometry_type, template=None, spatial_reference=None):
+        fields = [field for field in self.tables[str(template)]['fields'][2:]] if template else []
+        self.add_table(join(out_path, out_name), fields, [])
+
+    def add_fields(self, path, field_specs):
+        type_names = {'LONG': 'Integer', 'SHORT': 'SmallInteger', 'DOUBLE': 'Double', 'TEXT': 'String'}
+        self.tables[str(path)]['fields'].extend((spec[0], type_names[spec[1]]) for spec in field_specs)
+
+    def copy(self, in_path, out_path, where_clause=None):
+        '''Copy in_path's rows (those matching where_clause) to a new table; feature layers are copies too.
+        '''
+
+        rows = [
+            {name: value for name, value in row.items() if name != 'OBJECTID'}
+            for row in self._matching(in_path, where_clause)
+        ]
+        self.add_table(out_path, self.tables[str(in_path)]['fields'][2:], rows)
+
+    def _matching(self, path, where_clause):
+        rows = self.rows(path)
+        if where_clause is None:
+            return rows
+        in_match = re.fullmatch(r'(\w+) IN \(([\d, ]*)\)', where_clause)
+        if in_match:
+            field, values = in_match.groups()
+            wanted = {int(value) for value in values.split(',') if value.strip()}
+            return [row for row in rows if row[field] in wanted]
+        field, comparison, value = re.fullmatch(r'(\w+) (=|>) (\d+)', where_clause).groups()
+        compare = COMPARISONS[comparison]
+        return [row for row in rows if row[field] is not None and compare(row[field], int(value))]
+
+    @staticmethod
+    def _value(row, field):
+        if field == 'OID@':
+            return row['OBJECTID']
+        if field == 'SHAPE@':
+            return row['SHAPE']
+        if field == 'SHAPE@WKB':
+            return row['SHAPE'].coordinates.tobytes()
+        if field == 'SHAPE@X':
+            return row['SHAPE'].centroid.X
+        if field == 'SHAPE@Y':
+            return row['SHAPE'].centroid.Y
+        return row.get(field)
+
+    @contextmanager
+    def search_cursor(self, path, fields, where_clause=None):
+        yield iter([[self._value(row, field) for field in fields] for row in self._matching(path, where_clause)])
+
+    @contextmanager
+    def insert_cursor(self, path, fields):
+        table = self.tables[str(path)]
+
+        def insert_row(values):
+            row = {'OBJECTID': len(table['rows']) + 1}
+            for field, value in zip(fields, values):
+                row['SHAPE' if field == 'SHAPE@' else field] = value
+            table['rows'].append(row)
+
+        yield SimpleNamespace(insertRow=insert_row)
+
+    @contextmanager
+    def update_cursor(self, path, fields, where_clause=None):
+        yield FakeUpdateCursor(self._matching(path, where_clause), fields, self._value)
+
+    def to_numpy(self, path, fields, spatial_reference=None, null_value=None):
+        null_value = null_value or {}
+        columns = {
+            field: [
+                null_value.get(field) if self._value(row, field) is None else self._value(row, field)
+                for row in self.rows(path)
+            ]
+            for field in fields
+        }
+        return np.rec.fromarrays([np.asarray(values) for values in columns.values()], names=list(columns))
@@ -0,0 +1,32 @@
+'''Tests for the checkpoint input fingerprints.
+'''
+
+import os
+
+from checkpoints import tree_fingerprint
+
+
+def test_tree_fingerprint_follows_files_in_a_folder(tmp_path):
+    reports = tmp_path / 'reports'
+    reports.mkdir()
+    (reports / 'week1.xlsx').write_bytes(b'one')
+    first = tree_fingerprint(reports)
+
+    assert tree_fingerprint(reports) == first
+
+    (reports / 'week2.xlsx').write_bytes(b'two')
+    second = tree_fingerprint(reports)
+    assert second != first
+
+    os.utime(reports / 'week1.xlsx', ns=(0, 0))
+    assert tree_fingerprint(reports) != second
+
+
+def test_tree_fingerprint_of_a_single_file(tmp_path):
+    source = tmp_path / 'operators.csv'
+    source.write_text('a\n')
+    before = tree_fingerprint(source)
+
+    source.write_text('ab\n')
+
+    assert tree_fingerprint(source) != before
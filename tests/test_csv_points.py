@@ -0,0 +1,114 @@
+'''Tests for csv_points, writing GeoJSON so arcpy isn't needed.
+'''
+
+import json
+
+import pandas as pd
+import pytest
+
+import csv_points
+
+HEADER = 'VEHICLE,LATITUDE,LONGITUDE,NOTE,ODOMETER,ACTIVE'
+
+
+def write_csv(path, rows):
+    path.write_text('\n'.join([HEADER] + rows) + '\n')
+    return path
+
+
+def properties(geojson_path):
+    return [feature['properties'] for feature in json.loads(geojson_path.read_text())['features']]
+
+
+@pytest.fixture
+def late_values_csv(tmp_path):
+    #: NOTE is empty and ODOMETER a small int for the whole first chunk
+    rows = [f'{number},40.5,-111.9,,{number},true' for number in range(5)]
+    rows += [
+        f'5,40.5,-111.9,{"x" * 300},12.5,false',
+        '6,40.5,-111.9,check tires,3000000000,true',
+    ]
+    return write_csv(tmp_path / 'vehicles.csv', rows)
+
+
+def test_schema_is_scanned_from_the_whole_csv(late_values_csv):
+    schema = csv_points.scan_schema(late_values_csv, 'LONGITUDE', 'LATITUDE', chunk_size=5)
+
+    assert schema == {
+        'VEHICLE': ('LONG', None),
+        'LATITUDE': ('DOUBLE', None),
+        'LONGITUDE': ('DOUBLE', None),
+        'NOTE': ('TEXT', 600),
+        'ODOMETER': ('DOUBLE', None),
+        'ACTIVE': ('SHORT', None),
+    }
+
+
+def test_later_chunk_values_are_written_not_nulled(late_values_csv, tmp_path):
+    output = tmp_path / 'vehicles.geojson'
+
+    report = csv_points.convert_csv_to_points(late_values_csv, output, chunk_size=5)
+
+    assert (report.written, report.rejected) == (7, 0)
+    written = properties(output)
+    assert written[5]['NOTE'] == 'x' * 300
+    assert written[5]['ODOMETER'] == 12.5
+    assert written[6]['ODOMETER'] == 3000000000
+    assert written[6]['ACTIVE'] == 1
+    assert written[0]['NOTE'] is None
+
+
+def test_csv_is_parsed_once(late_values_csv, tmp_path, monkeypatch):
+    reads = []
+    read_csv = pd.read_csv
+
+    def counting_read_csv(*args, **kwargs):
+        reads.append(args[0])
+        return read_csv(*args, **kwargs)
+
+    monkeypatch.setattr(csv_points.pd, 'read_csv', counting_read_csv)
+    report = csv_points.convert_csv_to_points(late_values_csv, tmp_path / 'vehicles.geojson', chunk_size=2)
+
+    assert reads == [late_values_csv]
+    assert report.written == 7
+
+
+def test_stream_needs_a_field_type_for_every_column(late_values_csv, tmp_path):
+    output = tmp_path / 'streamed.geojson'
+
+    with open(late_values_csv, 'rb') as stream, pytest.raises(ValueError, match='missing NOTE, ACTIVE'):
+        csv_points.convert_csv_to_points(
+            stream, output, chunk_size=5, fields={'VEHICLE': 'LONG', 'ODOMETER': 'DOUBLE'}
+        )
+    assert not output.exists()
+
+
+def test_stream_values_that_dont_fit_the_given_fields_are_rejected(late_values_csv, tmp_path):
+    output = tmp_path / 'streamed.geojson'
+    rejects = tmp_path / 'rejects.csv'
+    fields = {'VEHICLE': 'LONG', 'NOTE': ('TEXT', 100), 'ODOMETER': 'LONG', 'ACTIVE': 'SHORT'}
+
+    with open(late_values_csv, 'rb') as stream:
+        report = csv_points.convert_csv_to_points(stream, output, chunk_size=5, rejects_path=rejects, fields=fields)
+
+    assert report.written == 5
+    assert report.rejects == {'NOTE too long': 1, 'non-integer ODOMETER': 1}
+    assert [line.rsplit(',', 1)[1] for line in rejects.read_text().splitlines()[1:]] == [
+        'NOTE too long', 'non-integer ODOMETER'
+    ]
+
+
+def test_explicit_fields_override_inferred_types(late_values_csv, tmp_path):
+    output = tmp_path / 'vehicles.geojson'
+
+    report = csv_points.convert_csv_to_points(
+        late_values_csv, output, chunk_size=5, fields={'ODOMETER': 'DOUBLE', 'NOTE': ('TEXT', 100)}
+    )
+
+    assert report.rejects == {'NOTE too long': 1}
+    assert properties(output)[-1]['NOTE'] == 'check tires'
+
+
+def test_unknown_field_type_raises(late_values_csv, tmp_path):
+    with pytest.raises(NotImplementedError):
+        csv_points.convert_csv_to_points(late_values_csv, tmp_path / 'out.geojson', fields={'NOTE': 'BLOB'})
@@ -0,0 +1,86 @@
+'''Tests for EIN normalization and EINIndex matching, against the pd.merge joins the index replaced.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ein_index import EINIndex, EINMatchStats, normalize_eins
+
+
+@pytest.fixture
+def dhrm():
+    #: 123456 is on two employee records; the last two have no usable EIN
+    return pd.DataFrame({
+        'EIN': [123456, 234567, 123456, 345678, 456789, 0, None],
+        'NAME': ['a', 'b', 'c', 'd', 'e', 'f', 'g'],
+    }).assign(EINint=lambda frame: normalize_eins(frame['EIN']))
+
+
+def merged_pairs(dhrm, source_eins):
+    '''(DHRM row, source row) pairs of pd.merge's inner join on valid EINs
+    '''
+
+    left = pd.DataFrame({'key': dhrm['EINint'], 'dhrm_row': np.arange(len(dhrm))}).dropna()
+    right = pd.DataFrame({'key': source_eins, 'source_row': np.arange(len(source_eins))}).dropna()
+    merged = pd.merge(left, right, how='inner', on='key')
+    return sorted(zip(merged['dhrm_row'], merged['source_row']))
+
+
+def test_normalize_eins_numbers_and_text():
+    numbers = normalize_eins(pd.Series([123456, 123456.0, 12.5, np.nan, 0, 1000000]))
+    text = normalize_eins(pd.Series([' 123456 ', '123456.0', '12a456', '', None, '0001234']))
+
+    assert numbers.dtype == 'Int32'
+    assert numbers.tolist() == [123456, 123456, pd.NA, pd.NA, pd.NA, pd.NA]
+    assert text.tolist() == [123456, 123456, pd.NA, pd.NA, pd.NA, 1234]
+
+
+def test_normalize_eins_text_length_and_min_value():
+    values = pd.Series(['123456', '1234', '012345', '99999.0'])
+
+    assert normalize_eins(values, text_length=6).tolist() == [123456, pd.NA, 12345, pd.NA]
+    assert normalize_eins(values, min_value=100000).tolist() == [123456, pd.NA, pd.NA, pd.NA]
+    #: The length applies to text only
+    assert normalize_eins(pd.Series([1234]), text_length=6).tolist() == [1234]
+
+
+def test_index_counts_duplicate_and_invalid_dhrm_eins(dhrm):
+    index = EINIndex(dhrm['EINint'])
+
+    assert index.eins.dtype == np.int32
+    assert index.eins.tolist() == [123456, 123456, 234567, 345678, 456789]
+    assert index.rows.tolist() == [0, 2, 1, 3, 4]
+    assert (index.duplicates, index.invalid) == (1, 2)
+
+
+def test_pairs_match_an_inner_merge(dhrm):
+    #: A duplicated source EIN, an ambiguous one, misses, and invalid text
+    source = pd.Series(['234567', '123456', '234567', '999999', 'n/a', '345678', '111111', '123456', None])
+
+    dhrm_rows, source_rows, stats = EINIndex(dhrm['EINint']).pairs(source, 'survey')
+
+    assert sorted(zip(dhrm_rows, source_rows)) == merged_pairs(dhrm, normalize_eins(source))
+    assert stats == EINMatchStats(
+        source='survey', eins=9, invalid=2, duplicates=2, matched=3, missed=2, ambiguous=1
+    )
+
+
+def test_pairs_apply_the_normalize_options(dhrm):
+    source = pd.Series(['12345', '234567', '0123456'])
+
+    dhrm_rows, source_rows, stats = EINIndex(dhrm['EINint']).pairs(source, text_length=6, min_value=200000)
+
+    assert list(zip(dhrm_rows, source_rows)) == [(1, 1)]
+    assert (stats.invalid, stats.matched, stats.missed) == (2, 1, 0)
+
+
+def test_match_is_the_rows_in_the_source_list(dhrm):
+    source = pd.Series([123456, 123456, 456789, 999999, 0])
+
+    dhrm_rows, stats = EINIndex(dhrm['EINint']).match(source, 'WFH survey')
+
+    #: What the old isin filter picked out
+    valid_eins = normalize_eins(source).dropna()
+    assert dhrm_rows.tolist() == np.flatnonzero(dhrm['EINint'].isin(valid_eins)).tolist()
+    assert (stats.matched, stats.missed, stats.duplicates, stats.invalid, stats.ambiguous) == (2, 1, 1, 1, 1)
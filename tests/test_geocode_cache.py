@@ -0,0 +1,37 @@
+'''Tests for the geocode cache and sharded geocoding staying separate per locator.
+'''
+
+import pandas as pd
+
+from geocode_cache import GeocodeCache, normalize_address_keys
+from geocoders import StubGeocoder, geocode_in_shards
+
+
+def addresses():
+    addresses_df = pd.DataFrame({'real_addr': ['1 Main St.', '2 State St'], 'real_zip': ['84101', '84111-1234']})
+    addresses_df['cache_key'] = normalize_address_keys(addresses_df['real_addr'], addresses_df['real_zip'])
+    return addresses_df
+
+
+def test_cache_entries_are_kept_per_geocoder(tmp_path):
+    cache = GeocodeCache(tmp_path / 'geocode_cache.sqlite')
+    utm, wgs84 = StubGeocoder(match_rate=1), StubGeocoder(match_rate=1, extent=(-114, 37, -109, 42), wkid=4326)
+    results_df, wkid = utm.geocode(addresses(), 'real_addr', 'real_zip')
+    cache.store(results_df, wkid, utm.cache_id)
+
+    cached = cache.lookup(addresses()['cache_key'], utm.cache_id)
+
+    assert sorted(cached['key']) == sorted(addresses()['cache_key'])
+    assert set(cached['wkid']) == {26912}
+    assert cache.lookup(addresses()['cache_key'], wgs84.cache_id).empty
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_saved_shards_are_not_reused_by_another_geocoder(tmp_path):
+    utm, wgs84 = StubGeocoder(), StubGeocoder(extent=(-114, 37, -109, 42), wkid=4326)
+    geocode_in_shards(addresses(), utm, tmp_path, 'real_addr', 'real_zip', max_workers=1)
+
+    results_df, wkid = geocode_in_shards(addresses(), wgs84, tmp_path, 'real_addr', 'real_zip', max_workers=1)
+
+    assert wkid == 4326
+    assert results_df['x'].dropna().between(-114, -109).all()
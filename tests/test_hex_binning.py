@@ -0,0 +1,126 @@
+'''Tests for the numpy hex binning engine and its saved hex index, on the FakeArcpy hex grid from conftest.py.
+'''
+
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+import hex_engine
+import update_hexes
+from fake_arcpy import FakeShape
+
+
+def brute_force_counts(arcpy):
+    '''{GRID_ID: (point count, {department: count})} by nearest hex center
+    '''
+
+    hexes = arcpy.rows('hexes.gdb/hexes')
+    centers = np.array([[row['SHAPE'].centroid.X, row['SHAPE'].centroid.Y] for row in hexes])
+    counts = {}
+    for point in arcpy.rows('scratch.gdb/points'):
+        distances = np.hypot(*(centers - [point['SHAPE'].centroid.X, point['SHAPE'].centroid.Y]).T)
+        grid_id = hexes[int(distances.argmin())]['GRID_ID']
+        total, departments = counts.get(grid_id, (0, {}))
+        department = point['USER_DEPT_NAME'] or 'Unknown'
+        departments[department] = departments.get(department, 0) + 1
+        counts[grid_id] = (total + 1, departments)
+    return counts
+
+
+def test_numpy_hex_bin_counts_points_and_departments(arcpy, tmp_path):
+    update_hexes.numpy_hex_bin(
+        'scratch.gdb/points', 'hexes.gdb/hexes', 'scratch.gdb/binned', simple_count=False, hex_index_dir=tmp_path
+    )
+
+    expected = brute_force_counts(arcpy)
+    binned = arcpy.rows('scratch.gdb/binned')
+    assert len(binned) == len(expected)
+    for row in binned:
+        total, departments = expected[row['GRID_ID']]
+        assert row['Point_Count'] == total
+        assert {name: row[name] for name in ['Parks', 'Roads', 'Unknown'] if row.get(name)} == departments
+
+
+def test_numpy_hex_bin_simple_count(arcpy):
+    update_hexes.numpy_hex_bin('scratch.gdb/points', 'hexes.gdb/hexes', 'scratch.gdb/binned')
+
+    expected = brute_force_counts(arcpy)
+    assert {row['GRID_ID']: row['Point_Count'] for row in arcpy.rows('scratch.gdb/binned')} == {
+        grid_id: total for grid_id, (total, _) in expected.items()
+    }
+
+
+def test_hex_bin_falls_back_to_summarize_within_for_irregular_hexes(arcpy, tmp_path):
+    #: A hex clipped in half at a boundary moves its centroid off the grid
+    clipped = arcpy.rows('hexes.gdb/hexes')[0]
+    clipped['SHAPE'] = FakeShape(clipped['SHAPE'].coordinates[:4])
+    summarized = []
+    arcpy.analysis = SimpleNamespace(SummarizeWithin=lambda *args, **kwargs: summarized.append(args))
+
+    update_hexes.hex_bin('scratch.gdb/points', 'hexes.gdb/hexes', 'scratch.gdb/binned', hex_index_dir=tmp_path)
+
+    assert summarized == [('hexes.gdb/hexes', 'scratch.gdb/points', 'scratch.gdb/binned')]
+    assert 'scratch.gdb/binned' not in arcpy.tables
+
+
+def test_load_hex_index_reuses_saved_index_until_hexes_change(arcpy, tmp_path, monkeypatch):
+    first = update_hexes.load_hex_index('hexes.gdb/hexes', tmp_path)
+    assert isinstance(first.cells, np.ndarray)
+    assert (tmp_path / hex_engine.HEX_INDEX_METADATA).exists()
+
+    #: Unchanged hexes are memory-mapped from the saved index instead of read again
+    monkeypatch.setattr(arcpy.da, 'SearchCursor', None)
+    reloaded = update_hexes.load_hex_index('hexes.gdb/hexes', tmp_path)
+    assert isinstance(reloaded.cells, np.memmap)
+    assert reloaded.source == first.source
+
+    #: A changed hex feature class is indexed again
+    monkeypatch.undo()
+    monkeypatch.setattr(update_hexes, 'arcpy', arcpy)
+    arcpy.rows('hexes.gdb/hexes').pop()
+    rebuilt = update_hexes.load_hex_index('hexes.gdb/hexes', Path(tmp_path))
+    assert rebuilt.source != first.source
+    assert len(rebuilt.cells) == 24
+
+
+def test_rollup_levels_roll_each_level_straight_from_the_base_counts():
+    grid = hex_engine.HexGrid(0, 0, 100)
+    rng = np.random.default_rng(1)
+    q, r = rng.integers(-40, 40, (2, 3000))
+    counts = hex_engine.bin_points(grid, *grid.centers(q, r), rng.choice(['Parks', 'Roads'], 3000))
+
+    levels = hex_engine.rollup_levels(grid, counts, [6, 2, 3])
+
+    assert list(levels) == [2, 3, 6]
+    for factor, (level_grid, level_counts) in levels.items():
+        assert level_grid.size == 100 * factor
+        assert level_counts.sum().to_dict() == counts.sum().to_dict()
+        #: Not from the 2x level's hexes, whose centers can land in a different coarse hex than their base hexes'
+        pd.testing.assert_frame_equal(level_counts, hex_engine.rollup_counts(grid, counts, level_grid))
+
+
+def test_rollup_hexes_trims_every_level(arcpy, tmp_path):
+    update_hexes.numpy_hex_bin(
+        'scratch.gdb/points', 'hexes.gdb/hexes', 'scratch.gdb/binned', simple_count=False, hex_index_dir=tmp_path
+    )
+    grid = update_hexes.load_hex_index('hexes.gdb/hexes', tmp_path).grid
+    output_fcs = {2: 'scratch.gdb/rollup_2', 3: 'scratch.gdb/rollup_3'}
+
+    written = update_hexes.rollup_hexes('scratch.gdb/binned', 'hexes.gdb/hexes', grid, output_fcs)
+
+    binned = pd.DataFrame(arcpy.rows('scratch.gdb/binned'))
+    counts = binned.set_index(grid.keys(binned['SHAPE'].map(lambda shape: shape.centroid.X),
+                                        binned['SHAPE'].map(lambda shape: shape.centroid.Y)))
+    counts = counts[['Point_Count', 'Parks', 'Roads', 'Unknown']].fillna(0)
+    for factor, (level_grid, level_counts) in hex_engine.rollup_levels(grid, counts, list(output_fcs)).items():
+        assert level_counts['Point_Count'].sum() == 200
+        expected = level_counts[level_counts['Point_Count'] > 1]
+        rows = arcpy.rows(output_fcs[factor])
+        assert written[factor] == len(rows) == len(expected)
+        for row in rows:
+            assert row['Point_Count'] > 1
+            #: Each hex is drawn around the coarse cell its counts belong to
+            key = level_grid.keys([row['SHAPE'].centroid.X], [row['SHAPE'].centroid.Y])[0]
+            assert [row[name] for name in expected.columns] == expected.loc[key].tolist()
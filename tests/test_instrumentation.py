@@ -0,0 +1,79 @@
+'''Tests for instrumentation's stage recording and profiling.
+'''
+
+import threading
+import time
+import tracemalloc
+
+import pytest
+
+from instrumentation import StageRecorder, current_rss_mb, peak_rss_mb
+
+
+def test_nested_stages_profile_only_the_outermost(tmp_path):
+    recorder = StageRecorder(emit=lambda line: None, profile_stage='all', profile_dir=tmp_path)
+
+    with recorder.stage('outer'):
+        with recorder.stage('inner'):
+            sum(range(1000))
+
+    inner, outer = recorder.records
+    assert inner['status'] == outer['status'] == 'ok'
+    assert 'profile' not in inner
+    assert (tmp_path / 'outer.prof').exists() and (tmp_path / 'outer.tracemalloc.txt').exists()
+    assert not tracemalloc.is_tracing()
+
+
+def test_profiling_leaves_existing_tracing_running(tmp_path):
+    recorder = StageRecorder(emit=lambda line: None, profile_stage='work', profile_dir=tmp_path)
+
+    tracemalloc.start()
+    try:
+        with recorder.stage('work'):
+            sum(range(1000))
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_peak_rss_does_not_drop():
+    first = peak_rss_mb()
+    buffer = bytearray(32 * 2**20)
+    del buffer
+
+    assert first > 0
+    assert peak_rss_mb() >= first
+
+
+def test_cpu_time_is_the_stage_threads_own():
+    recorder = StageRecorder(emit=lambda line: None)
+    stop = threading.Event()
+
+    def spin():
+        while not stop.is_set():
+            pass
+
+    spinner = threading.Thread(target=spin)
+    spinner.start()
+    try:
+        with recorder.stage('waiting'):
+            time.sleep(0.3)
+    finally:
+        stop.set()
+        spinner.join()
+
+    record = recorder.records[0]
+    assert record['wall_s'] >= 0.3
+    assert record['cpu_s'] < 0.1
+
+
+@pytest.mark.skipif(current_rss_mb() is None, reason='needs psutil or /proc')
+def test_rss_delta_follows_memory_held_by_the_stage():
+    recorder = StageRecorder(emit=lambda line: None)
+
+    with recorder.stage('allocate'):
+        held = b'\x01' * (64 * 2**20)
+
+    assert recorder.records[0]['rss_delta_mb'] >= 32
+    assert 'proc peak MB' in recorder.summary()
+    del held
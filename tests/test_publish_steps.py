@@ -0,0 +1,75 @@
+'''Tests for publish_steps' retries, with fake steps and no real waiting.
+'''
+
+import pytest
+
+from publish_steps import StepRunner, backoff_delay
+
+
+class FlakyStep:
+    '''A step that records each call in calls and raises the next of its errors until they run out
+    '''
+
+    def __init__(self, name, calls, *errors):
+        self.name = name
+        self.calls = calls
+        self.errors = list(errors)
+
+    def __call__(self):
+        self.calls.append(self.name)
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+def make_runner(**kwargs):
+    runner = StepRunner(**kwargs)
+    runner.sleeps = []
+    runner.sleep = runner.sleeps.append
+    return runner
+
+
+def test_retry_resumes_at_the_failed_step():
+    calls = []
+    steps = [(name, FlakyStep(name, calls)) for name in ['map layer', 'stage', 'upload']]
+    steps[1] = ('stage', FlakyStep('stage', calls, RuntimeError('staging failed'), RuntimeError('staging failed')))
+    runner = make_runner(retries=3, backoff_seconds=2)
+
+    assert runner.run(steps) == 2
+    assert calls == ['map layer', 'stage', 'stage', 'stage', 'upload']
+    assert runner.sleeps == [2, 8]
+
+
+def test_session_error_redoes_the_session_steps_then_the_failed_step():
+    calls = []
+    steps = [
+        ('agol login', FlakyStep('agol login', calls)),
+        ('portal sign in', FlakyStep('portal sign in', calls)),
+        ('upload', FlakyStep('upload', calls)),
+        ('publish', FlakyStep('publish', calls, RuntimeError('Invalid token.\nError Code: 498'))),
+    ]
+    runner = make_runner(session_steps=['agol login', 'portal sign in'])
+
+    assert runner.run(steps) == 1
+    #: The upload before the failed publish isn't redone
+    assert calls == ['agol login', 'portal sign in', 'upload', 'publish', 'agol login', 'portal sign in', 'publish']
+
+
+def test_gives_up_after_the_last_retry():
+    calls = []
+    error = RuntimeError('still down')
+    steps = [('publish', FlakyStep('publish', calls, *[error] * 5))]
+    runner = make_runner(retries=2)
+
+    with pytest.raises(RuntimeError, match='still down'):
+        runner.run(steps)
+    assert calls == ['publish'] * 3
+    assert len(runner.sleeps) == 2
+
+
+def test_backoff_delay_grows_and_is_capped():
+    delays = [backoff_delay(retry, 5, 300) for retry in range(1, 12)]
+
+    assert delays[:3] == [5, 20, 45]
+    assert delays == sorted(delays)
+    assert max(delays) == 300
+    assert backoff_delay(1, 5, 3) == 3
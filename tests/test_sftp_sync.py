@@ -0,0 +1,98 @@
+'''Tests for sftp_sync against a local folder through LocalDirectoryClient.
+'''
+
+import os
+from pathlib import Path
+
+import pytest
+
+from sftp_sync import MANIFEST_NAME, LocalDirectoryClient, ManifestSync, NoVehicleCsvs
+
+
+def test_empty_upload_folder_raises_a_clear_error(tmp_path):
+    (tmp_path / 'upload').mkdir()
+    (tmp_path / 'upload' / 'notes.txt').write_text('not a vehicle csv')
+    local_dir = tmp_path / 'fleet'
+    local_dir.mkdir()
+    (local_dir / 'vehicle_data_20210301.csv').write_text('VEHICLE\n1\n')
+
+    with pytest.raises(NoVehicleCsvs, match='upload'):
+        ManifestSync(LocalDirectoryClient(tmp_path), 'upload', local_dir).sync()
+    #: The last synced copy is kept
+    assert (local_dir / 'vehicle_data_20210301.csv').exists()
+
+
+def test_latest_name_picks_the_newest_date():
+    listing = {name: {'size': 1, 'mtime': 0} for name in ['vehicle_data_20210301.csv', 'vehicle_data_20210302.csv']}
+
+    assert ManifestSync.latest_name(listing) == 'vehicle_data_20210302.csv'
+
+
+@pytest.fixture
+def server(tmp_path):
+    upload_dir = tmp_path / 'server' / 'upload'
+    upload_dir.mkdir(parents=True)
+    return upload_dir
+
+
+def write_remote(upload_dir, name, contents, mtime):
+    path = upload_dir / name
+    path.write_text(contents)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_sync_downloads_new_and_changed_files_only(server, tmp_path):
+    write_remote(server, 'vehicle_data_20210301.csv', 'VEHICLE\n1\n', 1000)
+    local_dir = tmp_path / 'fleet'
+    sync = ManifestSync(LocalDirectoryClient(server.parent), 'upload', local_dir)
+
+    latest, downloaded = sync.sync()
+    assert latest == local_dir / 'vehicle_data_20210301.csv'
+    assert downloaded == ['vehicle_data_20210301.csv']
+    assert latest.read_text() == 'VEHICLE\n1\n'
+
+    #: Unchanged on the server, so the manifest says the local copy is current
+    assert sync.sync() == (latest, [])
+
+    write_remote(server, 'vehicle_data_20210301.csv', 'VEHICLE\n1\n2\n', 2000)
+    assert sync.sync() == (latest, ['vehicle_data_20210301.csv'])
+    assert latest.read_text() == 'VEHICLE\n1\n2\n'
+
+
+def test_sync_removes_stale_local_copies(server, tmp_path):
+    write_remote(server, 'vehicle_data_20210301.csv', 'VEHICLE\n1\n', 1000)
+    local_dir = tmp_path / 'fleet'
+    sync = ManifestSync(LocalDirectoryClient(server.parent), 'upload', local_dir)
+    sync.sync()
+
+    write_remote(server, 'vehicle_data_20210302.csv', 'VEHICLE\n2\n', 2000)
+    latest, downloaded = sync.sync()
+
+    assert downloaded == ['vehicle_data_20210302.csv']
+    assert sorted(path.name for path in local_dir.glob('vehicle_data_*.csv')) == [latest.name]
+    assert list(sync.load_manifest()) == [latest.name]
+
+
+def test_interrupted_download_never_leaves_a_partial_csv(server, tmp_path):
+    write_remote(server, 'vehicle_data_20210301.csv', 'VEHICLE\n1\n', 1000)
+    local_dir = tmp_path / 'fleet'
+    client = LocalDirectoryClient(server.parent)
+    sync = ManifestSync(client, 'upload', local_dir)
+
+    def interrupted_get(remotepath, localpath=None, callback=None, preserve_mtime=False):
+        Path(localpath).write_text('VEH')
+        raise ConnectionError('connection dropped')
+
+    original_get = client.get
+    client.get = interrupted_get
+    with pytest.raises(ConnectionError):
+        sync.sync()
+
+    assert list(local_dir.iterdir()) == []
+
+    client.get = original_get
+    latest, downloaded = sync.sync()
+    assert downloaded == [latest.name]
+    assert latest.read_text() == 'VEHICLE\n1\n'
+    assert sorted(path.name for path in local_dir.iterdir()) == [MANIFEST_NAME, latest.name]
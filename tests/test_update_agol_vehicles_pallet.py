@@ -0,0 +1,136 @@
+'''Tests for the vehicles pallet's csv streaming, against a local folder through sftp_sync.LocalDirectoryClient.
+'''
+
+import datetime
+import io
+import logging
+
+import pandas as pd
+import pytest
+
+import fleetshare_secrets
+import update_agol_vehicles_pallet
+from checkpoints import file_digest
+from instrumentation import StageRecorder
+from sftp_sync import LocalDirectoryClient, open_remote_csv
+
+
+@pytest.fixture
+def secrets(monkeypatch):
+    settings = {
+        'STREAM_CSV': True,
+        'VEHICLE_CSV_FIELDS': {'VEHICLE': 'LONG'},
+        'VEHICLE_KEY_FIELD': '',
+        'SFTP_HOST': 'sftp.example.com',
+        'VEHICLE_HISTORY_DIR': '',
+        'WATCH_INTERVAL_SECONDS': 0,
+        'WATCH_STABLE_POLLS': 1,
+    }
+    for name, value in settings.items():
+        monkeypatch.setattr(fleetshare_secrets, name, value, raising=False)
+    return fleetshare_secrets
+
+
+@pytest.fixture
+def upload(tmp_path):
+    '''A dated csv of more rows than fit in one read, in the upload folder of a LocalDirectoryClient root
+    '''
+
+    (tmp_path / 'upload').mkdir()
+    csv_path = tmp_path / 'upload' / f'vehicle_data_{datetime.date.today():%Y%m%d}.csv'
+    rows = [f'{number},{40 + number / 1e5:.5f},{-111.9 - number / 1e5:.5f}' for number in range(5000)]
+    csv_path.write_text('\n'.join(['VEHICLE,LATITUDE,LONGITUDE'] + rows) + '\n')
+    return csv_path
+
+
+def test_streamed_digest_and_size_match_the_file(upload):
+    client = LocalDirectoryClient(upload.parent.parent)
+
+    with open_remote_csv(client, f'upload/{upload.name}') as stream:
+        vehicles = pd.read_csv(io.BufferedReader(stream, buffer_size=4096))
+        stream.close()
+        #: Still available once the reader has closed the stream
+        assert stream.hexdigest() == file_digest(upload)
+    assert stream.size == upload.stat().st_size
+    assert len(vehicles) == 5000
+
+
+def test_hexdigest_reads_whatever_the_parser_left(upload):
+    client = LocalDirectoryClient(upload.parent.parent)
+
+    with open_remote_csv(client, f'upload/{upload.name}') as stream:
+        pd.read_csv(stream, nrows=10)
+        assert stream.hexdigest() == file_digest(upload)
+        assert stream.size == upload.stat().st_size
+
+
+def test_stream_latest_csv_hashes_what_it_converts(secrets, upload, tmp_path):
+    pallet = update_agol_vehicles_pallet.AGOLVehiclesPallet()
+    client = LocalDirectoryClient(upload.parent.parent)
+
+    source_path, date_string, remote, source_hash, conversion = pallet.stream_latest_csv(
+        tmp_path / 'points.geojson', tmp_path / 'rejects.csv', StageRecorder(emit=lambda line: None), client
+    )
+
+    assert source_path == f'sftp.example.com/upload/{upload.name}'
+    assert date_string == f'{datetime.date.today():%Y%m%d}'
+    assert remote.startswith(f'{upload.name}:{upload.stat().st_size}:')
+    assert source_hash == file_digest(upload)
+    assert conversion.written == 5000
+
+
+def test_stream_size_check_does_not_parse_the_fingerprint(secrets, upload, tmp_path, monkeypatch):
+    monkeypatch.setattr(update_agol_vehicles_pallet, 'remote_fingerprint', lambda name, entry: f'{name}|opaque')
+    pallet = update_agol_vehicles_pallet.AGOLVehiclesPallet()
+
+    _, _, remote, source_hash, _ = pallet.stream_latest_csv(
+        tmp_path / 'points.geojson', tmp_path / 'rejects.csv', StageRecorder(emit=lambda line: None),
+        LocalDirectoryClient(upload.parent.parent)
+    )
+
+    assert remote == f'{upload.name}|opaque'
+    assert source_hash == file_digest(upload)
+
+
+def test_stream_latest_csv_rejects_a_file_that_changed_mid_transfer(secrets, upload, tmp_path, monkeypatch):
+    pallet = update_agol_vehicles_pallet.AGOLVehiclesPallet()
+    list_then_append = pallet.latest_remote_csv
+
+    def latest_remote_csv(sftp):
+        listed = list_then_append(sftp)
+        with upload.open('a') as csv_file:
+            csv_file.write('5000,40.1,-111.9\n')
+        return listed
+
+    monkeypatch.setattr(pallet, 'latest_remote_csv', latest_remote_csv)
+
+    with pytest.raises(ValueError, match='may have changed mid-transfer'):
+        pallet.stream_latest_csv(
+            tmp_path / 'points.geojson', tmp_path / 'rejects.csv', StageRecorder(emit=lambda line: None),
+            LocalDirectoryClient(upload.parent.parent)
+        )
+
+
+def test_streaming_needs_the_csv_field_types(secrets, monkeypatch):
+    pallet = update_agol_vehicles_pallet.AGOLVehiclesPallet()
+    assert pallet.stream_enabled()
+
+    monkeypatch.setattr(secrets, 'VEHICLE_CSV_FIELDS', None)
+    assert not pallet.stream_enabled()
+
+
+@pytest.mark.parametrize('published', [True, False])
+def test_watch_skips_a_csv_that_is_already_published(secrets, tmp_path, monkeypatch, caplog, published):
+    (tmp_path / 'upload').mkdir()
+    (tmp_path / 'upload' / 'vehicle_data_20210301.csv').write_text('VEHICLE\n1\n')
+    pallet = update_agol_vehicles_pallet.AGOLVehiclesPallet()
+    processed = []
+    monkeypatch.setattr(pallet, 'remote_already_published', lambda sftp: published)
+    monkeypatch.setattr(pallet, 'process', processed.append)
+
+    with caplog.at_level(logging.INFO):
+        assert pallet.watch(lambda: LocalDirectoryClient(tmp_path), max_polls=1) == 1
+
+    skipped = 'vehicle_data_20210301.csv matches what was last published; skipping' in caplog.text
+    assert skipped == published
+    assert len(processed) == (0 if published else 1)
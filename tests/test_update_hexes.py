@@ -0,0 +1,413 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from os.path import join
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import update_hexes
+from checkpoints import CheckpointStore
+from ein_index import normalize_eins
+from fake_arcpy import FakeArcpy, FakeShape
+from instrumentation import StageRecorder
+
+
+@pytest.fixture
+def dhrm_excel(monkeypatch):
+    '''Stands in for pd.read_excel, returning a small DHRM dump (with its "Page" footer row) and counting the reads
+    '''
+
+    reads = []
+
+    def read_excel(path, usecols=None, **kwargs):
+        reads.append(Path(path).read_text())
+        dump = pd.DataFrame({
+            'EIN': ['123456', '23456', 'bad', 'Page 1'],
+            'DEPT_NAME': ['Parks', 'Roads', 'Parks', None],
+            'physical_address_line1': ['1 Main St', None, '3 Elm St', None],
+            'Empl Physical ZIP': ['84101-1234', None, '84103', None],
+            'mailing_address_line1': [None, 'PO Box 2', None, None],
+            'Empl Mail ZIP': [None, ' 84102 ', None, None],
+            'JOB_TITLE': ['Ranger', 'Plow Driver', 'Ranger', None],
+        }, dtype=object)
+        return dump[[column for column in dump.columns if usecols is None or usecols(column)]]
+
+    monkeypatch.setattr(pd, 'read_excel', read_excel)
+    return reads
+
+
+def test_dhrm_cache_is_reused_until_the_source_changes(dhrm_excel, tmp_path):
+    source = tmp_path / 'dhrm.xls'
+    source.write_text('first month')
+    cache_dir = tmp_path / 'cache'
+
+    first = update_hexes.get_dhrm_dataframe(source, cache_dir)
+    cached = update_hexes.get_dhrm_dataframe(source, cache_dir)
+
+    assert dhrm_excel == ['first month']
+    assert list(first['real_zip']) == ['84101', '84102', '84103']
+    pd.testing.assert_frame_equal(cached, first)
+    assert [path.suffix for path in cache_dir.iterdir()] == ['.parquet']
+
+    source.write_text('second month')
+    update_hexes.get_dhrm_dataframe(source, cache_dir)
+
+    assert dhrm_excel == ['first month', 'second month']
+    assert len(list(cache_dir.iterdir())) == 1
+
+
+def test_dhrm_columns_can_be_projected(dhrm_excel, tmp_path):
+    source = tmp_path / 'dhrm.xls'
+    source.write_text('first month')
+
+    default = update_hexes.get_dhrm_dataframe(source)
+    extra = update_hexes.get_dhrm_dataframe(source, columns=update_hexes.DHRM_COLUMNS + ('JOB_TITLE',))
+    #: Without the department, only what real_addr, real_zip, and EINint are built from
+    no_department = update_hexes.get_dhrm_dataframe(
+        source, columns=[column for column in update_hexes.DHRM_COLUMNS if column != 'DEPT_NAME']
+    )
+    everything = update_hexes.get_dhrm_dataframe(source, columns=None)
+
+    assert list(default.columns) == ['DEPT_NAME', 'real_addr', 'real_zip', 'EINint']
+    assert list(extra.columns) == ['DEPT_NAME', 'JOB_TITLE', 'real_addr', 'real_zip', 'EINint']
+    assert extra['JOB_TITLE'].tolist() == ['Ranger', 'Plow Driver', 'Ranger']
+    assert list(no_department.columns) == ['real_addr', 'real_zip', 'EINint']
+    assert no_department['real_zip'].dtype == 'category'
+    assert 'EIN' in everything.columns and everything['real_zip'].dtype != 'category'
+
+
+def test_operator_eins_match_the_merge_they_replaced(monkeypatch):
+    monthly = pd.DataFrame({
+        'EIN': ['123456', '234567', '123456', 'bad'],
+        'NAME': ['a', 'b', 'c', 'd'],
+        'DEPT_NAME': ['Parks', 'Roads', 'Parks', 'Roads'],
+    })
+    monthly['EINint'] = normalize_eins(monthly['EIN'])
+    #: A duplicated operator, a miss, and one under the 100000 floor
+    operators = pd.DataFrame({'EIN': [234567, 123456, 234567, 999999, 12345], 'NAME': ['v', 'w', 'x', 'y', 'z']})
+    monkeypatch.setattr(pd, 'read_excel', lambda path, **kwargs: operators.copy())
+
+    records = update_hexes.get_operator_eins('operators.xlsx', monthly)
+
+    cleaned = operators[(operators['EIN'] >= 100000) & (operators['EIN'] <= 999999)]
+    merged = pd.merge(monthly, cleaned, how='inner', left_on='EINint', right_on='EIN')
+    assert list(records.columns) == list(merged.columns)
+    assert {'EIN_x', 'EIN_y', 'NAME_x', 'NAME_y'} <= set(records.columns)
+    pd.testing.assert_frame_equal(
+        records.sort_values(['NAME_x', 'NAME_y'], ignore_index=True),
+        merged.sort_values(['NAME_x', 'NAME_y'], ignore_index=True),
+    )
+
+
+def test_department_count_matrix_matches_a_pivot_table():
+    join_ids = [3, 1, 3, 1, 3, 3]
+    departments = ['Roads', 'Parks', 'Roads', 'Zoo', 'Parks', 'Unknown']
+    counts = [2, 1, 4, 5, 1, 7]
+
+    unique_join_ids, unique_departments, count_matrix = update_hexes.department_count_matrix(
+        join_ids, departments, counts
+    )
+
+    pivot = pd.pivot_table(
+        pd.DataFrame({'join_id': join_ids, 'department': departments, 'count': counts}),
+        index='join_id',
+        columns='department',
+        values='count',
+        aggfunc='sum',
+        fill_value=0,
+    )
+    assert unique_join_ids.tolist() == pivot.index.tolist() == [1, 3]
+    assert unique_departments == pivot.columns.tolist() == ['Parks', 'Roads', 'Unknown', 'Zoo']
+    assert count_matrix.dtype == np.int64
+    assert count_matrix.tolist() == pivot.to_numpy().tolist() == [[1, 0, 0, 5], [1, 6, 7, 0]]
+
+
+def test_department_field_names_suffix_collisions():
+    departments = ['Parks & Rec', 'Parks - Rec', 'parks___rec', 'Join_ID', 'Roads', 'Point Count']
+
+    field_names = update_hexes.department_field_names(departments, reserved=['OBJECTID', 'Join_ID', 'Point_Count'])
+
+    #: Collisions are case insensitive, with each other and with the hexes' own fields
+    assert field_names == ['Parks___Rec', 'Parks___Rec_2', 'parks___rec_3', 'Join_ID_2', 'Roads', 'Point_Count_2']
+
+
+def test_department_counts_are_written_to_matching_hexes(monkeypatch):
+    arcpy = FakeArcpy()
+    arcpy.add_table('scratch.gdb/binned', [('Join_ID', 'Integer'), ('Point_Count', 'Integer')], [
+        {'SHAPE': FakeShape([0, 0]), 'Join_ID': join_id, 'Point_Count': 9} for join_id in [1, 2, 3, 4]
+    ])
+    join_ids, departments, count_matrix = update_hexes.department_count_matrix(
+        [3, 1, 3], ['Roads', 'Parks', 'Parks'], [2, 1, 4]
+    )
+    field_names = update_hexes.department_field_names(departments)
+
+    assert update_hexes.department_update_rows(join_ids, count_matrix) == {1: [1, 1, 0], 3: [3, 4, 2]}
+
+    monkeypatch.setattr(update_hexes, 'arcpy', arcpy)
+    update_hexes.write_department_counts('scratch.gdb/binned', join_ids, field_names, count_matrix)
+
+    assert [name for name, _ in arcpy.tables['scratch.gdb/binned']['fields']][-2:] == ['Parks', 'Roads']
+    #: Hexes without any grouped points get zeros rather than nulls
+    assert [(row['Join_ID'], row['Parks'], row['Roads']) for row in arcpy.rows('scratch.gdb/binned')] == [
+        (1, 1, 0), (2, 0, 0), (3, 4, 2), (4, 0, 0)
+    ]
+
+
+def test_wfh_report_cache_is_reused_until_the_report_is_touched(tmp_path):
+    report = tmp_path / 'week1.csv'
+    report.write_text('New,Q5,Q1_4,Other\nheader,2,3,4\nheader,2,3,4\nYes,DNR,123456,x\nNo,UTNG,,y\n')
+    cache_dir = tmp_path / 'cache'
+
+    parsed, from_cache = update_hexes.read_wfh_report(report, cache_dir)
+    assert not from_cache
+    assert list(parsed.columns) == ['New', 'Q5', 'Q1_4']
+    assert parsed['New'].tolist() == ['Yes', 'No']
+
+    cached, from_cache = update_hexes.read_wfh_report(report, cache_dir)
+    assert from_cache
+    pd.testing.assert_frame_equal(cached, parsed)
+
+    os.utime(report, ns=(0, 0))
+    _, from_cache = update_hexes.read_wfh_report(report, cache_dir)
+    assert not from_cache
+    assert len(list((cache_dir / 'wfh').iterdir())) == 1
+
+
+@pytest.fixture
+def common_info(tmp_path):
+    return update_hexes.CommonInfo(
+        employee_data_path=tmp_path / 'dhrm.xls',
+        locator_path=tmp_path / 'locator.loc',
+        hex_fc_path=Path('hexes.gdb/hexes'),
+        project_path=tmp_path / 'fleetshare.aprx',
+        map_name='Hexes',
+        portal='https://utah.maps.arcgis.com',
+        username='fleet',
+        scratch_gdb=Path('scratch.gdb'),
+        working_dir_path=tmp_path,
+    )
+
+
+@pytest.fixture
+def wfh_info(tmp_path):
+    return update_hexes.SpecificInfo('wfh', tmp_path / 'wfh', 'wfh-sd', 'wfh-fs', 'WFH Hexes', 'WFH locations')
+
+
+def test_rolled_up_layers_describe_their_own_hex_size(tmp_path):
+    wfh_info = update_hexes.SpecificInfo(
+        'wfh', tmp_path / 'wfh', 'wfh-sd', 'wfh-fs', 'WFH Hexes', 'WFH locations per 5 sq mile hex.', [
+            update_hexes.HexResolution(3, 'wfh-3-sd', 'wfh-3-fs', 'WFH Hexes 3x'),
+            update_hexes.HexResolution(1.5, 'wfh-15-sd', 'wfh-15-fs', 'WFH Hexes 1.5x'),
+            update_hexes.HexResolution(2, 'wfh-2-sd', 'wfh-2-fs', 'WFH Hexes 2x', 'Twenty sq mile hexes.'),
+        ]
+    )
+
+    assert [info.description for info in wfh_info.layers()] == [
+        'WFH locations per 5 sq mile hex.',
+        'WFH locations per 45 sq mile hex.',
+        'WFH locations per 11.25 sq mile hex.',
+        'Twenty sq mile hexes.',
+    ]
+    assert wfh_info.resolution_info(wfh_info.resolutions[0]).hex_square_miles == 45
+
+
+@pytest.fixture
+def published(monkeypatch):
+    '''Stands in for the map, staging, and AGOL calls of publish_hexes, listing the items each publish goes to
+    '''
+
+    items = []
+    monkeypatch.setattr(update_hexes, 'add_layer_to_map', lambda *args: ('layer', 'map'))
+    monkeypatch.setattr(update_hexes, 'stage_service_definition', lambda sharing_map, layer, info: f'{info.fs_name}.sd')
+    monkeypatch.setattr(update_hexes, 'get_item_information', lambda item, description: ({}, None))
+    monkeypatch.setattr(
+        update_hexes, 'publish_service_definition', lambda sd_path, sd_item, fs_item, *args: items.append(fs_item)
+    )
+    return items
+
+
+def test_unchanged_hexes_are_not_published_again(arcpy, common_info, wfh_info, published):
+    arcpy.add_table('scratch.gdb/trimmed_hexes_wfh', [('Point_Count', 'Integer')], [
+        {'SHAPE': FakeShape([[0, 0], [1, 0], [1, 1]]), 'Point_Count': count} for count in [2, 5]
+    ])
+    checkpoints = CheckpointStore(common_info.checkpoint_path)
+    checkpoints.complete('records', 'records-key')
+
+    def publish():
+        update_hexes.publish_hexes(
+            common_info, wfh_info, 'scratch.gdb/trimmed_hexes_wfh', 'sd item', 'fs item', 'wfh',
+            StageRecorder(emit=lambda line: None), checkpoints
+        )
+
+    publish()
+    publish()
+    assert published == ['fs item']
+
+    arcpy.rows('scratch.gdb/trimmed_hexes_wfh')[1]['Point_Count'] = 6
+    publish()
+    assert published == ['fs item', 'fs item']
+
+    #: --force-from publish republishes even unchanged hexes
+    checkpoints.force_from = 'publish'
+    publish()
+    assert len(published) == 3
+
+
+@pytest.mark.parametrize('workspace, intermediate_dir', [('memory', 'memory'), ('scratch', 'scratch.gdb')])
+def test_intermediates_go_to_the_chosen_workspace(
+    arcpy, common_info, tmp_path, published, workspace, intermediate_dir
+):
+    #: replace runs __post_init__ again, which picks the intermediate paths
+    common_info = replace(common_info, intermediate_workspace=workspace)
+    wfh_info = update_hexes.SpecificInfo(
+        'wfh', tmp_path / 'wfh', 'wfh-sd', 'wfh-fs', 'WFH Hexes', 'WFH locations',
+        [update_hexes.HexResolution(2, 'wfh-2-sd', 'wfh-2-fs', 'WFH Hexes 2x')]
+    )
+    #: Every other geocoded point is a WFH employee's
+    points = arcpy.tables['scratch.gdb/points']
+    arcpy.add_table(f'{intermediate_dir}/geocoded_points', [('USER_in_wfh', 'Integer')] + points['fields'][2:], [
+        {**row, 'USER_in_wfh': row['OBJECTID'] % 2} for row in points['rows']
+    ])
+    checkpoints = CheckpointStore(common_info.checkpoint_path, exists=arcpy.Exists)
+    checkpoints.complete('records', 'records-key')
+    checkpoints.complete('geocode', 'geocode-key')
+
+    update_hexes.bin_and_publish(
+        common_info, wfh_info, {'wfh-fs': ('sd', 'fs'), 'wfh-2-fs': ('2x sd', '2x fs')},
+        StageRecorder(emit=lambda line: None), checkpoints
+    )
+
+    assert common_info.geocoded_points_path == Path(intermediate_dir) / 'geocoded_points'
+    assert len(arcpy.rows(f'{intermediate_dir}/geocoded_points_wfh')) == 100
+    binned = arcpy.rows(f'{intermediate_dir}/hexes_wfh')
+    assert sum(row['Point_Count'] for row in binned) == 100
+    #: Only the published layers are written to the scratch gdb
+    trimmed = arcpy.rows('scratch.gdb/trimmed_hexes_wfh')
+    assert trimmed and all(row['Point_Count'] > 1 for row in trimmed)
+    assert len(trimmed) == sum(row['Point_Count'] > 1 for row in binned)
+    assert arcpy.rows('scratch.gdb/rollup_hexes_wfh_2')
+    assert 'method_layer' not in arcpy.tables
+    if workspace == 'memory':
+        assert not {'scratch.gdb/geocoded_points_wfh', 'scratch.gdb/hexes_wfh'} & set(arcpy.tables)
+    assert published == ['fs', '2x fs']
+
+
+@pytest.fixture
+def operator_info(tmp_path):
+    return update_hexes.SpecificInfo(
+        'operator', tmp_path / 'operators.xlsx', 'operator-sd', 'operator-fs', 'Operator Hexes', 'Operator locations'
+    )
+
+
+@pytest.fixture
+def run_harness(arcpy, common_info, monkeypatch):
+    '''Stands in for the login, DHRM, and geocoding parts of run_methods so it goes straight to binning and publishing
+    '''
+
+    common_info.employee_data_path.write_text('dhrm')
+    arcpy.SignInToPortal = lambda *args: None
+    arcpy.GetActivePortalURL = lambda: 'https://www.arcgis.com'
+    arcpy.management.CreateFileGDB = lambda folder, name: arcpy.add_table(join(folder, name), [], [])
+    monkeypatch.setattr(update_hexes, 'getpass', lambda prompt: 'password')
+    gis = SimpleNamespace(content=SimpleNamespace(get=lambda item_id: f'item {item_id}'))
+    monkeypatch.setattr(update_hexes, 'arcgis', SimpleNamespace(gis=SimpleNamespace(GIS=lambda *args: gis)))
+    monkeypatch.setattr(update_hexes, 'get_dhrm_dataframe', lambda *args: pd.DataFrame({'EINint': [1]}))
+
+    def get_method_records(specific_infos, dhrm_data, output_csv_path, cache_dir=None):
+        dhrm_data.to_csv(output_csv_path)
+        return dhrm_data
+
+    def geocode_points(points_csv, out_fc, *args, **kwargs):
+        common_info.geocode_matches_path.write_text('X,Y\n')
+        arcpy.add_table(out_fc, [], [])
+        return 0
+
+    monkeypatch.setattr(update_hexes, 'get_method_records', get_method_records)
+    monkeypatch.setattr(update_hexes, 'geocode_points', geocode_points)
+    monkeypatch.setattr(update_hexes, 'get_item_information', lambda item, description: ({}, None))
+    return common_info
+
+
+def test_failed_concurrent_publish_is_raised_after_the_others_finish(run_harness, wfh_info, operator_info, monkeypatch):
+    finished = []
+    publishing_threads = set()
+
+    def bin_and_publish(common_info, specific_info, items, recorder, checkpoints, executor, item_information):
+        def publish():
+            publishing_threads.add(threading.get_ident())
+            if specific_info.method == 'wfh':
+                raise RuntimeError('wfh publish failed')
+            finished.append(specific_info.fs_name)
+
+        return {specific_info.fs_name: executor.submit(publish)}
+
+    monkeypatch.setattr(update_hexes, 'bin_and_publish', bin_and_publish)
+
+    with pytest.raises(RuntimeError, match='wfh publish failed'):
+        update_hexes.run_methods(run_harness, [wfh_info, operator_info], StageRecorder(emit=lambda line: None))
+
+    assert finished == ['Operator Hexes']
+    assert threading.get_ident() not in publishing_threads
+
+
+class FakeItem:
+    '''An AGOL item whose thumbnail is always named thumbnail.png, recording the thumbnail each update reapplies
+    '''
+
+    def __init__(self, item_id, thumbnail_contents):
+        self.id = item_id
+        self.title = self.tags = self.snippet = self.accessInformation = item_id
+        self.thumbnail_contents = thumbnail_contents
+        self.reapplied = []
+
+    def download_thumbnail(self, save_folder=None):
+        thumbnail = Path(save_folder or '.') / 'thumbnail.png'
+        thumbnail.write_text(self.thumbnail_contents)
+        return str(thumbnail)
+
+    def update(self, item_properties=None, data=None, thumbnail=None):
+        if thumbnail is not None:
+            self.reapplied.append(Path(thumbnail).read_text())
+
+    def publish(self, overwrite=False):
+        pass
+
+
+def test_items_sharing_a_thumbnail_name_get_their_own_back():
+    items = [FakeItem('wfh-fs', 'wfh thumbnail'), FakeItem('operator-fs', 'operator thumbnail')]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        fetched = list(executor.map(lambda item: update_hexes.get_item_information(item, 'description'), items))
+    for item, (information, thumbnail) in zip(items, fetched):
+        update_hexes.publish_service_definition('layer.sd', FakeItem('sd', ''), item, information, thumbnail)
+        update_hexes.discard_thumbnail(thumbnail)
+
+    assert [item.reapplied for item in items] == [['wfh thumbnail'], ['operator thumbnail']]
+    assert not any(Path(thumbnail).parent.exists() for _, thumbnail in fetched)
+
+
+def test_item_information_is_only_prefetched_for_one_layer_per_worker(
+    run_harness, wfh_info, operator_info, monkeypatch
+):
+    fetched = []
+    prefetched = []
+    monkeypatch.setattr(
+        update_hexes, 'get_item_information', lambda item, description: fetched.append(item) or ({}, None)
+    )
+
+    def bin_and_publish(common_info, specific_info, items, recorder, checkpoints, executor, item_information):
+        prefetched.append(sorted(item_information))
+        return {}
+
+    monkeypatch.setattr(update_hexes, 'bin_and_publish', bin_and_publish)
+    run_harness.publish_workers = 1
+
+    update_hexes.run_methods(run_harness, [wfh_info, operator_info], StageRecorder(emit=lambda line: None))
+
+    assert fetched == ['item wfh-fs']
+    assert prefetched == [['wfh-fs'], ['wfh-fs']]
@@ -0,0 +1,204 @@
+'''Tests for vehicle_delta against an in-memory stand-in for a hosted feature layer.
+'''
+
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+import csv_points
+import fleetshare_secrets
+import update_agol_vehicles_pallet
+import vehicle_delta
+from fake_arcpy import FakeArcpy
+
+
+class FakeFeatureLayer:
+    '''
+    Keeps features in a dict by object id and answers query and edit_features
+    the way arcgis.features.FeatureLayer does for the calls apply_delta makes.
+
+    key:        The key field
+    key_type:   What the server's key field holds (ie, int for an integer
+                field); edits are stored as this type like the server would
+    '''
+
+    def __init__(self, key, key_type=str):
+        self.key = key
+        self.key_type = key_type
+        self.features = {}
+        self.next_oid = 1
+        self.calls = []
+
+    def load(self, rows_df):
+        for feature in vehicle_delta.to_features(rows_df):
+            self._add(feature)
+
+    def _add(self, feature):
+        attributes = dict(feature['attributes'], OBJECTID=self.next_oid)
+        attributes[self.key] = self.key_type(attributes[self.key])
+        self.features[self.next_oid] = attributes
+        self.next_oid += 1
+
+    def query(self, where, out_fields, return_geometry):
+        fields = out_fields.split(',')
+        features = [
+            SimpleNamespace(attributes={name: attributes[name] for name in fields})
+            for attributes in self.features.values()
+        ]
+        return SimpleNamespace(features=features)
+
+    def edit_features(self, adds=None, updates=None, deletes=None):
+        self.calls.append({'adds': len(adds or []), 'updates': len(updates or []), 'deletes': deletes})
+        results = {}
+        for feature in adds or []:
+            self._add(feature)
+        results['addResults'] = [{'success': True}] * len(adds or [])
+        for feature in updates or []:
+            attributes = dict(feature['attributes'])
+            attributes[self.key] = self.key_type(attributes[self.key])
+            self.features[attributes['OBJECTID']].update(attributes)
+        results['updateResults'] = [{'success': True}] * len(updates or [])
+        delete_ids = [int(oid) for oid in deletes.split(',')] if deletes else []
+        for oid in delete_ids:
+            del self.features[oid]
+        results['deleteResults'] = [{'success': True}] * len(delete_ids)
+        return results
+
+    def by_key(self):
+        return {attributes[self.key]: attributes for attributes in self.features.values()}
+
+
+def snapshot(rows):
+    return pd.DataFrame(rows, columns=['VEHICLE', 'LATITUDE', 'LONGITUDE', 'ODOMETER'])
+
+
+def test_numeric_server_keys_match_string_history_keys():
+    published = snapshot([(1001, 40.5, -111.9, 10), (1002, 40.6, -111.8, 20), (1003, 40.7, -111.7, 30)])
+    layer = FakeFeatureLayer('VEHICLE', key_type=int)
+    layer.load(published)
+    #: The vehicle history stores keys as strings
+    previous = published.astype({'VEHICLE': str})
+    current = snapshot([(1001, 40.5, -111.9, 15), (1002, 40.6, -111.8, 20), (1004, 40.8, -111.6, 0)])
+    current = current.astype({'VEHICLE': str})
+
+    delta = vehicle_delta.diff_snapshots(previous, current, 'VEHICLE')
+    counts = vehicle_delta.apply_delta(layer, delta, 'VEHICLE')
+
+    assert counts == {'adds': 1, 'updates': 1, 'deletes': 1}
+    vehicles = layer.by_key()
+    assert sorted(vehicles) == [1001, 1002, 1004]
+    assert vehicles[1001]['ODOMETER'] == 15
+
+
+def test_string_server_keys_match_numeric_csv_keys():
+    published = snapshot([('1001', 40.5, -111.9, 10), ('1002', 40.6, -111.8, 20)])
+    layer = FakeFeatureLayer('VEHICLE', key_type=str)
+    layer.load(published)
+    #: A csv read with type inference gets integer keys
+    previous = published.astype({'VEHICLE': int})
+    current = snapshot([(1001, 40.5, -111.9, 11)])
+
+    delta = vehicle_delta.diff_snapshots(previous, current, 'VEHICLE')
+    counts = vehicle_delta.apply_delta(layer, delta, 'VEHICLE')
+
+    assert counts == {'adds': 0, 'updates': 1, 'deletes': 1}
+    assert list(layer.by_key()) == ['1001']
+    assert layer.by_key()['1001']['ODOMETER'] == 11
+
+
+@pytest.fixture
+def published_layer():
+    published = snapshot([('V1', 40.5, -111.9, 10), ('V2', 40.6, -111.8, 20), ('V3', 40.7, -111.7, 30)])
+    layer = FakeFeatureLayer('VEHICLE')
+    layer.load(published)
+    return published, layer
+
+
+def test_adds_updates_and_deletes_are_applied(published_layer):
+    published, layer = published_layer
+    current = snapshot([('V1', 40.5, -111.9, 10), ('V2', 40.6, -111.8, 25), ('V4', 40.8, -111.6, 0)])
+
+    delta = vehicle_delta.diff_snapshots(published, current, 'VEHICLE')
+    counts = vehicle_delta.apply_delta(layer, delta, 'VEHICLE', batch_size=1)
+
+    assert delta.adds['VEHICLE'].tolist() == ['V4']
+    assert delta.updates['VEHICLE'].tolist() == ['V2']
+    assert delta.deletes == ['V3']
+    assert counts == {'adds': 1, 'updates': 1, 'deletes': 1}
+    vehicles = layer.by_key()
+    assert sorted(vehicles) == ['V1', 'V2', 'V4']
+    assert vehicles['V2']['ODOMETER'] == 25
+    #: Untouched vehicles keep their object ids
+    assert vehicles['V1']['OBJECTID'] == 1
+
+
+def test_rerunning_a_partly_applied_delta_does_not_duplicate(published_layer):
+    published, layer = published_layer
+    current = snapshot([('V1', 40.5, -111.9, 11), ('V4', 40.8, -111.6, 0), ('V5', 40.9, -111.5, 0)])
+    delta = vehicle_delta.diff_snapshots(published, current, 'VEHICLE')
+
+    #: The first run got as far as the first batch of adds and one delete before failing
+    layer.edit_features(adds=vehicle_delta.to_features(delta.adds.iloc[:1]))
+    layer.edit_features(deletes=str(layer.by_key()['V2']['OBJECTID']))
+    counts = vehicle_delta.apply_delta(layer, delta, 'VEHICLE')
+
+    assert counts == {'adds': 1, 'updates': 2, 'deletes': 1}
+    vehicles = layer.by_key()
+    assert sorted(vehicles) == ['V1', 'V4', 'V5']
+    assert len(layer.features) == 3
+    assert vehicles['V1']['ODOMETER'] == 11
+
+
+@pytest.fixture
+def pallet_secrets(monkeypatch):
+    monkeypatch.setattr(fleetshare_secrets, 'VEHICLE_KEY_FIELD', 'VEHICLE', raising=False)
+    monkeypatch.setattr(fleetshare_secrets, 'VEHICLE_BOUNDS', None, raising=False)
+    monkeypatch.setattr(fleetshare_secrets, 'VEHICLE_CSV_FIELDS', None, raising=False)
+    #: Field names are validated the way the full overwrite's feature class does
+    monkeypatch.setattr(csv_points, 'arcpy', FakeArcpy())
+
+
+def test_vehicle_with_bad_coordinates_is_left_out(published_layer, tmp_path, pallet_secrets):
+    published, layer = published_layer
+    snapshot_path = tmp_path / 'fleet_published.csv'
+    published.to_csv(snapshot_path, index=False)
+    source_path = tmp_path / 'vehicle_data_20210301.csv'
+    #: V3 reports null island and V4 is new but has no position
+    snapshot([('V1', 40.5, -111.9, 10), ('V2', 40.6, -111.8, 21), ('V3', 0, 0, 30),
+              ('V4', None, None, 0)]).to_csv(source_path, index=False)
+
+    delta = update_agol_vehicles_pallet.AGOLVehiclesPallet().get_delta(str(source_path), str(snapshot_path))
+    vehicle_delta.apply_delta(layer, delta, 'VEHICLE')
+
+    assert (delta.adds['VEHICLE'].tolist(), delta.updates['VEHICLE'].tolist(), delta.deletes) == ([], ['V2'], ['V3'])
+    assert sorted(layer.by_key()) == ['V1', 'V2']
+
+
+def test_delta_rows_get_the_published_field_names_and_types(tmp_path, monkeypatch, pallet_secrets):
+    columns = ['VEHICLE', 'LATITUDE', 'LONGITUDE', 'IN SERVICE', 'ODOMETER', 'NOTE']
+    snapshot_path = tmp_path / 'fleet_published.csv'
+    pd.DataFrame([('V1', 40.5, -111.9, True, 10, 'ok'), ('V2', 40.6, -111.8, True, 20, None)],
+                 columns=columns).to_csv(snapshot_path, index=False)
+    source_path = tmp_path / 'vehicle_data_20210301.csv'
+    #: V3's odometer doesn't fit the LONG field the full overwrite would give ODOMETER
+    pd.DataFrame([('V1', 40.5, -111.9, False, 10, 'ok'), ('V2', 40.6, -111.8, True, 25, None),
+                  ('V3', 40.7, -111.7, True, 'unknown', '7')],
+                 columns=columns).to_csv(source_path, index=False)
+    monkeypatch.setattr(fleetshare_secrets, 'VEHICLE_CSV_FIELDS', {'ODOMETER': 'LONG'})
+    layer = FakeFeatureLayer('VEHICLE')
+    layer.load(pd.DataFrame(
+        [('V1', 40.5, -111.9, 1, 10, 'ok'), ('V2', 40.6, -111.8, 1, 20, None), ('V3', 40.7, -111.7, 1, 5, '7')],
+        columns=['VEHICLE', 'LATITUDE', 'LONGITUDE', 'IN_SERVICE', 'ODOMETER', 'NOTE'],
+    ))
+
+    delta = update_agol_vehicles_pallet.AGOLVehiclesPallet().get_delta(str(source_path), str(snapshot_path))
+    vehicle_delta.apply_delta(layer, delta, 'VEHICLE')
+
+    assert list(delta.updates.columns) == ['VEHICLE', 'LATITUDE', 'LONGITUDE', 'IN_SERVICE', 'ODOMETER', 'NOTE']
+    assert delta.deletes == ['V3']
+    vehicles = layer.by_key()
+    assert sorted(vehicles) == ['V1', 'V2']
+    #: Booleans are SHORT 1/0 and numbers are ints, like csv_points.conform_chunk gives the full overwrite
+    assert (vehicles['V1']['IN_SERVICE'], vehicles['V2']['ODOMETER'], vehicles['V2']['NOTE']) == (0, 25, None)
+    assert 'IN SERVICE' not in vehicles['V1']
@@ -0,0 +1,92 @@
+'''Tests for the Parquet vehicle history store in a tmp_path.
+'''
+
+import datetime
+import subprocess
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from vehicle_history import PARTITION_FIELD, VehicleHistory
+
+HEADER = 'VEHICLE,LATITUDE,LONGITUDE,ODOMETER'
+SCRIPT = Path(__file__).resolve().parent.parent / 'src' / 'vehicle_history.py'
+
+
+def write_day(folder, day, rows):
+    csv_path = folder / f'vehicle_data_202103{day:02d}.csv'
+    csv_path.write_text('\n'.join([HEADER] + rows) + '\n')
+    return csv_path
+
+
+@pytest.fixture
+def fleet(tmp_path):
+    folder = tmp_path / 'fleet'
+    folder.mkdir()
+    write_day(folder, 1, ['1001,40.5,-111.9,100', '1002,40.6,-111.8,200'])
+    write_day(folder, 2, ['1001,40.5,-111.9,110', '1002,40.7,-111.7,250'])
+    write_day(folder, 3, ['1001,40.4,-111.9,130.5', '1003,37.1,-113.5,5'])
+    return folder
+
+
+@pytest.fixture
+def history(fleet, tmp_path):
+    store = VehicleHistory(tmp_path / 'history', key_field='VEHICLE')
+    for csv_path in sorted(fleet.glob('*.csv')):
+        store.ingest(csv_path)
+    return store
+
+
+def test_ingest_is_a_no_op_for_the_same_file_and_replaces_a_changed_one(fleet, history):
+    assert history.dates() == [datetime.date(2021, 3, day) for day in [1, 2, 3]]
+    assert not history.ingest(fleet / 'vehicle_data_20210301.csv')
+
+    write_day(fleet, 1, ['1001,40.5,-111.9,100'])
+    assert history.ingest(fleet / 'vehicle_data_20210301.csv')
+
+    snapshot = history.snapshot(datetime.date(2021, 3, 1))
+    assert snapshot['VEHICLE'].tolist() == ['1001']
+    assert PARTITION_FIELD not in snapshot.columns
+    assert history.snapshot(datetime.date(2021, 3, 4)) is None
+
+
+def test_query_by_dates_vehicles_and_columns(history):
+    results = history.query(start=datetime.date(2021, 3, 2), vehicles=[1001], columns=['ODOMETER'])
+    results = results.sort_values(PARTITION_FIELD)
+
+    assert list(results.columns) == [PARTITION_FIELD, 'VEHICLE', 'ODOMETER']
+    assert pd.to_datetime(results[PARTITION_FIELD]).dt.day.tolist() == [2, 3]
+    #: Ints on the 2nd and a decimal on the 3rd are read back as floats
+    assert results['ODOMETER'].tolist() == [110.0, 130.5]
+
+
+def test_query_outside_the_store_is_empty(history):
+    results = history.query(start=datetime.date(2022, 1, 1), columns=['ODOMETER'])
+
+    assert results.empty
+    assert list(results.columns) == [PARTITION_FIELD, 'ODOMETER']
+
+
+def test_vehicle_filter_needs_a_key_field(history):
+    with pytest.raises(ValueError):
+        VehicleHistory(history.root).query(vehicles=['1001'])
+
+
+def test_command_line_ingest_and_query(fleet, tmp_path):
+    store = tmp_path / 'cli_history'
+    output = tmp_path / 'out.csv'
+
+    def run(*args):
+        return subprocess.run(
+            [sys.executable, str(SCRIPT), str(store), '--key-field', 'VEHICLE', *args],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+
+    assert 'Added 3 of 3 csvs' in run('ingest', str(fleet))
+    assert 'Added 0 of 3 csvs' in run('ingest', str(fleet))
+    assert 'Wrote 2 rows' in run('query', '--start', '2021-03-03', '--output', str(output))
+    assert sorted(pd.read_csv(output)['VEHICLE']) == [1001, 1003]
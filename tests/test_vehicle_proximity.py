@@ -0,0 +1,114 @@
+'''Tests for vehicle_proximity's grid index against brute force haversine distances.
+'''
+
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from vehicle_history import VehicleHistory
+from vehicle_proximity import (
+    CLUSTER_FIELD, DISTANCE_FIELD, POINT_FIELD, VehicleIndex, haversine_miles, miles_driven
+)
+
+
+@pytest.fixture
+def vehicles():
+    '''Vehicles scattered over Utah, packed tighter around Salt Lake City, plus a few with bad coordinates
+    '''
+
+    rng = np.random.default_rng(7)
+    count = 1500
+    spread = np.where(rng.random(count) < 0.5, 0.05, 1.5)
+    vehicles = pd.DataFrame({
+        'VEHICLE': [f'V{number:04d}' for number in range(count)],
+        'LONGITUDE': np.clip(-111.89 + rng.normal(0, 1, count) * spread, -114.05, -109.05),
+        'LATITUDE': np.clip(40.76 + rng.normal(0, 1, count) * spread, 37, 42),
+    })
+    bad = pd.DataFrame({'VEHICLE': ['BAD1', 'BAD2'], 'LONGITUDE': [0, None], 'LATITUDE': [0, 40.5]})
+    return pd.concat([vehicles, bad], ignore_index=True)
+
+
+def brute_force_within(vehicles, lon, lat, miles):
+    valid = vehicles.dropna()
+    valid = valid[valid['LONGITUDE'] != 0]
+    distances = haversine_miles(lon, lat, valid['LONGITUDE'], valid['LATITUDE'])
+    return set(valid['VEHICLE'][distances <= miles])
+
+
+def brute_force_clusters(lon, lat, miles, candidates):
+    '''Cluster labels (-1 for non-candidates) by union-find over every pair of vehicles
+    '''
+
+    parents = list(range(len(lon)))
+
+    def root(number):
+        while parents[number] != number:
+            number = parents[number]
+        return number
+
+    for first in np.flatnonzero(candidates):
+        distances = haversine_miles(lon[first], lat[first], lon, lat)
+        for second in np.flatnonzero((distances <= miles) & candidates):
+            parents[root(second)] = root(first)
+    return [root(number) if candidates[number] else -1 for number in range(len(lon))]
+
+
+@pytest.mark.parametrize('miles', [0.5, 5, 40])
+def test_within_matches_brute_force(vehicles, miles):
+    index = VehicleIndex(vehicles, miles=5)
+
+    for lon, lat in [(-111.89, 40.76), (-113.6, 37.1), (-109.5, 41.9)]:
+        found = index.within(lon, lat, miles)
+        assert set(found['VEHICLE']) == brute_force_within(vehicles, lon, lat, miles)
+        assert found[DISTANCE_FIELD].is_monotonic_increasing
+        assert (found[DISTANCE_FIELD] <= miles).all()
+
+
+def test_nearby_lists_each_points_vehicles(vehicles):
+    index = VehicleIndex(vehicles, miles=3)
+    points = [(-111.89, 40.76), (-111.88, 40.77)]
+
+    found = index.nearby(points, 3)
+
+    for number, (lon, lat) in enumerate(points):
+        point_vehicles = set(found.loc[found[POINT_FIELD] == number, 'VEHICLE'])
+        assert point_vehicles == brute_force_within(vehicles, lon, lat, 3)
+
+
+@pytest.mark.parametrize('use_candidates', [False, True])
+def test_clusters_match_brute_force(vehicles, use_candidates):
+    index = VehicleIndex(vehicles, miles=1)
+    candidates = np.arange(len(index.vehicles)) % 3 != 0 if use_candidates else np.ones(len(index.vehicles), bool)
+    #: Bigger than the index's radius, so the grid is rebuilt for it
+    miles = 2
+
+    clustered = index.clusters(miles, candidates if use_candidates else None, min_size=2)
+
+    labels = pd.Series(brute_force_clusters(index.lon, index.lat, miles, candidates), index=index.vehicles['VEHICLE'])
+    sizes = labels.map(labels.value_counts())
+    expected = labels[(labels >= 0) & (sizes >= 2)]
+    assert set(clustered['VEHICLE']) == set(expected.index)
+    #: Same groups, whatever they're numbered
+    found_groups = {frozenset(group) for _, group in clustered.groupby(CLUSTER_FIELD)['VEHICLE']}
+    expected_groups = {frozenset(group.index) for _, group in expected.groupby(expected)}
+    assert found_groups == expected_groups
+    assert clustered['cluster_size'].is_monotonic_decreasing
+
+
+def test_miles_driven_from_history(tmp_path):
+    fleet = tmp_path / 'fleet'
+    fleet.mkdir()
+    for day, odometers in [(1, [100, 5000]), (2, [150, 5000]), (3, [400, 5010])]:
+        rows = [f'V{number},40.5,-111.9,{odometer}' for number, odometer in enumerate(odometers)]
+        (fleet / f'vehicle_data_202103{day:02d}.csv').write_text('\n'.join(['VEHICLE,LATITUDE,LONGITUDE,ODOMETER'] +
+                                                                            rows) + '\n')
+    history = VehicleHistory(tmp_path / 'history', key_field='VEHICLE')
+    for csv_path in sorted(fleet.glob('*.csv')):
+        history.ingest(csv_path)
+
+    driven = miles_driven(history, 'VEHICLE', end=datetime.date(2021, 3, 2))
+
+    assert driven.to_dict() == {'V0': 50, 'V1': 0}
+    assert miles_driven(history, 'VEHICLE').to_dict() == {'V0': 300, 'V1': 10}
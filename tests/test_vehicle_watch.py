@@ -0,0 +1,156 @@
+'''Tests for watch mode and the publish lock, watching a local folder through sftp_sync.LocalDirectoryClient.
+'''
+
+import datetime
+import os
+import time
+from contextlib import nullcontext
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+
+import fleetshare_secrets
+import update_agol_vehicles_pallet
+from checkpoints import file_digest
+from fingerprints import FINGERPRINT_FILE_NAME, FingerprintStore
+from sftp_sync import LocalDirectoryClient
+from vehicle_watch import LOCK_FILE_NAME, LockHeld, PublishLock
+
+ITEM_ID = 'features-item'
+
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    scratch_dir = tmp_path / 'scratch'
+    scratch_dir.mkdir()
+    fake_arcpy = SimpleNamespace(env=SimpleNamespace(scratchFolder=str(scratch_dir)))
+    monkeypatch.setattr(update_agol_vehicles_pallet, 'arcpy', fake_arcpy)
+    settings = {'SFTP_HOST': 'sftp.example.com', 'FEATURES_ITEM_ID': ITEM_ID, 'WATCH_INTERVAL_SECONDS': 0}
+    for name, value in settings.items():
+        monkeypatch.setattr(fleetshare_secrets, name, value, raising=False)
+    return scratch_dir
+
+
+@pytest.fixture
+def upload(tmp_path):
+    upload_dir = tmp_path / 'server' / 'upload'
+    upload_dir.mkdir(parents=True)
+    csv_path = upload_dir / f'vehicle_data_{datetime.date.today():%Y%m%d}.csv'
+    csv_path.write_text('VEHICLE,LATITUDE,LONGITUDE\n1001,40.5,-111.9\n')
+    return csv_path
+
+
+@pytest.fixture
+def pallet(scratch, monkeypatch):
+    '''A pallet whose publish just records the synced csv's fingerprint, like a successful publish would.
+    '''
+
+    published = []
+
+    def publish_latest_csv(self, client=None):
+        source_path, _ = self.latest_csv
+        published.append(source_path)
+        FingerprintStore(scratch / FINGERPRINT_FILE_NAME).record(ITEM_ID, source=file_digest(source_path))
+
+    monkeypatch.setattr(update_agol_vehicles_pallet.AGOLVehiclesPallet, 'publish_latest_csv', publish_latest_csv)
+    pallet = update_agol_vehicles_pallet.AGOLVehiclesPallet()
+    pallet.published = published
+    return pallet
+
+
+def test_new_csv_is_published_once(pallet, upload):
+    handled = pallet.watch(lambda: LocalDirectoryClient(upload.parent.parent), max_polls=4)
+
+    assert handled == 1
+    assert [os.path.basename(path) for path in pallet.published] == [upload.name]
+
+
+def test_reuploaded_duplicate_is_skipped(pallet, upload):
+    connect = partial(LocalDirectoryClient, upload.parent.parent)
+    pallet.watch(connect, max_polls=2)
+
+    #: Same contents, new modification time
+    os.utime(upload, (time.time() + 60, time.time() + 60))
+    handled = pallet.watch(connect, max_polls=2)
+
+    assert handled == 1
+    assert len(pallet.published) == 1
+
+
+def test_held_lock_blocks_publishing_until_released(pallet, upload, scratch):
+    client = LocalDirectoryClient(upload.parent.parent)
+    lock = PublishLock(scratch / LOCK_FILE_NAME).acquire()
+
+    assert pallet.watch(lambda: client, max_polls=3) == 0
+    assert not pallet.requires_processing()
+
+    lock.release()
+    assert pallet.watch(lambda: client, max_polls=2) == 1
+    assert len(pallet.published) == 1
+
+
+class DroppingClient(LocalDirectoryClient):
+    '''
+    A LocalDirectoryClient that can't be used once closed, and (if drop is
+    set) loses its connection on its first listing.
+    '''
+
+    def __init__(self, root, drop=False):
+        super().__init__(root)
+        self.drop = drop
+        self.closed = False
+
+    def listdir_attr(self, remotepath='.'):
+        if self.closed:
+            raise OSError('Socket is closed')
+        if self.drop:
+            self.drop = False
+            raise OSError('Connection reset')
+        return super().listdir_attr(remotepath)
+
+    def close(self):
+        self.closed = True
+
+
+def test_watch_reconnects_after_a_failed_poll(pallet, upload):
+    clients = []
+
+    def connect():
+        clients.append(DroppingClient(upload.parent.parent, drop=not clients))
+        return clients[-1]
+
+    handled = pallet.watch(connect, max_polls=4)
+
+    assert handled == 1
+    assert len(clients) == 2
+    assert all(client.closed for client in clients)
+
+
+def test_half_written_lock_is_held_not_stale(tmp_path):
+    lock_path = tmp_path / LOCK_FILE_NAME
+    lock_path.write_text('')
+
+    assert PublishLock(lock_path).is_held()
+    with pytest.raises(LockHeld):
+        PublishLock(lock_path).acquire()
+    assert lock_path.exists()
+
+
+def test_stale_lock_is_taken_over(tmp_path):
+    lock_path = tmp_path / LOCK_FILE_NAME
+    lock_path.write_text('')
+    os.utime(lock_path, (0, 0))
+
+    with PublishLock(lock_path) as lock:
+        assert lock.holder()['pid'] == os.getpid()
+    assert os.listdir(tmp_path) == []
+
+
+def test_empty_upload_folder_needs_no_processing(pallet, upload, monkeypatch):
+    client = LocalDirectoryClient(upload.parent.parent)
+    monkeypatch.setattr(pallet, 'connect_sftp', lambda: nullcontext(client))
+    upload.unlink()
+
+    assert not pallet.requires_processing()
+    assert pallet.published == []